@@ -0,0 +1,195 @@
+######################################################################################
+# AsyncChargePlan.py
+# asyncio variant of the statemachine in ChargePlan.py. All wallbox and measurement
+# communication runs on one event loop, without a thread per blocking call. The
+# decisions of each state are the same methods as in ChargePlanEngine, so both engines
+# have exactly the same state transitions.
+######################################################################################
+
+import sys
+import time
+import asyncio
+
+import ChargePlan
+from ChargePlan import ChargePlanState, SENSOR_PENDING
+import Drivers
+import Metrics
+import CircuitBreaker
+
+
+class AsyncChargePlanEngine(ChargePlan.ChargePlanEngine):
+
+    # Wallbox and measurement classes by "type" in config.json
+    wallboxTypes = Drivers.asyncWallboxes
+    weatherSensorTypes = Drivers.asyncWeatherSensors
+
+    def __init__(self, configPath='config.json', clock=None):
+        super().__init__(configPath, clock)
+        self.loop = None
+        self.commandEvent = None
+        self.retiredDrivers = list() # replaced wallboxes and sensors, which still have to be closed
+
+    def postCommand(self, command, *arguments):
+        # Can be called from any thread, wakes up the event loop
+        super().postCommand(command, *arguments)
+        if self.loop != None :
+            self.loop.call_soon_threadsafe(self.commandEvent.set)
+
+    async def waitAsync(self, seconds):
+        # Like asyncio.sleep, but returns as soon as a command arrives. Returns True in this case.
+        self.commandEvent.clear()
+        if self.processCommands() :
+            return True
+        try:
+            await asyncio.wait_for(self.commandEvent.wait(), timeout=max(seconds, 0))
+        except asyncio.TimeoutError:
+            return False
+        self.processCommands()
+        return True
+
+    def startSampler(self):
+        # The sampler runs as tasks on the event loop
+        self.sampler.startTasks(self.loop)
+
+    async def readWeatherSensorsAsync(self, powerWallbox):
+        if self.sampler != None :
+            # The first samples are read by the tasks after the start, returns at once later
+            await self.sampler.waitForFirstSamplesAsync(self.config.timing.sensorDeadlineSeconds)
+            return self.sampler.getReading()
+        # Query all weather sensors at the same time. Answers which arrive after the deadline are ignored.
+        deadline = self.loop.time() + self.config.timing.sensorDeadlineSeconds
+        tasks = [asyncio.ensure_future(weatherSensor.readValue(powerWallbox)) for weatherSensor in self.weatherSensorList]
+        failed = set()
+
+        while True:
+            reading = self.pickWeatherSensorAnswer(tasks, failed, False)
+            if reading is not SENSOR_PENDING :
+                break
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                # Deadline reached, use the answer with the highest priority received so far
+                reading = self.pickWeatherSensorAnswer(tasks, failed, True)
+                break
+            await asyncio.wait([task for task in tasks if not task.done()], timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+
+        # ignore all sensors with lower priority
+        for task in tasks:
+            task.cancel()
+        self.recordWeatherSensorValues(tasks)
+        return reading
+
+    def createWeatherSensors(self):
+        # The connections of the replaced sensors are closed by the event loop, see closeRetiredDrivers()
+        self.retiredDrivers.extend(self.weatherSensorList)
+        super().createWeatherSensors()
+
+    def initStep(self, chargePoint):
+        if chargePoint.charger != None :
+            self.retiredDrivers.append(chargePoint.charger)
+        return super().initStep(chargePoint)
+
+    async def closeRetiredDrivers(self):
+        while len(self.retiredDrivers) > 0 :
+            await self.retiredDrivers.pop().close()
+
+    async def closeDrivers(self):
+        if self.sampler != None :
+            # the sampler tasks must not use the drivers anymore
+            self.sampler.stop()
+            await asyncio.gather(*self.sampler.tasks, return_exceptions=True)
+        await self.closeRetiredDrivers()
+        for chargePoint in self.chargePoints.values():
+            if chargePoint.charger != None :
+                await chargePoint.charger.close()
+        for weatherSensor in self.weatherSensorList:
+            await weatherSensor.close()
+        if self.mqtt != None :
+            self.mqtt.stop()
+        # only if a Swissmeteo sensor has loaded the module
+        AsyncMeasurement = sys.modules.get("AsyncMeasurement")
+        if AsyncMeasurement != None :
+            await AsyncMeasurement.closeAsyncSwissmeteoFeeds()
+
+    async def runIterationAsync(self):
+        # One pass of the statemachines of all charge points which are due
+        started = time.perf_counter()
+        chargingChargePoints = list()
+        for chargePoint in self.beginIteration():
+            charger = chargePoint.charger
+            try:
+                if chargePoint.state == ChargePlanState.STATE_INIT :
+                    waitSeconds = self.initStep(chargePoint)
+                    await chargePoint.charger.flushSettings()
+                elif chargePoint.state == ChargePlanState.STATE_NO_CAR :
+                    await charger.readStatus()
+                    waitSeconds = self.noCarStep(chargePoint)
+                    chargePoint.IOerror_count = 0
+                elif chargePoint.state == ChargePlanState.STATE_CHARGING :
+                    await charger.readStatus()
+                    if self.chargingStatusStep(chargePoint) :
+                        # decided below, after one reading of the weather sensors for all wallboxes
+                        chargingChargePoints.append(chargePoint)
+                        continue
+                    waitSeconds = 0
+                    chargePoint.IOerror_count = 0
+                elif chargePoint.state == ChargePlanState.STATE_FINISHED :
+                    await charger.readStatus()
+                    waitSeconds = self.finishedStep(chargePoint)
+                    await charger.flushSettings()
+                    chargePoint.IOerror_count = 0
+                else :
+                    waitSeconds = self.errorStep(chargePoint)
+            except CircuitBreaker.CircuitOpenError:
+                waitSeconds = self.wallboxUnavailableStep(chargePoint)
+            except IOError:
+                waitSeconds = self.wallboxErrorStep(chargePoint)
+            self.endStep(chargePoint, waitSeconds)
+
+        if len(chargingChargePoints) > 0 :
+            reading = await self.readWeatherSensorsAsync(self.getTotalPower())
+            currents = self.allocateCurrents(reading, chargingChargePoints)
+            for chargePoint in chargingChargePoints:
+                try:
+                    waitSeconds = self.chargingStep(chargePoint, currents[chargePoint.id])
+                    await chargePoint.charger.flushSettings()
+                    chargePoint.IOerror_count = 0
+                except CircuitBreaker.CircuitOpenError:
+                    waitSeconds = self.wallboxUnavailableStep(chargePoint)
+                except IOError:
+                    waitSeconds = self.wallboxErrorStep(chargePoint)
+                self.endStep(chargePoint, waitSeconds)
+
+        await self.closeRetiredDrivers()
+        Metrics.iterationSeconds.observe(time.perf_counter() - started)
+        self.publishStatus()
+        self.saveState()
+        # small appends once per flushSeconds, fast enough for the event loop
+        if self.timeSeries != None :
+            self.timeSeries.flushIfDue()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.commandEvent = asyncio.Event()
+        self.initialize()
+
+        # main state machine
+        try:
+            while True:
+                await self.runIterationAsync()
+                # Wait for the next iteration, a command from the web application ends the wait immediately
+                await self.waitAsync(self.getSecondsToNextRun())
+        finally:
+            if self.timeSeries != None :
+                self.timeSeries.flush()
+            await self.closeDrivers()
+            self.loop = None
+
+    def start(self):
+        # Same interface as ChargePlanEngine, e.g. for the thread of ChargePlanWebApp
+        asyncio.run(self.run())
+
+
+#If file is called as script, not used as module
+if __name__ == "__main__":
+    cp = AsyncChargePlanEngine()
+    cp.start()
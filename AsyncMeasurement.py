@@ -0,0 +1,168 @@
+######################################################################################
+# AsyncMeasurement.py
+# asyncio variants of the measurement classes in Measurement.py, used by
+# AsyncChargePlan. Parsing and thresholds are shared with Measurement.py, only the
+# communication is asynchronous with aiohttp. The Smartfox is in AsyncSmartfox.py.
+######################################################################################
+
+import asyncio
+import time
+
+# aiohttp is used as asynchronous HTTP client
+import aiohttp
+
+import Measurement
+import Log
+from Measurement import log
+
+
+######################################################################################
+# Class AsyncHTTPClient
+#
+# Holds one aiohttp session, which is created within the event loop on first use.
+######################################################################################
+class AsyncHTTPClient:
+
+    asyncSession = None
+
+    def getSession(self):
+        if self.asyncSession == None :
+            self.asyncSession = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5))
+        return self.asyncSession
+
+    async def close(self):
+        if self.asyncSession != None :
+            await self.asyncSession.close()
+            self.asyncSession = None
+
+
+######################################################################################
+# Class AsyncWeatherSensor
+#
+# Base class of all asynchronous measurement classes, readValue() is a coroutine.
+######################################################################################
+class AsyncWeatherSensor(AsyncHTTPClient):
+
+    async def getMaxAllowedCurrent(self, powerWallbox, modeID):
+        return self.getCurrent(await self.readValue(powerWallbox), modeID)
+
+
+######################################################################################
+# Class AsyncSwissmeteoFeed
+#
+# Same cache as Measurement.SwissmeteoFeed, shared by all SwissmeteoAsync instances.
+######################################################################################
+class AsyncSwissmeteoFeed(AsyncHTTPClient, Measurement.SwissmeteoFeed):
+
+    def __init__(self, url):
+        super().__init__(url)
+        self.session = None # requests is not used, see getSession()
+        self.lock = asyncio.Lock()
+
+    async def getStation(self, stationID):
+        async with self.lock:
+            now = time.time()
+            slot = self.slotToUpdate(now)
+            if slot != None :
+                async with self.getSession().get(self.url, headers=self.requestHeaders()) as resp:
+                    self.lastCheck = now
+                    if resp.status != 304 :
+                        resp.raise_for_status()
+                        self.update(await resp.json(content_type=None), resp.headers, slot)
+        return self.lookup(stationID)
+
+# One feed per URL, all coroutines run on the same event loop
+asyncSwissmeteoFeeds = dict()
+
+def getAsyncSwissmeteoFeed(url):
+    if url not in asyncSwissmeteoFeeds :
+        asyncSwissmeteoFeeds[url] = AsyncSwissmeteoFeed(url)
+    return asyncSwissmeteoFeeds[url]
+
+async def closeAsyncSwissmeteoFeeds():
+    # The sessions belong to the event loop, close them before it ends
+    for feed in asyncSwissmeteoFeeds.values():
+        await feed.close()
+
+
+######################################################################################
+# Class SwissmeteoAsync
+######################################################################################
+class SwissmeteoAsync(AsyncWeatherSensor, Measurement.Swissmeteo):
+
+    def __init__(self, stationID, modes, url=Measurement.SwissmeteoFeed.URL):
+        Measurement.WeatherSensor.__init__(self, modes)
+        self.stationID = stationID
+        self.feed = getAsyncSwissmeteoFeed(url)
+
+    async def readValue(self, powerWallbox):
+        try:
+            stationName, sunshineduration = await self.feed.getStation(self.stationID)
+            log.info("Sunshine duration", extra=Log.fields(sensor="Swissmeteo", station=stationName, value=sunshineduration))
+            return sunshineduration
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError):
+            raise IOError
+
+    async def close(self):
+        # The session belongs to the shared feed
+        pass
+
+
+######################################################################################
+# Class SolarLogAsync
+######################################################################################
+class SolarLogAsync(AsyncWeatherSensor, Measurement.SolarLog):
+
+    def __init__(self, url, username, password, modes):
+        super().__init__(url, username, password, modes)
+        self.session = None # requests is not used, see getSession()
+        self.lock = asyncio.Lock()
+
+    def getSession(self):
+        # unsafe: also keep the cookies of a Solar-Log which is addressed by its IP address
+        if self.asyncSession == None :
+            self.asyncSession = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5), cookie_jar=aiohttp.CookieJar(unsafe=True))
+        return self.asyncSession
+
+    async def login(self):
+        async with self.getSession().post(self.url, data=self.loginPayload()) as resp:
+            await resp.read()
+        self.loggedIn = True
+
+    async def readWebsite(self):
+        async with self.lock:
+            if not self.loggedIn :
+                await self.login()
+            async with self.getSession().get(self.url) as resp:
+                statusCode, text = resp.status, await resp.text()
+            if self.needsLogin(statusCode, text) :
+                # Session expired, login again and repeat the request
+                await self.login()
+                async with self.getSession().get(self.url) as resp:
+                    text = await resp.text()
+            return text
+
+    async def readValue(self, powerWallbox):
+        #get current power
+        try:
+            return self.parsePower(await self.readWebsite())
+
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.loggedIn = False
+            raise IOError
+
+
+######################################################################################
+# Class FroniusAsync
+######################################################################################
+class FroniusAsync(AsyncWeatherSensor, Measurement.Fronius):
+
+    async def readValue(self, powerWallbox):
+        try:
+            async with self.getSession().get(self.requestURL(), params=self.requestParameters()) as resp:
+                return self.parseResponse(await resp.json(content_type=None), powerWallbox)
+
+        # not a bare except, asyncio.CancelledError must pass
+        except Exception:
+            raise IOError
@@ -0,0 +1,80 @@
+######################################################################################
+# AsyncSmartfox.py
+# asyncio variant of Smartfox.py, used by AsyncChargePlan.
+######################################################################################
+
+import asyncio
+
+# umodbus is only used to build and parse the Modbus TCP messages
+from umodbus import conf
+from umodbus.client import tcp
+
+from AsyncMeasurement import AsyncWeatherSensor
+import Smartfox
+
+
+######################################################################################
+# Class SmartfoxAsync
+#
+# Keeps one Modbus TCP connection open like Smartfox.Smartfox, using asyncio streams.
+######################################################################################
+class SmartfoxAsync(AsyncWeatherSensor, Smartfox.Smartfox):
+
+    def __init__(self, IPaddress, modes, timeout=2, port=502):
+        super().__init__(IPaddress, modes, timeout, port)
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    def closeConnection(self):
+        if self.writer != None :
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def sendMessage(self, message):
+        self.writer.write(message)
+        await self.writer.drain()
+
+        # Check exception ADU (which is shorter than all other responses) first.
+        exceptionADUSize = 9
+        responseErrorADU = await self.reader.readexactly(exceptionADUSize)
+        tcp.raise_for_exception_adu(responseErrorADU)
+
+        expectedResponseSize = tcp.expected_response_pdu_size_from_request_pdu(message[7:]) + 7
+        responseRemainder = await self.reader.readexactly(expectedResponseSize - exceptionADUSize)
+        return tcp.parse_response_adu(responseErrorADU + responseRemainder, message)
+
+    async def readPowerRegisters(self):
+        message = tcp.read_holding_registers(slave_id=1, starting_address=self.BLOCK_START, quantity=self.BLOCK_QUANTITY)
+        async with self.lock:
+            # Try once on the existing connection, reconnect if the device has closed it meanwhile
+            for attempt in range(2):
+                reused = self.writer != None
+                try:
+                    if not reused :
+                        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.IPaddress, self.port), self.timeout)
+                    return await asyncio.wait_for(self.sendMessage(message), self.timeout)
+                except asyncio.CancelledError:
+                    # cancelled by the deadline of the engine: the response can still arrive and
+                    # would be read as the answer of the next request
+                    self.closeConnection()
+                    raise
+                except Exception:
+                    self.closeConnection()
+                    if not reused or attempt == 1 :
+                        raise
+
+    async def readValue(self, powerWallbox):
+
+        try:
+            # Enable values to be signed (default is False).
+            conf.SIGNED_VALUES = False
+
+            return self.decodePower(await self.readPowerRegisters(), powerWallbox)
+
+        except Exception:
+            raise IOError
+
+    async def close(self):
+        self.closeConnection()
@@ -0,0 +1,91 @@
+######################################################################################
+# AsyncWallbox.py
+# asyncio variants of the wallboxes in Wallbox.py, used by AsyncChargePlan. Settings are
+# queued exactly like in Wallbox.py, only readStatus() and flushSettings() are
+# coroutines.
+#
+# goEchargerAsync: Connection to go-Echarger via local REST API, using aiohttp
+# goEchargerV2Async: Connection to go-Echarger via the HTTP API v2, using aiohttp
+# goEchargerSimulationAsync: simulates a go-Echarger for offline testing
+######################################################################################
+
+import asyncio
+import json
+
+# aiohttp is used as asynchronous HTTP client
+import aiohttp
+
+import Wallbox
+
+
+##################################################################################################
+# Wallbox goEchargerAsync
+##################################################################################################
+class goEchargerAsync(Wallbox.goEcharger):
+
+    def __init__(self, baseURL, absolutMaxCurrent):
+        super().__init__(baseURL, absolutMaxCurrent)
+        # The aiohttp session must be created within the event loop, see getSession()
+        self.session = None
+
+    def getSession(self):
+        if self.session == None :
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5))
+        return self.session
+
+    async def flushSettings(self):
+        # Send all pending settings in one single request
+        payload = self.pendingPayload()
+        if payload == None :
+            return
+        try:
+            async with self.getSession().get(self.baseURL + self.SET_PATH, params=payload) as resp:
+                await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise IOError
+        self.checkSetResponse(resp.status)
+        self.settingsSent()
+
+    async def readStatus(self):
+        #Connect to wallbox and read some stuff
+        try:
+            async with self.getSession().get(self.baseURL + self.STATUS_PATH, params=self.statusParameters()) as resp:
+                status = await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise IOError
+        except json.decoder.JSONDecodeError:
+            raise IOError
+        self.parseStatus(status)
+
+    async def close(self):
+        if self.session != None :
+            await self.session.close()
+            self.session = None
+
+
+##################################################################################################
+# Wallbox goEchargerV2Async
+##################################################################################################
+class goEchargerV2Async(goEchargerAsync, Wallbox.goEchargerV2):
+
+    async def readStatus(self):
+        try:
+            await super().readStatus()
+        except (KeyError, TypeError, IndexError):
+            raise IOError
+
+
+##################################################################################################
+# Wallbox goEchargerSimulationAsync
+# can be used if testing the software without a real wallbox
+##################################################################################################
+class goEchargerSimulationAsync(Wallbox.goEchargerSimulation):
+
+    async def flushSettings(self):
+        super().flushSettings()
+
+    async def readStatus(self):
+        super().readStatus()
+
+    async def close(self):
+        pass
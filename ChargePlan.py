@@ -1,16 +1,35 @@
 ######################################################################################
 # ChargePlan.py
 # Main statemachine for chargeplan. Can be used as script or within ChargePlanWebApp
-# as a web application.
+# as a web application. One engine handles all configured wallboxes, each with its own
+# statemachine (ChargePoint) but with shared weather sensors.
 ######################################################################################
 
 import time
+import math
 import datetime
+import functools
+import logging
+import queue
+import threading
+from collections import namedtuple
 from enum import IntEnum
-import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-import Wallbox
-import Measurement
+import Drivers
+from Drivers import WallboxState
+import Config
+import TimeSeries
+import Metrics
+import Sampler
+import CircuitBreaker
+import StateFile
+import Log
+
+# Planner.py, imported by createPlanner() only if planning is enabled, because it needs NumPy
+Planner = None
+
+log = Log.getLogger("Engine")
 
 
 class ChargePlanState(IntEnum):
@@ -20,311 +39,1131 @@ class ChargePlanState(IntEnum):
         STATE_FINISHED = 4
         STATE_ERROR = 5
 
-class ChargePlanEngine:
+# Returned by ChargePlanEngine.pickWeatherSensorAnswer if a sensor has not answered yet
+SENSOR_PENDING = object()
+
+# Wallboxes which are due within this time are handled in the same iteration, so they
+# share one reading of the weather sensors
+SCHEDULE_TOLERANCE_SECONDS = 5
+
+# Immutable snapshot of the engine, published after each iteration (see ChargePlanEngine.publishStatus).
+# goal and deadline are ISO strings or None, so the snapshot can be serialized directly.
+ChargePointStatus = namedtuple("ChargePointStatus", ["id", "name", "state", "allowCharging", "power", "energy", "mode", "car",
+                                                     "goal", "deadline", "limitToMaxEnergy", "maxEnergy"])
+EngineStatus = namedtuple("EngineStatus", ["version", "timestamp", "chargePoints"])
+
+
+######################################################################################
+# Class SystemClock
+#
+# Time source of the engine. Simulation.VirtualClock replaces it to run the engine
+# faster than real time.
+######################################################################################
+class SystemClock:
+
+    def monotonic(self):
+        return time.monotonic()
 
-    def __init__(self):
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.datetime.now()
+
+
+######################################################################################
+# Class ChargePoint
+#
+# State of one wallbox: its statemachine, goal, car and settings.
+######################################################################################
+class ChargePoint:
+
+    def __init__(self, wallboxConfig, mode, car):
+        self.id = wallboxConfig.id
+        self.wallboxConfig = wallboxConfig
+        self.charger = None
         self.state = ChargePlanState.STATE_INIT
         self.new_state = None
         self.power = 0
         self.energy = 0
         self._goal = None
         self.deadline = None
-        self.config = None
         self.allowCharging = False # internal state, not the same as the Wallbox state which can change through the Wallbox itself
         self.maxEnergy = 0
         self.limitToMaxEnergy = False
-        self.mode = 1
-        self.car = 1
+        self.mode = mode
+        self.car = car
+        self.IOerror_count = 0
+        self.nextRun = 0 # clock.monotonic() of the next iteration of this statemachine
+        self.stateSince = None # clock.monotonic() since the time in the state was last counted
+        self.plan = None # Planner.Plan for the goal, None without goal or planner
+        self.switchedAt = None # clock.monotonic() when allowCharging has been changed
+        self.breaker = None # CircuitBreaker of the wallbox, kept when the wallbox is initialized again
+        self.subscription = None # MQTT.WallboxSubscription if the wallbox publishes its status
+        self.restoredState = None # ChargePlanState of the snapshot, continued instead of STATE_INIT
+        self.current = None # current last set while charging, None if charging is not allowed
+        self.currentSince = None # clock.monotonic() when current has been changed
 
-        self.printToLogfile("Main initialized")
+    def getGoal(self):
+        return self._goal
+
+    def getStatus(self):
+        goal = None
+        deadline = None
+        if self._goal != None :
+            goal = self._goal.isoformat()
+        if self.deadline != None :
+            # without a charge from the grid in the plan, there's no deadline
+            deadline = self.deadline.isoformat()
+        return ChargePointStatus(self.id, self.wallboxConfig.name, int(self.state), self.allowCharging, self.power, self.energy, self.mode, self.car,
+                                 goal, deadline, self.limitToMaxEnergy, self.maxEnergy)
+
+    def getSnapshot(self):
+        # Settings and state which survive a restart, see StateFile.py
+        goal = None
+        deadline = None
+        if self._goal != None :
+            goal = self._goal.isoformat()
+        if self.deadline != None :
+            deadline = self.deadline.isoformat()
+        state = self.state
+        if state == ChargePlanState.STATE_INIT and self.restoredState != None :
+            state = self.restoredState
+        return {"id": self.id, "state": int(state), "allowCharging": self.allowCharging, "mode": self.mode, "car": self.car, "goal": goal,
+                "deadline": deadline, "limitToMaxEnergy": self.limitToMaxEnergy, "maxEnergy": self.maxEnergy}
+
+    def getMaxPowerkW(self):
+        # Maximum charging power allowed by absolutMaxCurrent
+        return self.wallboxConfig.absolutMaxCurrent * self.wallboxConfig.phases * self.wallboxConfig.voltage / 1000
+
+
+class ChargePlanEngine:
+
+    # Wallbox and measurement classes by "type" in config.json
+    wallboxTypes = Drivers.wallboxes
+    weatherSensorTypes = Drivers.weatherSensors
+
+    def __init__(self, configPath='config.json', clock=None):
+        if clock == None :
+            clock = SystemClock()
+        self.clock = clock
+        self.configFile = Config.ConfigFile(configPath)
+        self.config = None
+        self.chargePoints = dict() # wallbox id -> ChargePoint, in the order of the configuration
+        self.weatherSensorList = list()
+        self.weatherSensorMeasurements = list()
+        self.sensorExecutor = None
+        self.timeSeries = None
+        self.planner = None
+        self.sampler = None
+        self.mqtt = None # MQTT.MqttConnection
+        self.stateFile = None
+        # Commands from other threads (e.g. the web application), executed by the state machine
+        self.commands = queue.Queue()
+        # Values published by the wallboxes which don't need an immediate reaction, applied at the
+        # next iteration: wallbox id -> status. pushedStates: last published state per wallbox id.
+        self.deferredStatus = dict()
+        self.pushedStates = dict()
+        self.deferredLock = threading.Lock()
+        # Last published snapshot, readers wait on statusCondition for a new version
+        self.status = EngineStatus(0, None, tuple())
+        self.statusCondition = threading.Condition()
 
-    def printToLogfile(self, logstring):
-        dateObjectNow = datetime.datetime.now()
-        timeString = dateObjectNow.isoformat()
-        print(timeString + ": " + logstring)
+        if Log.listener == None :
+            # until the configuration is read
+            Log.setupLogging()
+        log.info("Main initialized")
+
+    def logChargePoint(self, chargePoint, message, level=logging.INFO, **values):
+        # Log with the wallbox and the state of the statemachine as fields
+        log.log(level, message, extra=Log.fields(wallbox=chargePoint.wallboxConfig.name, state=chargePoint.state.name, **values))
+
+    # The following settings can be called from any thread. They are only queued and then
+    # executed by the thread of the state machine, which wakes up immediately.
+    # wallboxID None means the first wallbox.
+    def setNewGoal(self, dateString, timeString, wallboxID=None):
+        self.postCommand(self.applyNewGoal, wallboxID, dateString, timeString)
+
+    def setMaxEnergy(self, limitToMaxEnergy, maxEnergy, wallboxID=None):
+        self.postCommand(self.applyMaxEnergy, wallboxID, limitToMaxEnergy, maxEnergy)
+
+    def setMode(self, mode, wallboxID=None):
+        self.postCommand(self.applyMode, wallboxID, mode)
+
+    def setCar(self, car, wallboxID=None):
+        self.postCommand(self.applyCar, wallboxID, car)
+
+    def activateSettings(self, wallboxID=None):
+        self.postCommand(self.applyActivateSettings, wallboxID)
+
+    def postCommand(self, command, *arguments):
+        self.commands.put((command, arguments))
+
+    def processCommands(self):
+        # Execute all queued commands, returns True if there were any
+        processed = False
+        while True:
+            try:
+                command, arguments = self.commands.get_nowait()
+            except queue.Empty:
+                return processed
+            self.runCommand(command, arguments)
+            processed = True
 
-    def setNewGoal(self, dateString, timeString):
+    def runCommand(self, command, arguments):
+        wallboxID = arguments[0]
+        chargePoint = self.getChargePoint(wallboxID)
+        if chargePoint == None :
+            log.warning("Command for unknown wallbox ignored", extra=Log.fields(wallbox=wallboxID))
+            return
+        if command(chargePoint, *arguments[1:]) == False :
+            # nothing has changed which needs a reaction
+            return
+        # React on the new settings immediately
+        chargePoint.nextRun = 0
+
+    def wait(self, seconds):
+        # Like time.sleep, but returns as soon as a command arrives. Returns True in this case.
+        try:
+            command, arguments = self.commands.get(timeout=max(seconds, 0))
+        except queue.Empty:
+            return False
+        self.runCommand(command, arguments)
+        self.processCommands()
+        return True
+
+    def applyNewGoal(self, chargePoint, dateString, timeString):
+        deadlineHours = self.config.cars[chargePoint.car].deadlineHours
         if dateString != None and timeString != None :
             #try to convert strings to datetime object
             try :
                 datetimeString = dateString + " " + timeString
-                self._goal = datetime.datetime.strptime(datetimeString, "%d.%m.%Y %H:%M")
+                chargePoint._goal = datetime.datetime.strptime(datetimeString, "%d.%m.%Y %H:%M")
                 #Deadline is the latest possible charging start time
-                self.deadline = self._goal - datetime.timedelta(hours=self.config["cars"][0]["deadlineHours"])
-                self.printToLogfile("Goal: " + str(self._goal))
-                self.printToLogfile("Deadline: " + str(self.deadline))
+                chargePoint.deadline = chargePoint._goal - datetime.timedelta(hours=deadlineHours)
+                self.logChargePoint(chargePoint, "Goal set", goal=chargePoint._goal.isoformat(), deadline=chargePoint.deadline.isoformat())
             except ValueError:
                 #possibly because of usage of mobile device with date picker, which returns YYYY-MM-DD
                 try :
                     datetimeString = dateString + " " + timeString
-                    self._goal = datetime.datetime.strptime(datetimeString, "%Y-%m-%d %H:%M")
+                    chargePoint._goal = datetime.datetime.strptime(datetimeString, "%Y-%m-%d %H:%M")
                     #Deadline is the latest possible charging start time
-                    self.deadline = self._goal - datetime.timedelta(hours=self.config["cars"][0]["deadlineHours"])
-                    self.printToLogfile("Goal: " + str(self._goal))
-                    self.printToLogfile("Deadline: " + str(self.deadline))
+                    chargePoint.deadline = chargePoint._goal - datetime.timedelta(hours=deadlineHours)
+                    self.logChargePoint(chargePoint, "Goal set", goal=chargePoint._goal.isoformat(), deadline=chargePoint.deadline.isoformat())
                 except ValueError:
                     # Typerror is raised if both arguments are None
-                    self._goal = None
-                    self.deadline = None
-                    self.printToLogfile("ValueError, no Goal. dateString: " + dateString + " timeString: " + timeString)
+                    chargePoint._goal = None
+                    chargePoint.deadline = None
+                    self.logChargePoint(chargePoint, "ValueError, no Goal", logging.WARNING, dateString=dateString, timeString=timeString)
         else :
-            self._goal = None
-            self.deadline = None
-            self.printToLogfile("No Goal set")
+            chargePoint._goal = None
+            chargePoint.deadline = None
+            self.logChargePoint(chargePoint, "No Goal set")
+        self.updatePlan(chargePoint)
 
-    def setMaxEnergy(self, limitToMaxEnergy, maxEnergy):
+    def applyMaxEnergy(self, chargePoint, limitToMaxEnergy, maxEnergy):
         #Only store data, don't send to wallbox directly
         if limitToMaxEnergy == True :
-            self.limitToMaxEnergy = True
-            self.maxEnergy = maxEnergy
-            self.printToLogfile("Energy limit set: " + str(maxEnergy) + " kWh")
+            chargePoint.limitToMaxEnergy = True
+            chargePoint.maxEnergy = maxEnergy
+            self.logChargePoint(chargePoint, "Energy limit set", maxEnergykWh=maxEnergy)
         else :
-            self.limitToMaxEnergy = False
-            self.maxEnergy = 0
-            self.printToLogfile("No energy limit set" )
+            chargePoint.limitToMaxEnergy = False
+            chargePoint.maxEnergy = 0
+            self.logChargePoint(chargePoint, "No energy limit set" )
+        self.updatePlan(chargePoint)
 
-    def setMode(self, mode):
+    def applyMode(self, chargePoint, mode):
         #Only store data, don't send to wallbox directly
-        self.mode = mode
-        self.printToLogfile("Mode set: " + str(mode))
+        if mode not in self.config.modes :
+            self.logChargePoint(chargePoint, "Unknown mode ignored", logging.WARNING, mode=mode)
+            return False
+        chargePoint.mode = mode
+        self.logChargePoint(chargePoint, "Mode set", mode=mode)
 
-    def setCar(self, car):
+    def applyCar(self, chargePoint, car):
         #Only store data
-        self.car = car
-        self.printToLogfile("Car set: " + str(car))
+        if car not in self.config.cars :
+            self.logChargePoint(chargePoint, "Unknown car ignored", logging.WARNING, car=car)
+            return False
+        chargePoint.car = car
+        self.logChargePoint(chargePoint, "Car set", car=car)
 
-    def activateSettings(self):
-        self.allowCharging = False
-        self.new_state = ChargePlanState.STATE_NO_CAR # this starts charging activities based on new settings
-    
-    def getGoal(self):
-        return self._goal
+    def onPushedStatus(self, wallboxID, status):
+        # Called by the MQTT thread for each message. Only a new state wakes up the engine, the power
+        # (published several times a minute) is applied at the next iteration.
+        with self.deferredLock:
+            pending = self.deferredStatus.setdefault(wallboxID, dict())
+            pending.update(status)
+            if "state" not in status or status["state"] == self.pushedStates.get(wallboxID) :
+                return
+            self.pushedStates[wallboxID] = status["state"]
+            del self.deferredStatus[wallboxID]
+        self.postCommand(self.applyPushedStatus, wallboxID, pending)
 
-    def start(self):
+    def applyDeferredStatus(self):
+        with self.deferredLock:
+            deferredStatus = self.deferredStatus
+            self.deferredStatus = dict()
+        for wallboxID, status in deferredStatus.items():
+            self.runCommand(self.applyPushedStatus, (wallboxID, status))
 
-        self.state = ChargePlanState.STATE_INIT
+    def applyPushedStatus(self, chargePoint, status):
+        # Status published by the wallbox. Only a car which has been plugged in or unplugged wakes up
+        # the statemachine, which then reads the whole status.
+        charger = chargePoint.charger
+        if charger == None :
+            return False
+        if "power" in status :
+            charger.currentPower = status["power"]
+            if chargePoint.state == ChargePlanState.STATE_CHARGING :
+                chargePoint.power = status["power"]
+        if "state" not in status or status["state"] == charger.state :
+            return False
+        plugged = (status["state"] == WallboxState.STATE_READY_NO_CAR) != (charger.state == WallboxState.STATE_READY_NO_CAR)
+        charger.state = status["state"]
+        if plugged :
+            self.logChargePoint(chargePoint, "Car plugged in or unplugged", wallboxState=charger.state.name)
+        return plugged
+
+    def applyActivateSettings(self, chargePoint):
+        chargePoint.allowCharging = False
+        if chargePoint.state != ChargePlanState.STATE_INIT :
+            chargePoint.state = ChargePlanState.STATE_NO_CAR # this starts charging activities based on new settings
+
+    def getChargePoint(self, wallboxID=None):
+        # None means the first wallbox. Returns None if there is no such wallbox (yet).
+        chargePoints = self.chargePoints
+        if wallboxID == None :
+            return next(iter(chargePoints.values()), None)
+        return chargePoints.get(wallboxID)
+
+    def getChargePoints(self):
+        return list(self.chargePoints.values())
+
+    def publishStatus(self):
+        # Publish a new snapshot if anything has changed since the last one
+        chargePoints = tuple(chargePoint.getStatus() for chargePoint in self.chargePoints.values())
+        if chargePoints == self.status.chargePoints :
+            return
+        with self.statusCondition:
+            self.status = EngineStatus(self.status.version + 1, self.clock.now().isoformat(), chargePoints)
+            self.statusCondition.notify_all()
+
+    def saveState(self):
+        # Written only if anything has changed
+        if self.stateFile == None :
+            return
+        try:
+            self.stateFile.save({"chargePoints": [chargePoint.getSnapshot() for chargePoint in self.chargePoints.values()]})
+        except OSError as error:
+            log.warning("State not saved", extra=Log.fields(file=self.stateFile.path, error=error))
+
+    def restoreState(self):
+        # Take over the snapshot of the last run. The charge points continue in their state after
+        # one status read, instead of stopping the charging in STATE_INIT.
+        if self.stateFile == None :
+            return
+        snapshot = self.stateFile.load()
+        if snapshot == None :
+            return
+        try:
+            for entry in snapshot["chargePoints"]:
+                chargePoint = self.chargePoints.get(entry["id"])
+                if chargePoint != None :
+                    self.restoreChargePoint(chargePoint, entry)
+        except (KeyError, TypeError, ValueError) as error:
+            log.warning("Invalid state file, starting without it", extra=Log.fields(file=self.stateFile.path, error=error))
+
+    def restoreChargePoint(self, chargePoint, entry):
+        state = ChargePlanState(entry["state"])
+        if state not in (ChargePlanState.STATE_NO_CAR, ChargePlanState.STATE_CHARGING, ChargePlanState.STATE_FINISHED) :
+            return
+        if entry["mode"] in self.config.modes :
+            chargePoint.mode = entry["mode"]
+        if entry["car"] in self.config.cars :
+            chargePoint.car = entry["car"]
+        if entry["goal"] != None :
+            chargePoint._goal = datetime.datetime.fromisoformat(entry["goal"])
+        if entry["deadline"] != None :
+            chargePoint.deadline = datetime.datetime.fromisoformat(entry["deadline"])
+        chargePoint.limitToMaxEnergy = entry["limitToMaxEnergy"]
+        chargePoint.maxEnergy = entry["maxEnergy"]
+        chargePoint.allowCharging = entry["allowCharging"]
+        chargePoint.restoredState = state
+        self.logChargePoint(chargePoint, "State restored", restoredState=state.name, allowCharging=chargePoint.allowCharging)
+
+    def getStatus(self):
+        # The snapshot is never modified, it can be used without locking
+        return self.status
+
+    def waitForStatus(self, version, timeout):
+        # Wait until a snapshot newer than version is published, returns the current snapshot
+        with self.statusCondition:
+            self.statusCondition.wait_for(lambda: self.status.version != version, timeout)
+            return self.status
+
+    def getConfig(self):
+        # Current configuration, reloaded if the file has changed
+        return self.configFile.get()
+
+    def reloadConfig(self):
+        # Apply a changed configuration file without interrupting charging. Only wallboxes whose
+        # IP, type or mqttTopic has changed are initialized again.
+        config = self.configFile.get()
+        if config is self.config :
+            return
+        loggingChanged = config.logging != self.config.logging
+        mqttChanged = config.mqtt != self.config.mqtt
+        samplingChanged = config.sampling != self.config.sampling
+        stateChanged = config.state != self.config.state
+        oldDevices = [(measurement.type, measurement.settings, measurement.sampleSeconds) for measurement in self.config.measurements]
+        newDevices = [(measurement.type, measurement.settings, measurement.sampleSeconds) for measurement in config.measurements]
+        self.config = config
+        if loggingChanged :
+            self.setupLogging()
+        if mqttChanged :
+            log.info("Configuration of MQTT changed, connect again")
+            self.createMqtt()
+        if newDevices != oldDevices or mqttChanged :
+            log.info("Configuration of measurements changed, re-initialize weather sensors")
+            self.createWeatherSensors()
+        else :
+            for weatherSensor, measurement in zip(self.weatherSensorList, self.weatherSensorMeasurements):
+                weatherSensor.modes = config.measurements[measurement].modes
+                weatherSensor.hysteresis = config.measurements[measurement].hysteresis
+            if samplingChanged :
+                self.createSampler()
+        self.updateChargePoints()
+        if mqttChanged :
+            for chargePoint in self.chargePoints.values():
+                if chargePoint.charger != None :
+                    self.subscribeWallbox(chargePoint)
+        if stateChanged :
+            self.createStateFile()
+        if self.timeSeries == None or config.history != (self.timeSeries.directory, self.timeSeries.retentionDays, self.timeSeries.flushSeconds) :
+            self.createTimeSeries()
+        self.createPlanner()
+        log.info("Configuration reloaded")
+
+    def updateChargePoints(self):
+        # Create a charge point for each configured wallbox. Existing charge points keep their
+        # settings, but they are initialized again if the connection to their wallbox has changed.
+        # Cars and modes which are not configured anymore are replaced by the first one.
+        chargePoints = dict()
+        for wallboxConfig in self.config.wallboxList:
+            chargePoint = self.chargePoints.get(wallboxConfig.id)
+            if chargePoint == None :
+                chargePoint = ChargePoint(wallboxConfig, self.config.modeList[0].id, self.config.carList[0].id)
+            elif chargePoint.wallboxConfig != wallboxConfig :
+                self.updateWallboxConfig(chargePoint, wallboxConfig)
+            if chargePoint.car not in self.config.cars :
+                self.logChargePoint(chargePoint, "Car not configured anymore, using the first one", logging.WARNING, car=chargePoint.car)
+                chargePoint.car = self.config.carList[0].id
+            if chargePoint.mode not in self.config.modes :
+                self.logChargePoint(chargePoint, "Mode not configured anymore, using the first one", logging.WARNING, mode=chargePoint.mode)
+                chargePoint.mode = self.config.modeList[0].id
+            chargePoints[wallboxConfig.id] = chargePoint
+        # replace at once, the web application might read it meanwhile
+        self.chargePoints = chargePoints
+
+    def updateWallboxConfig(self, chargePoint, wallboxConfig):
+        oldConfig = chargePoint.wallboxConfig
+        chargePoint.wallboxConfig = wallboxConfig
+        if (oldConfig.IP, oldConfig.type, oldConfig.mqttTopic) != (wallboxConfig.IP, wallboxConfig.type, wallboxConfig.mqttTopic) :
+            chargePoint.state = ChargePlanState.STATE_INIT
+            chargePoint.nextRun = 0
+        elif chargePoint.charger != None :
+            # e.g. a new name or maximum current, charging continues
+            chargePoint.charger.absolutMaxCurrent = wallboxConfig.absolutMaxCurrent
+
+    def createWallbox(self, wallboxConfig):
+        # "type": "goEchargerSimulation" simulates the wallbox for developing
+        wallboxClass = self.wallboxTypes.get(wallboxConfig.type)
+        if wallboxClass == None :
+            log.error("Unknown wallbox type", extra=Log.fields(wallbox=wallboxConfig.name, type=wallboxConfig.type))
+            raise IOError("Unknown wallbox type " + str(wallboxConfig.type))
+        return wallboxClass.fromConfig(wallboxConfig)
+
+    def instrumentWallbox(self, chargePoint):
+        # Latency and errors of the wallbox requests in the metrics
+        name = chargePoint.wallboxConfig.name
+        Metrics.instrument(chargePoint.charger, "readStatus", name)
+        Metrics.instrument(chargePoint.charger, "flushSettings", name)
+        # called by flushSettings only if a request has been sent
+        Metrics.countCalls(chargePoint.charger, "settingsSent", Metrics.wallboxCommands, wallbox=name)
+
+    def createWeatherSensor(self, measurement):
+        # Returns None if the type is unknown
+        weatherSensorClass = self.weatherSensorTypes.get(measurement.type)
+        if weatherSensorClass == None :
+            return None
+        return weatherSensorClass.fromSettings(measurement.settings, measurement.modes)
+
+    def createWeatherSensors(self):
+        for weatherSensor in self.weatherSensorList:
+            if hasattr(weatherSensor, "unsubscribe") :
+                weatherSensor.unsubscribe()
+        self.weatherSensorList = list()
+        self.weatherSensorMeasurements = list() # index of the measurement in the configuration for each sensor
+        for index, measurement in enumerate(self.config.measurements):
+            weatherSensor = self.createWeatherSensor(measurement)
+            if weatherSensor == None :
+                log.warning("Invalid weatherSensor definition", extra=Log.fields(sensor=measurement.type))
+                continue
+            Metrics.instrument(weatherSensor, "readValue", self.getSensorInstance(index))
+            weatherSensor.breaker = self.createBreaker(self.getSensorInstance(index))
+            CircuitBreaker.guard(weatherSensor, "readValue", weatherSensor.breaker)
+            weatherSensor.hysteresis = measurement.hysteresis
+            self.weatherSensorList.append(weatherSensor)
+            self.weatherSensorMeasurements.append(index)
+
+        if self.sensorExecutor != None :
+            self.sensorExecutor.shutdown(wait=False)
+        self.sensorExecutor = ThreadPoolExecutor(max_workers=max(1, len(self.weatherSensorList)), thread_name_prefix="WeatherSensor")
+        self.createSampler()
+
+    def createSampler(self):
+        # Background reading of the weather sensors, replaces the reading in each iteration
+        if self.sampler != None :
+            self.sampler.stop()
+            self.sampler = None
+        sampling = self.config.sampling
+        if not sampling.enabled :
+            return
+        samplers = list()
+        for weatherSensor, measurement in zip(self.weatherSensorList, self.weatherSensorMeasurements):
+            intervalSeconds = self.config.measurements[measurement].sampleSeconds
+            if intervalSeconds == None :
+                intervalSeconds = sampling.intervalSeconds
+            onSample = functools.partial(self.recordValue, self.getSensorSeriesName(measurement))
+            samplers.append(Sampler.SensorSampler(weatherSensor, self.getSensorInstance(measurement), intervalSeconds, self.getTotalPower, onSample,
+                                                  sampling.windowSamples, sampling.filter, sampling.timeConstantSeconds))
+        self.sampler = Sampler.Sampler(samplers, sampling.maxAgeSeconds)
+        self.startSampler()
+
+    def startSampler(self):
+        self.sampler.start()
+        # Without a first sample the engine would wait waitWithoutSunSeconds after each start
+        self.sampler.waitForFirstSamples(self.config.timing.sensorDeadlineSeconds)
+
+    def createBreaker(self, name):
+        settings = self.config.circuitBreaker
+        return CircuitBreaker.CircuitBreaker(name, self.clock, settings.failureThreshold, settings.backoffSeconds, settings.maxBackoffSeconds, settings.jitter)
+
+    def guardWallbox(self, chargePoint):
+        # Requests to a wallbox which has failed repeatedly fail immediately until its backoff has passed
+        if chargePoint.breaker == None :
+            chargePoint.breaker = self.createBreaker(chargePoint.wallboxConfig.name)
+        CircuitBreaker.guard(chargePoint.charger, "readStatus", chargePoint.breaker)
+        CircuitBreaker.guard(chargePoint.charger, "flushSettings", chargePoint.breaker)
+
+    def createStateFile(self):
+        if self.config.state.file == None :
+            self.stateFile = None
+        else :
+            self.stateFile = StateFile.StateFile(self.config.state.file)
+
+    def createMqtt(self):
+        # Push ingestion of the wallbox status and meters, see MQTT.py. paho-mqtt is only imported
+        # if a broker is configured.
+        if self.mqtt != None :
+            import MQTT
+            MQTT.connection = None
+            self.mqtt.stop()
+            self.mqtt = None
+        settings = self.config.mqtt
+        if settings.host == None :
+            return
+        try:
+            import MQTT
+        except ImportError:
+            log.warning("paho-mqtt is not installed, the wallboxes are polled")
+            return
+        self.mqtt = MQTT.MqttConnection(settings.host, settings.port, settings.username, settings.password, settings.keepaliveSeconds, settings.clientID)
+        MQTT.connection = self.mqtt
+        self.mqtt.start()
+
+    def subscribeWallbox(self, chargePoint):
+        if chargePoint.subscription != None :
+            chargePoint.subscription.close()
+            chargePoint.subscription = None
+        topic = chargePoint.wallboxConfig.mqttTopic
+        if self.mqtt == None or topic == None :
+            return
+        chargePoint.subscription = self.mqtt.subscribeWallbox(topic, functools.partial(self.onPushedStatus, chargePoint.id))
+
+    def getIdleWaitSeconds(self, chargePoint, waitSeconds):
+        # While the wallbox publishes its status, polling is only a slow liveness check
+        if chargePoint.subscription != None and chargePoint.subscription.isLive() :
+            return max(waitSeconds, self.config.mqtt.livenessSeconds)
+        return waitSeconds
+
+    def getSensorInstance(self, measurementIndex):
+        # Label of a sensor in the metrics
+        return "measurement" + str(measurementIndex)
+
+    def initialize(self):
+        # load configuration from JSON file and create the weather sensors and charge points
+        self.config = self.configFile.load()
+        self.setupLogging()
+        self.createMqtt()
+        self.createWeatherSensors()
+        self.updateChargePoints()
+        self.createStateFile()
+        self.restoreState()
+        self.createTimeSeries()
+        self.createPlanner()
+
+    def setupLogging(self):
+        loggingConfig = self.config.logging
+        Log.setupLogging(loggingConfig.level, loggingConfig.file, loggingConfig.maxBytes, loggingConfig.backupCount, loggingConfig.repeatSeconds, loggingConfig.console)
+
+    def createTimeSeries(self):
+        if self.timeSeries != None :
+            self.timeSeries.flush()
+        history = self.config.history
+        self.timeSeries = TimeSeries.TimeSeriesStore(history.directory, history.retentionDays, history.flushSeconds)
+
+    def isPlanningEnabled(self):
+        return self.config.planning.enabled
+
+    def createPlanner(self):
+        planning = self.config.planning
+        self.planner = None
+        if not self.isPlanningEnabled() :
+            return
+        global Planner
+        try:
+            import Planner
+        except ImportError:
+            # NumPy is not installed, charging from the grid starts deadlineHours before the goal
+            log.warning("NumPy is not installed, charging by the deadline of the car")
+            return
+        self.planner = Planner.ChargePlanner(self.createForecast(), planning.slotMinutes * 60, planning.horizonDays, planning.forecastFactor, planning.reserveMinutes * 60)
+
+    def createForecast(self):
+        # PV forecast from the recorded values of the first sensor which measures a power
+        for weatherSensor, measurement in zip(self.weatherSensorList, self.weatherSensorMeasurements):
+            if weatherSensor.valueIsPower :
+                return Planner.HistoryForecast(self.timeSeries, self.getSensorSeriesName(measurement), self.config.planning.historyDays, self.config.planning.slotMinutes * 60)
+        return Planner.NoForecast()
+
+    def getSensorSeriesName(self, measurementIndex):
+        return "sensor" + str(measurementIndex) + "." + self.config.measurements[measurementIndex].type
+
+    def recordValue(self, name, value):
+        # Store a value in the time series, which are shown in the web application
+        if self.timeSeries != None :
+            self.timeSeries.append(name, value, self.clock.time())
+
+    def recordWeatherSensorValues(self, futures):
+        # Store the values of all sensors which have answered, not only the one which is used
+        for weatherSensor, measurement, future in zip(self.weatherSensorList, self.weatherSensorMeasurements, futures):
+            if future.done() and not future.cancelled() and future.exception() == None :
+                self.recordValue(self.getSensorSeriesName(measurement), future.result())
+
+    def pickWeatherSensorAnswer(self, futures, failed, deadlineReached):
+        # The first sensor in the list has the highest priority, its answer is used as soon as all
+        # sensors before it have failed. Returns (weatherSensor, value), SENSOR_PENDING if a sensor
+        # with higher priority might still answer or None if no sensor has returned a valid value.
+        # Works with concurrent.futures.Future and asyncio.Task.
+        for weatherSensor, measurementIndex, future in zip(self.weatherSensorList, self.weatherSensorMeasurements, futures):
+            if not future.done():
+                if not deadlineReached :
+                    return SENSOR_PENDING
+                future.cancel()
+                log.warning("WeatherSensor timeout", extra=Log.fields(sensor=type(weatherSensor).__name__))
+                Metrics.driverTimeouts.inc(driver=type(weatherSensor).__name__, instance=self.getSensorInstance(measurementIndex))
+                continue
+            if weatherSensor in failed:
+                continue
+            try:
+                value = future.result()
+            except CircuitBreaker.CircuitOpenError:
+                # not asked, the sensor has failed repeatedly
+                failed.add(weatherSensor)
+                continue
+            except IOError:
+                # probably connection error to sensor
+                log.warning("WeatherSensor IOError", extra=Log.fields(sensor=type(weatherSensor).__name__))
+                failed.add(weatherSensor)
+                continue
+            if value != None:
+                return (weatherSensor, value)
+            failed.add(weatherSensor)
+        return None
+
+    def readWeatherSensors(self, powerWallbox):
+        if self.sampler != None :
+            # filtered values of the background sampler, without waiting for the devices
+            return self.sampler.getReading()
+        # Query all weather sensors at the same time. Answers which arrive after the deadline are ignored.
+        deadline = time.monotonic() + self.config.timing.sensorDeadlineSeconds
+        futures = [self.sensorExecutor.submit(weatherSensor.readValue, powerWallbox) for weatherSensor in self.weatherSensorList]
+        failed = set()
 
-        # main state machine
         while True:
-            self.printToLogfile("State: " + str(self.state) )
+            reading = self.pickWeatherSensorAnswer(futures, failed, False)
+            if reading is not SENSOR_PENDING :
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # Deadline reached, use the answer with the highest priority received so far
+                reading = self.pickWeatherSensorAnswer(futures, failed, True)
+                break
+            wait([future for future in futures if not future.done()], timeout=remaining, return_when=FIRST_COMPLETED)
+
+        # ignore all sensors with lower priority
+        for future in futures:
+            future.cancel()
+        self.recordWeatherSensorValues(futures)
+        return reading
+
+    def getTotalPower(self):
+        # Charging power of all wallboxes, as last read
+        return sum(chargePoint.power for chargePoint in self.chargePoints.values())
+
+    def isDeadlineReached(self, chargePoint):
+        return chargePoint.deadline != None and self.clock.now() > chargePoint.deadline
+
+    def getRequiredEnergykWh(self, chargePoint):
+        # Energy still needed for the goal, a full battery if there's no limit
+        if chargePoint.limitToMaxEnergy :
+            targetkWh = chargePoint.maxEnergy
+        else :
+            targetkWh = self.config.cars[chargePoint.car].batterysizekWh
+        return max(0, targetkWh - chargePoint.energy)
+
+    def updatePlan(self, chargePoint):
+        # Plan again in each iteration, with the energy charged so far. The deadline becomes the
+        # start of the charge from the grid in the plan.
+        if self.planner == None or chargePoint._goal == None :
+            chargePoint.plan = None
+            return
+        chargingCount = sum(1 for other in self.chargePoints.values() if other.state == ChargePlanState.STATE_CHARGING)
+        plan = self.planner.plan(self.clock.time(), chargePoint._goal.timestamp(), self.getRequiredEnergykWh(chargePoint),
+                                 chargePoint.getMaxPowerkW(), 1 / max(1, chargingCount))
+        if plan.gridStart != None :
+            chargePoint.deadline = datetime.datetime.fromtimestamp(plan.gridStart)
+        else :
+            chargePoint.deadline = None
+        if not plan.reachable and (chargePoint.plan == None or chargePoint.plan.reachable) :
+            self.logChargePoint(chargePoint, "Goal can't be reached", logging.WARNING, goal=chargePoint._goal.isoformat())
+        chargePoint.plan = plan
+
+    def getGridCurrent(self, chargePoint):
+        # Current to charge with, independent of the sun. 0 if only the sun decides.
+        plan = chargePoint.plan
+        if plan != None :
+            if plan.powerkW <= 0 :
+                return 0
+            current = math.ceil(plan.powerkW * 1000 / (chargePoint.wallboxConfig.phases * chargePoint.wallboxConfig.voltage))
+            return min(max(current, Planner.MIN_CURRENT), chargePoint.wallboxConfig.absolutMaxCurrent)
+        if self.isDeadlineReached(chargePoint) :
+            return chargePoint.wallboxConfig.absolutMaxCurrent
+        return 0
+
+    def isFollowingSurplus(self, chargePoint):
+        mode = self.config.modes.get(chargePoint.mode)
+        return mode != None and mode.control == "surplus"
+
+    def getSurplusCurrent(self, weatherSensor, powerkW, chargePoint):
+        # Current which uses the power without drawing from the grid, 0 if it's below the minimum
+        # current of the car. While charging, the minimum current is kept down to a power lowered
+        # by the hysteresis.
+        wallboxConfig = chargePoint.wallboxConfig
+        minCurrent = self.config.cars[chargePoint.car].minCurrent
+        wattsPerAmpere = wallboxConfig.phases * wallboxConfig.voltage
+        current = math.floor(powerkW * 1000 / wattsPerAmpere)
+        if current < minCurrent :
+            if chargePoint.allowCharging and (powerkW + weatherSensor.hysteresis) * 1000 / wattsPerAmpere >= minCurrent :
+                return minCurrent
+            return 0
+        return min(current, wallboxConfig.absolutMaxCurrent)
+
+    def getSensorCurrent(self, weatherSensor, value, chargePoint):
+        if weatherSensor.valueIsPower and self.isFollowingSurplus(chargePoint) :
+            return self.getSurplusCurrent(weatherSensor, value, chargePoint)
+        # While charging, the thresholds are lowered by the hysteresis of the measurement
+        if chargePoint.allowCharging :
+            return weatherSensor.getCurrent(value, chargePoint.mode, weatherSensor.hysteresis)
+        return weatherSensor.getCurrent(value, chargePoint.mode)
+
+    def allocateCurrents(self, reading, chargePoints):
+        # Split one reading of the weather sensors between the wallboxes, returns the maximum
+        # allowed current (or None) by wallbox id. A power is shared fairly: each wallbox gets
+        # the same part, but not more than it can use with absolutMaxCurrent. The rest goes to
+        # the others. The last one gets all that's left, so one wallbox alone is not limited.
+        if reading == None :
+            return {chargePoint.id: None for chargePoint in chargePoints}
+        weatherSensor, value = reading
+
+        currents = dict()
+        solarChargePoints = list()
+        for chargePoint in chargePoints:
+            if self.getGridCurrent(chargePoint) > 0 :
+                # charges from the grid anyway, the power it uses is not available for the others
+                currents[chargePoint.id] = self.getSensorCurrent(weatherSensor, value, chargePoint)
+                if weatherSensor.valueIsPower :
+                    value = value - chargePoint.power
+            else :
+                solarChargePoints.append(chargePoint)
+
+        if not weatherSensor.valueIsPower :
+            # e.g. a sunshine duration, which can't be split
+            for chargePoint in solarChargePoints:
+                currents[chargePoint.id] = self.getSensorCurrent(weatherSensor, value, chargePoint)
+            return currents
+
+        solarChargePoints.sort(key=lambda chargePoint: chargePoint.getMaxPowerkW())
+        remaining = value
+        for index, chargePoint in enumerate(solarChargePoints):
+            if index == len(solarChargePoints) - 1 :
+                share = remaining
+            else :
+                share = min(chargePoint.getMaxPowerkW(), remaining / (len(solarChargePoints) - index))
+            remaining = remaining - share
+            currents[chargePoint.id] = self.getSensorCurrent(weatherSensor, share, chargePoint)
+            if len(chargePoints) > 1 :
+                self.logChargePoint(chargePoint, "Power share", powerkW="{:.2f}".format(share))
+        return currents
+
+##################################################################################################
+# The following methods implement the decisions of each state of a charge point. They only use
+# the settings of the wallbox, which are sent with charger.flushSettings(), so they are shared
+# with the asyncio engine. Each method sets chargePoint.new_state and returns the seconds to wait.
+##################################################################################################
 
 ##################################################################################################
 # STATE_INIT
 ##################################################################################################
-            if self.state == ChargePlanState.STATE_INIT :
-                try:
-                    # load configuration from JSON file
-                    with open('config.json') as configFile:
-                        self.config = json.load(configFile)
-
-                    # Initialize Wallbox
-                    charger = Wallbox.goEcharger(self.config["wallbox"]["IP"], self.config["wallbox"]["absolutMaxCurrent"])
-                    
-                    # Uncomment this to use wallbox simulator for developing
-                    #charger = Wallbox.goEchargerSimulation(self.config["wallbox"]["IP"], self.config["wallbox"]["absolutMaxCurrent"])
-
-                    # Initialize Measurement
-                    weatherSensorList = list()
-                    for measurement in self.config["measurements"]:
-                        if measurement["type"] == "Swissmeteo" :
-                            weatherSensorList.append(Measurement.Swissmeteo(measurement["station"], measurement["modes"]))
-                        elif measurement["type"] == "Solarlog" :
-                            weatherSensorList.append(Measurement.SolarLog(measurement["url"], measurement["username"], measurement["password"], measurement["modes"]))
-                        elif measurement["type"] == "Fronius" :
-                            weatherSensorList.append(Measurement.Fronius(measurement["url"], measurement["deviceID"], measurement["modes"]))
-                        elif measurement["type"] == "Smartfox" :
-                            weatherSensorList.append(Measurement.Smartfox(measurement["ip"], measurement["modes"]))
-                        else :
-                            self.printToLogfile("Invalid weatherSensor definition")
-
-                    charger.allowCharging(False)
-                    self.allowCharging = False # internal state
-                    self.new_state = ChargePlanState.STATE_NO_CAR
-                except IOError:
-                    # probably connection error to wallbox, try again
-                    self.printToLogfile("Wallbox IOError")
-                    time.sleep(self.config["timing"]["waitAfterErrorSeconds"])
-                    self.new_state = ChargePlanState.STATE_INIT
+    def initStep(self, chargePoint):
+        # Initialize Wallbox
+        chargePoint.charger = self.createWallbox(chargePoint.wallboxConfig)
+        self.instrumentWallbox(chargePoint)
+        self.guardWallbox(chargePoint)
+        self.subscribeWallbox(chargePoint)
+        if chargePoint.restoredState != None :
+            # Warm restart: the wallbox keeps its settings, the next step reads its status and
+            # continues in the state of the snapshot
+            chargePoint.new_state = chargePoint.restoredState
+            chargePoint.restoredState = None
+            return 0
+        chargePoint.charger.allowCharging(False)
+        chargePoint.allowCharging = False # internal state
+        chargePoint.current = None
+        chargePoint.new_state = ChargePlanState.STATE_NO_CAR
+        return 0
 
 ##################################################################################################
 # STATE_NO_CAR
 ##################################################################################################
-            elif self.state == ChargePlanState.STATE_NO_CAR :
-                try:
-                    charger.readStatus()
-                    self.printToLogfile("Charger state: " + str(charger.state))
-                    if charger.state == Wallbox.WallboxState.STATE_READY_NO_CAR :
-                        self.printToLogfile("Still no car connected, wait.")
-                        time.sleep(self.config["timing"]["waitWithoutCarSeconds"])
-                    elif (charger.state == Wallbox.WallboxState.STATE_WAITING_FOR_CAR) or (charger.state == Wallbox.WallboxState.STATE_CHARGING):
-                        self.printToLogfile("Car connected.")
-                        self._goal = None
-                        self.deadline = None
-                        self.maxEnergy = 0
-                        self.limitToMaxEnergy = False
-                        self.new_state = ChargePlanState.STATE_CHARGING
-                    elif charger.state == Wallbox.WallboxState.STATE_FINISHED_CAR_STILL_CONNECTED :
-                        if self.allowCharging == False :
-                            self.printToLogfile("Car connected but probably not really finished")
-                            self.new_state = ChargePlanState.STATE_CHARGING
-                        else : 
-                            self.printToLogfile("Car connected but already finished")
-                            self.new_state = ChargePlanState.STATE_FINISHED
-                    IOerror_count = 0
-                except IOError:
-                    # probably connection error to wallbox, try again
-                    IOerror_count = IOerror_count + 1
-                    self.printToLogfile("Wallbox IOError: " + str(IOerror_count))
-                    # if error count is too high, re-init everything
-                    if (IOerror_count > self.config["timing"]["connectionMaxRetrys"]) :
-                        self.new_state = ChargePlanState.STATE_INIT
-                    else :
-                        time.sleep(self.config["timing"]["waitAfterErrorSeconds"])
-                        self.new_state = ChargePlanState.STATE_NO_CAR
+    def noCarStep(self, chargePoint):
+        charger = chargePoint.charger
+        self.logChargePoint(chargePoint, "Charger state", wallboxState=charger.state.name)
+        if charger.state == WallboxState.STATE_READY_NO_CAR :
+            self.logChargePoint(chargePoint, "Still no car connected, wait.")
+            return self.getIdleWaitSeconds(chargePoint, self.config.timing.waitWithoutCarSeconds)
+        elif (charger.state == WallboxState.STATE_WAITING_FOR_CAR) or (charger.state == WallboxState.STATE_CHARGING):
+            self.logChargePoint(chargePoint, "Car connected.")
+            chargePoint._goal = None
+            chargePoint.deadline = None
+            chargePoint.plan = None
+            chargePoint.maxEnergy = 0
+            chargePoint.limitToMaxEnergy = False
+            chargePoint.new_state = ChargePlanState.STATE_CHARGING
+        elif charger.state == WallboxState.STATE_FINISHED_CAR_STILL_CONNECTED :
+            if chargePoint.allowCharging == False :
+                self.logChargePoint(chargePoint, "Car connected but probably not really finished")
+                chargePoint.new_state = ChargePlanState.STATE_CHARGING
+            else :
+                self.logChargePoint(chargePoint, "Car connected but already finished")
+                chargePoint.new_state = ChargePlanState.STATE_FINISHED
+        else :
+            # e.g. "car" 0 (unknown) or 5 (error) of the API v2, ask again later instead of at once
+            self.logChargePoint(chargePoint, "Wallbox state undefined, wait.", logging.WARNING)
+            return self.config.timing.waitAfterErrorSeconds
+        return 0
 
 ##################################################################################################
 # STATE_CHARGING
-##################################################################################################                
-            elif self.state == ChargePlanState.STATE_CHARGING :
-                try:
-                    charger.readStatus()
-                    self.printToLogfile("Wallbox state: " + str(charger.state))
-                    self.power = charger.currentPower
-                    self.energy = charger.energy
-
-                    # check state of car and decide on consequences
-                    if charger.state == Wallbox.WallboxState.STATE_READY_NO_CAR :
-                        # car disconnected
-                        self.new_state = ChargePlanState.STATE_FINISHED
-                    elif charger.state == Wallbox.WallboxState.STATE_FINISHED_CAR_STILL_CONNECTED :
-                        if self.allowCharging == True :
-                            # Car says it's finished during charging, so battery is full
-                            self.new_state = ChargePlanState.STATE_FINISHED
-                        else :
-                            # Car says it's finished when charging is not allowed, so battery is NOT full.
-                            self.new_state = ChargePlanState.STATE_CHARGING
-                    else:
-                        self.new_state = ChargePlanState.STATE_CHARGING
-
-                    # take further actions if state should not be left
-                    if self.new_state == ChargePlanState.STATE_CHARGING :
-                        dateObjectNow = datetime.datetime.now()
-
-                        # Get maximum current from weather sensors. If multiple sensors are configured,
-                        # try all of them but stop as soon as one of them returns a valid value
-                        maxAllowedCurrent = None
-                        for weatherSensor in weatherSensorList:
-                            if maxAllowedCurrent == None:
-                                try:
-                                    maxAllowedCurrent = weatherSensor.getMaxAllowedCurrent(self.power, self.mode)
-                                except IOError:
-                                    # probably connection error to sensor
-                                    self.printToLogfile("WeatherSensor IOError: " + str(weatherSensor))
-                        
-                        # Check returned value from weather sensors and react
-                        if maxAllowedCurrent == None:
-                            self.printToLogfile("No weathersensor has returned a value.")
-                            maxAllowedCurrent = 0
-                            time.sleep(self.config["timing"]["waitWithoutSunSeconds"])
-                            self.new_state = ChargePlanState.STATE_CHARGING
-                        else:
-                            # Check if deadline is reached
-                            if self.deadline != None:
-                                if dateObjectNow > self.deadline:
-                                    deadlineReached = True
-                                else:
-                                    deadlineReached = False
-                            else:
-                                deadlineReached = False
-
-                            # Decide on charging depending on deadline and measurements
-                            if deadlineReached:
-                                    # Deadline reached, charge
-                                    charger.allowCharging(True)
-                                    self.allowCharging = True # internal state
-                                    self.printToLogfile("Charge: deadline reached. Power: " + str(self.power))
-                                    charger.setMaxCurrent(self.config["wallbox"]["absolutMaxCurrent"])
-                                    charger.setMaxEnergy(self.limitToMaxEnergy, self.maxEnergy)
-                                    time.sleep(self.config["timing"]["waitChargingSeconds"])
-                                    self.new_state = ChargePlanState.STATE_CHARGING
-                            else :
-                                if maxAllowedCurrent > 0:
-                                    charger.allowCharging(True)
-                                    self.allowCharging = True # internal state
-                                    charger.setMaxCurrent(maxAllowedCurrent)
-                                    charger.setMaxEnergy(self.limitToMaxEnergy, self.maxEnergy)
-                                    self.printToLogfile("Charge: getMaxAllowedCurrent: " + str(maxAllowedCurrent) + " power: " + str(self.power))
-                                    time.sleep(self.config["timing"]["waitChargingSeconds"])
-                                    self.new_state = ChargePlanState.STATE_CHARGING
-                                else:
-                                    charger.allowCharging(False)
-                                    self.allowCharging = False # internal state
-                                    self.printToLogfile("No sun, don't charge, wait.")
-                                    time.sleep(self.config["timing"]["waitWithoutSunSeconds"])
-                                    self.new_state = ChargePlanState.STATE_CHARGING
-                    IOerror_count = 0
-                except IOError:
-                    # probably connection error to wallbox, try again
-                    IOerror_count = IOerror_count + 1
-                    self.printToLogfile("Wallbox IOError: " + str(IOerror_count))
-                    # if error count is too high, re-init everything
-                    if (IOerror_count > self.config["timing"]["connectionMaxRetrys"]) :
-                        self.new_state = ChargePlanState.STATE_INIT
-                    else :
-                        time.sleep(self.config["timing"]["waitAfterErrorSeconds"])
-                        self.new_state = ChargePlanState.STATE_CHARGING
+##################################################################################################
+    def chargingStatusStep(self, chargePoint):
+        # Returns True if the state is not left and the weather sensors must be read
+        charger = chargePoint.charger
+        self.logChargePoint(chargePoint, "Wallbox state", wallboxState=charger.state.name)
+        chargePoint.power = charger.currentPower
+        chargePoint.energy = charger.energy
+        self.recordValue("wallbox" + str(chargePoint.id) + ".power", chargePoint.power)
+        self.recordValue("wallbox" + str(chargePoint.id) + ".energy", chargePoint.energy)
+
+        # check state of car and decide on consequences
+        if charger.state == WallboxState.STATE_READY_NO_CAR :
+            # car disconnected
+            chargePoint.new_state = ChargePlanState.STATE_FINISHED
+        elif charger.state == WallboxState.STATE_FINISHED_CAR_STILL_CONNECTED :
+            if chargePoint.allowCharging == True :
+                # Car says it's finished during charging, so battery is full
+                chargePoint.new_state = ChargePlanState.STATE_FINISHED
+            else :
+                # Car says it's finished when charging is not allowed, so battery is NOT full.
+                chargePoint.new_state = ChargePlanState.STATE_CHARGING
+        else:
+            chargePoint.new_state = ChargePlanState.STATE_CHARGING
+
+        # take further actions if state should not be left
+        if chargePoint.new_state != ChargePlanState.STATE_CHARGING :
+            return False
+        self.updatePlan(chargePoint)
+        return True
+
+    def chargingStep(self, chargePoint, maxAllowedCurrent):
+        charger = chargePoint.charger
+        chargePoint.new_state = ChargePlanState.STATE_CHARGING
+        self.recordValue("wallbox" + str(chargePoint.id) + ".maxAllowedCurrent", maxAllowedCurrent)
+
+        # Check returned value from weather sensors and react
+        if maxAllowedCurrent == None:
+            self.logChargePoint(chargePoint, "No weathersensor has returned a value.", logging.WARNING)
+            return self.config.timing.waitWithoutSunSeconds
+
+        # Decide on charging depending on plan or deadline and measurements
+        gridCurrent = self.getGridCurrent(chargePoint)
+        if gridCurrent > 0:
+            # Deadline reached, charge. More if the sun allows it.
+            self.setAllowCharging(chargePoint, True)
+            self.logChargePoint(chargePoint, "Charge: deadline reached", current=max(gridCurrent, maxAllowedCurrent), power=chargePoint.power)
+            self.setCurrent(chargePoint, max(gridCurrent, maxAllowedCurrent))
+            charger.setMaxEnergy(chargePoint.limitToMaxEnergy, chargePoint.maxEnergy)
+            return self.config.timing.waitChargingSeconds
+
+        # Charging switched by the sun stays on or off for a minimum time
+        dwellSeconds = self.getRemainingDwellSeconds(chargePoint, maxAllowedCurrent > 0)
+        if dwellSeconds > 0 :
+            self.logChargePoint(chargePoint, "Keep charging state, minimum time not reached", allowCharging=chargePoint.allowCharging, remainingSeconds=round(dwellSeconds))
+            return min(dwellSeconds, self.config.timing.waitChargingSeconds)
+        elif maxAllowedCurrent > 0:
+            if self.isFollowingSurplus(chargePoint) :
+                current = self.getRampedCurrent(chargePoint, maxAllowedCurrent)
+                waitSeconds = self.config.control.intervalSeconds
+            else :
+                current = maxAllowedCurrent
+                waitSeconds = self.config.timing.waitChargingSeconds
+            self.setAllowCharging(chargePoint, True)
+            self.setCurrent(chargePoint, current)
+            charger.setMaxEnergy(chargePoint.limitToMaxEnergy, chargePoint.maxEnergy)
+            self.logChargePoint(chargePoint, "Charge", maxAllowedCurrent=maxAllowedCurrent, current=current, power=chargePoint.power)
+            return waitSeconds
+        else:
+            self.setAllowCharging(chargePoint, False)
+            self.logChargePoint(chargePoint, "No sun, don't charge, wait.")
+            return self.config.timing.waitWithoutSunSeconds
+
+    def setAllowCharging(self, chargePoint, allowCharging):
+        if allowCharging != chargePoint.allowCharging :
+            chargePoint.switchedAt = self.clock.monotonic()
+            Metrics.chargingSwitches.inc(wallbox=chargePoint.wallboxConfig.name)
+        chargePoint.charger.allowCharging(allowCharging)
+        chargePoint.allowCharging = allowCharging # internal state
+        if not allowCharging :
+            chargePoint.current = None
+
+    def setCurrent(self, chargePoint, current):
+        if current != chargePoint.current :
+            chargePoint.currentSince = self.clock.monotonic()
+        chargePoint.charger.setMaxCurrent(current)
+        chargePoint.current = current
+
+    def getRampedCurrent(self, chargePoint, targetCurrent):
+        # Surplus following: a higher current is approached by at most rampAmperePerMinute, a
+        # lower one is set at once so the grid isn't used. Increases smaller than deadbandAmpere
+        # are not sent to the wallbox.
+        control = self.config.control
+        if chargePoint.current == None or not chargePoint.allowCharging :
+            # charging starts
+            return targetCurrent
+        if targetCurrent <= chargePoint.current :
+            return targetCurrent
+        elapsedSeconds = self.clock.monotonic() - chargePoint.currentSince
+        current = min(targetCurrent, chargePoint.current + math.floor(control.rampAmperePerMinute * elapsedSeconds / 60))
+        if current - chargePoint.current < control.deadbandAmpere :
+            return chargePoint.current
+        return current
+
+    def getRemainingDwellSeconds(self, chargePoint, allowCharging):
+        # Seconds until allowCharging may be changed, 0 if it's not changed or may be changed now
+        if allowCharging == chargePoint.allowCharging or chargePoint.switchedAt == None :
+            return 0
+        if chargePoint.allowCharging :
+            minimumSeconds = self.config.timing.minChargingOnSeconds
+        else :
+            minimumSeconds = self.config.timing.minChargingOffSeconds
+        return max(0, chargePoint.switchedAt + minimumSeconds - self.clock.monotonic())
 
 ##################################################################################################
 # STATE_FINISHED
-##################################################################################################  
-            elif self.state == ChargePlanState.STATE_FINISHED :
-                try:
-                    charger.readStatus()
-                    charger.setMaxCurrent(self.config["wallbox"]["absolutMaxCurrent"])
-                    self.printToLogfile("Charger state: " + str(charger.state))
-                    if charger.state == Wallbox.WallboxState.STATE_FINISHED_CAR_STILL_CONNECTED :
-                        self.printToLogfile("Charging finished, car still connected")
-                        time.sleep(self.config["timing"]["waitAfterFinishedSeconds"])
-                    elif charger.state == Wallbox.WallboxState.STATE_READY_NO_CAR :
-                        charger.allowCharging(False)
-                        self.allowCharging = False # internal state
-                        self.printToLogfile("Charging finished, car disconnected")
-                        self.new_state = ChargePlanState.STATE_NO_CAR
-                        time.sleep(self.config["timing"]["waitWithoutCarSeconds"])
-                    elif charger.state == Wallbox.WallboxState.STATE_WAITING_FOR_CAR  or charger.state == Wallbox.WallboxState.STATE_CHARGING :
-                        self.printToLogfile("Car starts charging again, probably pre-Heat")
-                        self.new_state = ChargePlanState.STATE_FINISHED
-                        time.sleep(self.config["timing"]["waitAfterFinishedSeconds"])
-                    IOerror_count = 0
-                except IOError:
-                    # probably connection error to wallbox, try again
-                    IOerror_count = IOerror_count + 1
-                    self.printToLogfile("Wallbox IOError: " + str(IOerror_count))
-                    # if error count is too high, re-init everything
-                    if (IOerror_count > self.config["timing"]["connectionMaxRetrys"]) :
-                        self.new_state = ChargePlanState.STATE_INIT
-                    else :
-                        time.sleep(self.config["timing"]["waitAfterErrorSeconds"])
-                        self.new_state = ChargePlanState.STATE_FINISHED
+##################################################################################################
+    def finishedStep(self, chargePoint):
+        charger = chargePoint.charger
+        self.setCurrent(chargePoint, chargePoint.wallboxConfig.absolutMaxCurrent)
+        self.logChargePoint(chargePoint, "Charger state", wallboxState=charger.state.name)
+        if charger.state == WallboxState.STATE_FINISHED_CAR_STILL_CONNECTED :
+            self.logChargePoint(chargePoint, "Charging finished, car still connected")
+            return self.getIdleWaitSeconds(chargePoint, self.config.timing.waitAfterFinishedSeconds)
+        elif charger.state == WallboxState.STATE_READY_NO_CAR :
+            charger.allowCharging(False)
+            chargePoint.allowCharging = False # internal state
+            self.logChargePoint(chargePoint, "Charging finished, car disconnected")
+            chargePoint.new_state = ChargePlanState.STATE_NO_CAR
+            return self.getIdleWaitSeconds(chargePoint, self.config.timing.waitWithoutCarSeconds)
+        elif charger.state == WallboxState.STATE_WAITING_FOR_CAR  or charger.state == WallboxState.STATE_CHARGING :
+            self.logChargePoint(chargePoint, "Car starts charging again, probably pre-Heat")
+            chargePoint.new_state = ChargePlanState.STATE_FINISHED
+            return self.config.timing.waitAfterFinishedSeconds
+        self.logChargePoint(chargePoint, "Wallbox state undefined, wait.", logging.WARNING)
+        return self.config.timing.waitAfterErrorSeconds
 
 ##################################################################################################
-# STATE_ERROR
-##################################################################################################  
-            elif self.state == ChargePlanState.STATE_ERROR :
-                self.printToLogfile("Statemachine stuck in STATE_ERROR")
-                time.sleep(self.config["timing"]["waitAfterErrorSeconds"])
+# STATE_ERROR and undefined states
+##################################################################################################
+    def errorStep(self, chargePoint):
+        if chargePoint.state == ChargePlanState.STATE_ERROR :
+            self.logChargePoint(chargePoint, "Statemachine stuck in STATE_ERROR", logging.ERROR)
+            return self.config.timing.waitAfterErrorSeconds
+        else:
+            self.logChargePoint(chargePoint, "Invalid state", logging.ERROR)
+            return self.config.timing.waitAfterFinishedSeconds
+
+##################################################################################################
+# IOError of the wallbox in any state
+##################################################################################################
+    def getWallboxRetrySeconds(self, chargePoint):
+        # Backoff of the circuit breaker, which grows with the failures in a row
+        if chargePoint.breaker == None :
+            return self.config.timing.waitAfterErrorSeconds
+        return chargePoint.breaker.getRetrySeconds()
+
+    def wallboxUnavailableStep(self, chargePoint):
+        # The circuit breaker has not sent the request, try again after its backoff
+        self.logChargePoint(chargePoint, "Wallbox unavailable, circuit open", logging.DEBUG)
+        chargePoint.new_state = chargePoint.state
+        return self.getWallboxRetrySeconds(chargePoint)
+
+    def wallboxErrorStep(self, chargePoint):
+        if chargePoint.state == ChargePlanState.STATE_INIT :
+            # probably connection error to wallbox, try again
+            self.logChargePoint(chargePoint, "Wallbox IOError", logging.WARNING)
+            chargePoint.new_state = ChargePlanState.STATE_INIT
+            return self.getWallboxRetrySeconds(chargePoint)
+
+        # probably connection error to wallbox, try again
+        chargePoint.IOerror_count = chargePoint.IOerror_count + 1
+        self.logChargePoint(chargePoint, "Wallbox IOError", logging.WARNING, IOerrorCount=chargePoint.IOerror_count)
+        # if error count is too high, re-init the wallbox
+        if (chargePoint.IOerror_count > self.config.timing.connectionMaxRetrys) :
+            chargePoint.new_state = ChargePlanState.STATE_INIT
+            return 0
+        else :
+            chargePoint.new_state = chargePoint.state
+            return self.getWallboxRetrySeconds(chargePoint)
 
 ##################################################################################################
-# Undefined states
+# Scheduling of the charge points
 ##################################################################################################
-            else:
-                self.printToLogfile("Error: Invalid state")
-                time.sleep(self.config["timing"]["waitAfterFinishedSeconds"])
+    def beginIteration(self):
+        # Common start of each iteration, returns the charge points which are due
+        self.processCommands()
+        # newer than the queued commands
+        self.applyDeferredStatus()
+        self.reloadConfig()
+        now = self.clock.monotonic()
+        dueChargePoints = [chargePoint for chargePoint in self.chargePoints.values() if chargePoint.nextRun <= now + SCHEDULE_TOLERANCE_SECONDS]
+        for chargePoint in dueChargePoints:
+            self.logChargePoint(chargePoint, "Iteration", logging.DEBUG)
+            chargePoint.new_state = chargePoint.state
+        return dueChargePoints
+
+    def endStep(self, chargePoint, waitSeconds):
+        now = self.clock.monotonic()
+        if chargePoint.stateSince != None :
+            Metrics.stateSeconds.inc(now - chargePoint.stateSince, wallbox=chargePoint.wallboxConfig.name, state=chargePoint.state.name)
+        chargePoint.stateSince = now
+        chargePoint.state = chargePoint.new_state
+        chargePoint.nextRun = now + waitSeconds
+
+    def getSecondsToNextRun(self):
+        return min(chargePoint.nextRun for chargePoint in self.chargePoints.values()) - self.clock.monotonic()
+
+    def runIteration(self):
+        # One pass of the statemachines of all charge points which are due
+        started = time.perf_counter()
+        chargingChargePoints = list()
+        for chargePoint in self.beginIteration():
+            charger = chargePoint.charger
+            try:
+                if chargePoint.state == ChargePlanState.STATE_INIT :
+                    waitSeconds = self.initStep(chargePoint)
+                    chargePoint.charger.flushSettings()
+                elif chargePoint.state == ChargePlanState.STATE_NO_CAR :
+                    charger.readStatus()
+                    waitSeconds = self.noCarStep(chargePoint)
+                    chargePoint.IOerror_count = 0
+                elif chargePoint.state == ChargePlanState.STATE_CHARGING :
+                    charger.readStatus()
+                    if self.chargingStatusStep(chargePoint) :
+                        # decided below, after one reading of the weather sensors for all wallboxes
+                        chargingChargePoints.append(chargePoint)
+                        continue
+                    waitSeconds = 0
+                    chargePoint.IOerror_count = 0
+                elif chargePoint.state == ChargePlanState.STATE_FINISHED :
+                    charger.readStatus()
+                    waitSeconds = self.finishedStep(chargePoint)
+                    charger.flushSettings()
+                    chargePoint.IOerror_count = 0
+                else :
+                    waitSeconds = self.errorStep(chargePoint)
+            except CircuitBreaker.CircuitOpenError:
+                waitSeconds = self.wallboxUnavailableStep(chargePoint)
+            except IOError:
+                waitSeconds = self.wallboxErrorStep(chargePoint)
+            self.endStep(chargePoint, waitSeconds)
 
-            self.state = self.new_state
+        if len(chargingChargePoints) > 0 :
+            # Get the measurement from weather sensors. If multiple sensors are configured,
+            # all of them are queried in parallel and the first valid value in list order wins
+            reading = self.readWeatherSensors(self.getTotalPower())
+            currents = self.allocateCurrents(reading, chargingChargePoints)
+            for chargePoint in chargingChargePoints:
+                try:
+                    waitSeconds = self.chargingStep(chargePoint, currents[chargePoint.id])
+                    chargePoint.charger.flushSettings()
+                    chargePoint.IOerror_count = 0
+                except CircuitBreaker.CircuitOpenError:
+                    waitSeconds = self.wallboxUnavailableStep(chargePoint)
+                except IOError:
+                    waitSeconds = self.wallboxErrorStep(chargePoint)
+                self.endStep(chargePoint, waitSeconds)
+
+        Metrics.iterationSeconds.observe(time.perf_counter() - started)
+        self.publishStatus()
+        self.saveState()
+        if self.timeSeries != None :
+            self.timeSeries.flushIfDue()
+
+    def start(self):
+
+        self.initialize()
+
+        # main state machine
+        while True:
+            self.runIteration()
+            # Wait for the next iteration, a command from the web application ends the wait immediately
+            self.wait(self.getSecondsToNextRun())
 
 
 #If file is called as script, not used as module
 if __name__ == "__main__":
     cp = ChargePlanEngine()
-    cp.start()
\ No newline at end of file
+    cp.start()
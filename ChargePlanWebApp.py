@@ -9,110 +9,260 @@ import threading
 import ChargePlan
 import datetime
 import json
-from flask import Flask, render_template, request
+import time
+import hashlib
+import TimeSeries
+import Metrics
+import Log
+from flask import Flask, render_template, request, Response
 
 # This enum must correlate to the class ChargePlanState
 GUIstates = ["NULL", "Initialisierung", "Kein Auto", "Auto verbunden", "Fertig", "Fehler"]
 
+# An event stream without new status sends a comment after this time, so proxies keep the connection open
+STREAM_KEEPALIVE_SECONDS = 15
+# Each event stream holds a thread of the server. It is closed after this time and the browser
+# connects again after STREAM_RETRY_MILLISECONDS, so streams of closed pages don't stay forever.
+STREAM_MAX_SECONDS = 300
+STREAM_RETRY_MILLISECONDS = 1000
+
+# Open event streams, at most half of the threads of "web" in config.json, so the pages and
+# /metrics are still served with many open pages
+streamCount = 0
+streamLock = threading.Lock()
+
+log = Log.getLogger("ChargePlanWebApp")
+
 app = Flask(__name__)
 
 cp = ChargePlan.ChargePlanEngine()
 
-# load configuration from JSON file
-with open('config.json') as configFile:
-    config = json.load(configFile)
+def getSelectedChargePoint():
+    # The wallbox is selected with the parameter "wallbox", the first one is the default
+    wallboxID = request.values.get('wallbox', type=int)
+    return cp.getChargePoint(wallboxID)
 
-@app.route("/",  methods=["GET", "POST"])
-def home():
-    global cp
-    # load data and show webpage
-    GUIstate = GUIstates[int(cp.state)]
-    if cp.getGoal() != None :
-        GUIdeadline = cp.deadline.strftime("%d.%m. um %H:%M Uhr")
-        GUIgoal = cp.getGoal().strftime("%d.%m. um %H:%M Uhr")
+# Rendered home page per wallbox, rendered again only when the engine publishes a new status
+# snapshot or the configuration changes: wallbox id -> (status version, config, body, ETag)
+homePageCache = dict()
+
+def getSelectedStatus(status):
+    # Status of the selected wallbox in the snapshot, None before the first snapshot
+    chargePoint = getSelectedChargePoint()
+    if chargePoint == None :
+        return None
+    for chargePointStatus in status.chargePoints:
+        if chargePointStatus.id == chargePoint.id :
+            return chargePointStatus
+    return None
+
+def renderHome(config, chargePointStatus):
+    GUIstate = GUIstates[chargePointStatus.state]
+    if chargePointStatus.goal != None :
+        GUIgoal = datetime.datetime.fromisoformat(chargePointStatus.goal).strftime("%d.%m. um %H:%M Uhr")
     else:
-        GUIdeadline = None
         GUIgoal = None
-    if cp.state == ChargePlan.ChargePlanState.STATE_CHARGING:
-        if cp.allowCharging == True:
+    if chargePointStatus.deadline != None :
+        GUIdeadline = datetime.datetime.fromisoformat(chargePointStatus.deadline).strftime("%d.%m. um %H:%M Uhr")
+    else:
+        GUIdeadline = None
+    if chargePointStatus.state == ChargePlan.ChargePlanState.STATE_CHARGING:
+        if chargePointStatus.allowCharging == True:
             GUIallowCharging = ", freigegeben"
         else:
             GUIallowCharging = ", gesperrt"
     else :
         GUIallowCharging = None
 
-    GUIcar = config["cars"][cp.car - 1]["name"] #-1 to convert from ID to list index
-    GUImode = config["modes"][cp.mode - 1]["name"] #-1 to convert from ID to list index
-    GUIpower = "{:.1f}".format(cp.power)
-    GUIenergy = "{:.1f}".format(cp.energy)
-    GUIlimitToMaxEnergy = cp.limitToMaxEnergy
-    GUImaxenergy = "{:.0f}".format(cp.maxEnergy / config["cars"][0]["batterysizekWh"] * 100)
-    GUImaxenergykwh = "{:.1f}".format(cp.maxEnergy)
-    GUIcar = config["cars"][cp.car - 1]["name"] #-1 to convert from ID to list index
-    return render_template("home.html", state=GUIstate, allowCharging=GUIallowCharging, power=GUIpower, deadline=GUIdeadline, energy=GUIenergy, goal=GUIgoal, limitmaxenergy=GUIlimitToMaxEnergy, maxenergy=GUImaxenergy, maxenergykwh=GUImaxenergykwh, mode=GUImode, car=GUIcar)
+    # After a reload of the configuration, the snapshot can contain a car or mode which is not configured anymore
+    car = config.cars.get(chargePointStatus.car)
+    mode = config.modes.get(chargePointStatus.mode)
+    GUIcar = car.name if car != None else None
+    GUImode = mode.name if mode != None else None
+    GUIpower = "{:.1f}".format(chargePointStatus.power)
+    GUIenergy = "{:.1f}".format(chargePointStatus.energy)
+    GUIlimitToMaxEnergy = chargePointStatus.limitToMaxEnergy
+    GUImaxenergy = "{:.0f}".format(chargePointStatus.maxEnergy / car.batterysizekWh * 100) if car != None else None
+    GUImaxenergykwh = "{:.1f}".format(chargePointStatus.maxEnergy)
+    return render_template("home.html", state=GUIstate, allowCharging=GUIallowCharging, power=GUIpower, deadline=GUIdeadline, energy=GUIenergy, goal=GUIgoal, limitmaxenergy=GUIlimitToMaxEnergy, maxenergy=GUImaxenergy, maxenergykwh=GUImaxenergykwh, mode=GUImode, car=GUIcar,
+                           wallboxList=config.wallboxList, wallboxSelected=chargePointStatus.id)
+
+@app.route("/",  methods=["GET", "POST"])
+def home():
+    global cp
+    config = cp.getConfig()
+    status = cp.getStatus()
+    chargePointStatus = getSelectedStatus(status)
+    if chargePointStatus == None :
+        # Engine not initialized yet
+        return render_template("home.html", state=None, wallboxList=config.wallboxList, wallboxSelected=None)
+    version, cachedConfig, body, etag = homePageCache.get(chargePointStatus.id, (None, None, None, None))
+    if version != status.version or cachedConfig is not config :
+        body = renderHome(config, chargePointStatus)
+        # The same page gets the same ETag, also after a new snapshot which doesn't change it
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        homePageCache[chargePointStatus.id] = (status.version, config, body, etag)
+    response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    # The browser asks each time, an unchanged page is answered with 304 Not Modified
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 @app.route("/settings",  methods=["GET", "POST"])
 def settings():
     global cp
+    config = cp.getConfig()
+    chargePoint = getSelectedChargePoint()
+    if chargePoint == None :
+        # Engine not initialized yet
+        return render_template("settings.html", formPosted=None, wallboxList=config.wallboxList)
+    wallboxID = chargePoint.id
     # if form is submitted   
     if request.method == 'POST':
         # if "Charge now" button is clicked
         if request.form.get('chargeInstantly') != None :
-            cp.setMaxEnergy(False, 0)
-            dateObjectNow = datetime.datetime.now()
-            cp.setNewGoal(dateObjectNow.date().strftime("%d.%m.%Y"), dateObjectNow.time().strftime("%H:%M"))
+            cp.setMaxEnergy(False, 0, wallboxID)
+            dateObjectNow = cp.clock.now()
+            cp.setNewGoal(dateObjectNow.date().strftime("%d.%m.%Y"), dateObjectNow.time().strftime("%H:%M"), wallboxID)
         else :
 
+            # the engine applies the settings asynchronously, so use the selected car directly
+            car = chargePoint.car
             if request.form.get('car') != None :
-                cp.setCar(int(request.form.get('car')))
+                car = int(request.form.get('car'))
+                cp.setCar(car, wallboxID)
 
             try:
                 limit = float(request.form.get('limit'))
-                limit = limit * config["cars"][cp.car - 1]["batterysizekWh"] / 100
+                limit = limit * config.cars[car].batterysizekWh / 100
                 limit = round(limit, 1)
-            except ValueError:
+            except (ValueError, KeyError):
                 limit = 0
 
             # translate from "on" to "True"
             if request.form.get('use_limit') == "on" :
-                cp.setMaxEnergy(True, limit)
+                cp.setMaxEnergy(True, limit, wallboxID)
             else :
-                cp.setMaxEnergy(False, limit)
+                cp.setMaxEnergy(False, limit, wallboxID)
 
             if request.form.get('use_goal') == None :
-                cp.setNewGoal(None, None)
+                cp.setNewGoal(None, None, wallboxID)
             else :
-                cp.setNewGoal(request.form.get('goal_date'), request.form.get('goal_time'))
+                cp.setNewGoal(request.form.get('goal_date'), request.form.get('goal_time'), wallboxID)
 
             if request.form.get('mode') != None :
-                cp.setMode(int(request.form.get('mode')))
+                cp.setMode(int(request.form.get('mode')), wallboxID)
 
-            cp.activateSettings()
+            cp.activateSettings(wallboxID)
 
             
-        return render_template("settings.html", formPosted=True)
+        return render_template("settings.html", formPosted=True, wallboxSelected=wallboxID)
     else : #Form not posted
-        GUIModeList = config["modes"]
+        GUIModeList = config.modeList
         GUINumberOfModes = len(GUIModeList)
-        GUImodeSelected = cp.mode
-        GUICarList = config["cars"]
+        GUImodeSelected = chargePoint.mode
+        GUICarList = config.carList
         GUINumberOfCars = len(GUICarList)
-        GUICarSelected = cp.car
-        return render_template("settings.html", formPosted=None, modeList=GUIModeList, numberOfModes=GUINumberOfModes, modeSelected=GUImodeSelected, carList=GUICarList, numberOfCars=GUINumberOfCars, carSelected=GUICarSelected)
+        GUICarSelected = chargePoint.car
+        return render_template("settings.html", formPosted=None, modeList=GUIModeList, numberOfModes=GUINumberOfModes, modeSelected=GUImodeSelected, carList=GUICarList, numberOfCars=GUINumberOfCars, carSelected=GUICarSelected,
+                               wallboxList=config.wallboxList, wallboxSelected=wallboxID)
+
+# JSON of the last status snapshot, serialized only once per version for all clients
+statusJSONCache = (None, None)
+
+def getStatusJSON(status):
+    global statusJSONCache
+    version, body = statusJSONCache
+    if version != status.version :
+        chargePoints = list()
+        for chargePointStatus in status.chargePoints:
+            chargePoint = chargePointStatus._asdict()
+            chargePoint["stateText"] = GUIstates[chargePointStatus.state]
+            chargePoints.append(chargePoint)
+        body = json.dumps({"version": status.version, "timestamp": status.timestamp, "chargePoints": chargePoints})
+        statusJSONCache = (status.version, body)
+    return body
+
+@app.route("/api/status")
+def statusAPI():
+    global cp
+    return Response(getStatusJSON(cp.getStatus()), mimetype="application/json")
+
+def streamClosed():
+    global streamCount
+    with streamLock:
+        streamCount = streamCount - 1
+
+@app.route("/api/status/stream")
+def statusStream():
+    global cp, streamCount
+    with streamLock:
+        if streamCount >= max(1, cp.getConfig().web.threads // 2) :
+            return Response("Too many status streams", status=503, mimetype="text/plain", headers={"Retry-After": "30"})
+        streamCount = streamCount + 1
+    # Server-Sent Events: a message is only sent when the engine publishes a new snapshot
+    def events():
+        yield "retry: " + str(STREAM_RETRY_MILLISECONDS) + "\n\n"
+        version = None
+        endTime = time.monotonic() + STREAM_MAX_SECONDS
+        while time.monotonic() < endTime :
+            status = cp.waitForStatus(version, min(STREAM_KEEPALIVE_SECONDS, max(0, endTime - time.monotonic())))
+            if status.version == version :
+                yield ": keepalive\n\n"
+            else :
+                version = status.version
+                yield "id: " + str(version) + "\ndata: " + getStatusJSON(status) + "\n\n"
+    response = Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    # also called if the client has gone before the first event
+    response.call_on_close(streamClosed)
+    return response
+
+@app.route("/api/history")
+def historyAPI():
+    global cp
+    if cp.timeSeries == None :
+        return Response(json.dumps({"error": "not initialized"}), status=503, mimetype="application/json")
+    # Without "series" the names of all series are returned
+    name = request.args.get('series')
+    if name == None :
+        return Response(json.dumps({"series": cp.timeSeries.getSeriesNames()}), mimetype="application/json")
+    # start and end as unix time, default is the last 24 hours
+    end = request.args.get('end', default=time.time(), type=float)
+    start = request.args.get('start', default=end - 24 * 3600, type=float)
+    buckets = request.args.get('buckets', default=200, type=int)
+    try:
+        result = cp.timeSeries.query(name, start, end, min(buckets, 5000))
+    except TimeSeries.TimeSeriesError as error:
+        return Response(json.dumps({"error": str(error)}), status=400, mimetype="application/json")
+    return Response(json.dumps({"series": name, "start": start, "end": end, "columns": ["time", "min", "max", "mean", "count"], "buckets": result}), mimetype="application/json")
+
+@app.route("/metrics")
+def metrics():
+    # Prometheus text format
+    return Response(Metrics.registry.render(), mimetype="text/plain; version=0.0.4")
 
 class ChargePlanThread(threading.Thread):
     def run(self):
         global cp
         cp.start()
 
+def serve(web):
+    # Serve in the main thread, with "web" of config.json
+    if web.server == "waitress" :
+        try:
+            import waitress
+        except ImportError:
+            log.warning("waitress not installed, using the development server of Flask")
+        else :
+            # Each open /api/status/stream holds one thread. With the lookahead waitress notices a
+            # closed page during the stream, and its thread is free at the next keepalive.
+            waitress.serve(app, host=web.host, port=web.port, threads=web.threads, ident="ChargePlan", channel_request_lookahead=1)
+            return
+    # Flask must run in main thread to support debug mode and reloader
+    app.run(host=web.host, port=web.port, debug=False, threaded=True)
+
 if __name__ == "__main__":
+    web = cp.getConfig().web
     t = ChargePlanThread()
     t.start()
-
-    # Flask must run in main thread to support debug mode and reloader
-
-    #use for application in network. ##TODO make IP adress configurable
-    app.run(host='192.168.178.23', debug=False)
-
-    #use for local debugging
-    #app.run(debug=False)
\ No newline at end of file
+    serve(web)
\ No newline at end of file
@@ -0,0 +1,130 @@
+######################################################################################
+# CircuitBreaker.py
+# One circuit breaker per wallbox and weather sensor. After failureThreshold failures
+# in a row the circuit opens: calls fail immediately with CircuitOpenError instead of
+# waiting for the device. After an exponential backoff with jitter one call is let
+# through (half-open). If it succeeds the circuit closes again, otherwise the backoff
+# is doubled.
+######################################################################################
+
+import random
+import asyncio
+import threading
+import functools
+
+import Log
+import Metrics
+
+log = Log.getLogger("CircuitBreaker")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(IOError):
+    # A subclass of IOError, so the callers handle it like a failed request
+    pass
+
+
+######################################################################################
+# Class CircuitBreaker
+######################################################################################
+class CircuitBreaker:
+
+    def __init__(self, name, clock, failureThreshold=3, backoffSeconds=10, maxBackoffSeconds=600, jitter=0.2, seed=None):
+        self.name = name
+        self.clock = clock # monotonic() is used
+        self.failureThreshold = failureThreshold
+        self.backoffSeconds = backoffSeconds
+        self.maxBackoffSeconds = maxBackoffSeconds
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.state = CLOSED
+        self.failures = 0 # failures in a row
+        self.retryAt = None # clock.monotonic() of the next attempt after a failure
+        self.probing = False # a half-open call is running
+        self.lock = threading.Lock()
+
+    def getBackoffSeconds(self):
+        # Doubled with each failure in a row, +-jitter so several devices don't retry at the same time
+        backoff = min(self.maxBackoffSeconds, self.backoffSeconds * 2 ** (self.failures - 1))
+        return backoff * (1 + self.jitter * (2 * self.random.random() - 1))
+
+    def allowRequest(self):
+        with self.lock:
+            if self.state == CLOSED :
+                return True
+            if self.probing or self.clock.monotonic() < self.retryAt :
+                return False
+            self.state = HALF_OPEN
+            self.probing = True
+            return True
+
+    def recordSuccess(self):
+        with self.lock:
+            if self.state != CLOSED :
+                log.info("Circuit closed", extra=Log.fields(device=self.name, failures=self.failures))
+            self.state = CLOSED
+            self.failures = 0
+            self.retryAt = None
+            self.probing = False
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures = self.failures + 1
+            self.retryAt = self.clock.monotonic() + self.getBackoffSeconds()
+            self.probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failureThreshold) :
+                if self.state == CLOSED :
+                    Metrics.circuitOpened.inc(device=self.name)
+                    log.warning("Circuit open", extra=Log.fields(device=self.name, failures=self.failures, retrySeconds=round(self.retryAt - self.clock.monotonic())))
+                self.state = OPEN
+
+    def recordCancelled(self):
+        # A cancelled call is no failure, but another call may probe now
+        with self.lock:
+            self.probing = False
+
+    def getRetrySeconds(self):
+        # Seconds until the device should be tried again, 0 if it can be used now
+        with self.lock:
+            if self.retryAt == None :
+                return 0
+            return max(0, self.retryAt - self.clock.monotonic())
+
+
+def guard(driver, operation, breaker):
+    # Replace the method driver.<operation> of this instance by one which goes through the
+    # breaker. Coroutines stay coroutines.
+    method = getattr(driver, operation)
+
+    if asyncio.iscoroutinefunction(method) :
+        @functools.wraps(method)
+        async def guarded(*arguments, **keywords):
+            if not breaker.allowRequest() :
+                raise CircuitOpenError(breaker.name)
+            try:
+                result = await method(*arguments, **keywords)
+            except asyncio.CancelledError:
+                breaker.recordCancelled()
+                raise
+            except Exception:
+                breaker.recordFailure()
+                raise
+            breaker.recordSuccess()
+            return result
+    else :
+        @functools.wraps(method)
+        def guarded(*arguments, **keywords):
+            if not breaker.allowRequest() :
+                raise CircuitOpenError(breaker.name)
+            try:
+                result = method(*arguments, **keywords)
+            except Exception:
+                breaker.recordFailure()
+                raise
+            breaker.recordSuccess()
+            return result
+
+    setattr(driver, operation, guarded)
@@ -0,0 +1,255 @@
+######################################################################################
+# Config.py
+# Compiled configuration of ChargePlan. The JSON file is validated once and converted
+# into immutable, id-indexed structures, so the control loop doesn't have to search
+# or sort anything. ConfigFile reloads the file when it has been changed.
+######################################################################################
+
+import os
+import json
+import threading
+from bisect import bisect_right
+from collections import namedtuple
+from types import MappingProxyType
+
+import Log
+
+log = Log.getLogger("Config")
+
+
+class ConfigError(ValueError):
+    pass
+
+
+# control "surplus" follows the measured power continuously instead of the thresholds, see Control
+Mode = namedtuple("Mode", ["id", "name", "control"], defaults=["thresholds"])
+# minCurrent: lowest current the car charges with
+Car = namedtuple("Car", ["id", "name", "batterysizekWh", "deadlineHours", "minCurrent"], defaults=[6])
+# phases and voltage are used to convert between charging power and current. mqttTopic: topic under
+# which the wallbox publishes its status, e.g. "go-eCharger/123456", None if it's only polled.
+WallboxConfig = namedtuple("WallboxConfig", ["id", "name", "IP", "type", "absolutMaxCurrent", "phases", "voltage", "mqttTopic"], defaults=[None])
+# settings contains the keys of the measurement for the sensor, e.g. "ip" or "url". While charging,
+# the thresholds are lowered by hysteresis (in their unit). sampleSeconds: interval of the Sampler,
+# None for the default of "sampling".
+MeasurementConfig = namedtuple("MeasurementConfig", ["type", "settings", "modes", "hysteresis", "sampleSeconds"])
+# Charging switched on (off) by the sun stays on (off) at least minChargingOnSeconds (minChargingOffSeconds)
+Timing = namedtuple("Timing", ["connectionMaxRetrys", "waitAfterFinishedSeconds", "waitWithoutCarSeconds", "waitAfterErrorSeconds",
+                               "waitWithoutSunSeconds", "waitChargingSeconds", "sensorDeadlineSeconds", "minChargingOnSeconds", "minChargingOffSeconds"],
+                    defaults=[6, 0, 0])
+# Time series of the measured values, see TimeSeries.py
+History = namedtuple("History", ["directory", "retentionDays", "flushSeconds"], defaults=["history", 90, 60])
+# Arguments of Log.setupLogging(), file None means no logfile
+Logging = namedtuple("Logging", ["level", "file", "maxBytes", "backupCount", "repeatSeconds", "console"], defaults=["INFO", None, 1000000, 5, 600, True])
+# Charge schedule for a goal, see Planner.py. Without NumPy or if not enabled (default), charging
+# from the grid starts deadlineHours of the car before the goal.
+Planning = namedtuple("Planning", ["enabled", "slotMinutes", "horizonDays", "historyDays", "forecastFactor", "reserveMinutes"], defaults=[False, 15, 3, 7, 0.8, 30])
+# Background reading of the weather sensors, see Sampler.py. filter is "median" or "ewma".
+Sampling = namedtuple("Sampling", ["enabled", "intervalSeconds", "windowSamples", "filter", "timeConstantSeconds", "maxAgeSeconds"], defaults=[False, 15, 20, "median", 60, 120])
+# Circuit breaker of each wallbox and sensor, see CircuitBreaker.py
+CircuitBreakerConfig = namedtuple("CircuitBreakerConfig", ["failureThreshold", "backoffSeconds", "maxBackoffSeconds", "jitter"], defaults=[3, 10, 600, 0.2])
+# Surplus following of the modes with control "surplus": the current is raised by at most
+# rampAmperePerMinute, increases smaller than deadbandAmpere are not sent, and the wallbox is
+# checked every intervalSeconds while charging
+Control = namedtuple("Control", ["rampAmperePerMinute", "deadbandAmpere", "intervalSeconds"], defaults=[2, 2, 30])
+# Broker of the push ingestion, see MQTT.py. Without host everything is polled. While a wallbox
+# publishes its status, it's polled only every livenessSeconds when no car is connected or the
+# car is full.
+Mqtt = namedtuple("Mqtt", ["host", "port", "username", "password", "keepaliveSeconds", "clientID", "livenessSeconds"],
+                  defaults=[None, 1883, None, None, 60, "chargeplan", 1800])
+# Snapshot of the settings and states for a warm restart, see StateFile.py. file None: no snapshot.
+State = namedtuple("State", ["file"], defaults=["state.json"])
+# Web server of ChargePlanWebApp: "waitress" (needs waitress) or "flask" (development server).
+# Read only at start.
+Web = namedtuple("Web", ["host", "port", "server", "threads"], defaults=["127.0.0.1", 5000, "waitress", 16])
+Config = namedtuple("Config", ["modes", "modeList", "cars", "carList", "measurements", "wallboxes", "wallboxList", "timing", "history", "logging", "planning", "sampling",
+                               "circuitBreaker", "control", "mqtt", "state", "web"])
+
+# Values of "control" of a mode
+CONTROLS = ("thresholds", "surplus")
+
+# Keys of a threshold which can be compared with the value of a measurement
+THRESHOLD_KEYS = ("minPowerProductionKW", "minSunshineDuration")
+
+
+######################################################################################
+# Class ThresholdTable
+#
+# Maps a measured value (power or sunshine duration) to the allowed charging current.
+# The limits are sorted once, the lookup is a binary search.
+######################################################################################
+class ThresholdTable:
+
+    __slots__ = ("limits", "currents")
+
+    def __init__(self, thresholds):
+        entries = list()
+        for threshold in thresholds:
+            keys = [key for key in THRESHOLD_KEYS if key in threshold]
+            if len(keys) != 1 or "chargeCurrentAmpere" not in threshold:
+                raise ConfigError("Invalid threshold: " + str(threshold))
+            entries.append((float(threshold[keys[0]]), threshold["chargeCurrentAmpere"]))
+        # If two thresholds have the same limit, the first one wins as before. Sorting the
+        # reversed list keeps it behind the other one, where the binary search finds it.
+        entries = sorted(reversed(entries), key=lambda entry: entry[0])
+        self.limits = tuple(entry[0] for entry in entries)
+        self.currents = tuple(entry[1] for entry in entries)
+
+    def getCurrent(self, value):
+        # Highest threshold which is reached, or 0 if no threshold is reached
+        index = bisect_right(self.limits, value)
+        if index == 0:
+            return 0
+        return self.currents[index - 1]
+
+
+def indexByID(entries, name, factory):
+    index = dict()
+    for entry in entries:
+        try:
+            item = factory(entry)
+        except (KeyError, TypeError, ValueError) as error:
+            raise ConfigError("Invalid " + name + " definition: " + str(error))
+        if item.id in index:
+            raise ConfigError("Duplicate " + name + " id: " + str(item.id))
+        index[item.id] = item
+    return MappingProxyType(index)
+
+
+def compileMode(mode):
+    control = mode.get("control", "thresholds")
+    if control not in CONTROLS:
+        raise ValueError("unknown control " + str(control))
+    return Mode(mode["id"], mode["name"], control)
+
+
+def compileMeasurement(measurement):
+    try:
+        measurementType = measurement["type"]
+        modes = dict()
+        for mode in measurement["modes"]:
+            if mode["id"] in modes:
+                raise ConfigError("Duplicate mode id " + str(mode["id"]) + " in measurement " + str(measurementType))
+            modes[mode["id"]] = ThresholdTable(mode["thresholds"])
+    except KeyError as error:
+        raise ConfigError("Invalid measurement definition, missing " + str(error))
+    settings = {key: value for key, value in measurement.items() if key not in ("type", "modes", "hysteresis", "sampleSeconds")}
+    return MeasurementConfig(measurementType, MappingProxyType(settings), MappingProxyType(modes), measurement.get("hysteresis", 0), measurement.get("sampleSeconds"))
+
+
+def compileWallbox(wallbox):
+    return WallboxConfig(wallbox.get("id", 1), wallbox.get("name", "Wallbox " + str(wallbox.get("id", 1))), wallbox["IP"], wallbox.get("type", "goEcharger"),
+                         wallbox["absolutMaxCurrent"], wallbox.get("phases", 3), wallbox.get("voltage", 230), wallbox.get("mqttTopic"))
+
+
+def compileConfig(rawConfig):
+    try:
+        modes = indexByID(rawConfig["modes"], "mode", compileMode)
+        cars = indexByID(rawConfig["cars"], "car", lambda car: Car(car["id"], car["name"], car["batterysizekWh"], car["deadlineHours"], car.get("minCurrent", 6)))
+        measurements = tuple(compileMeasurement(measurement) for measurement in rawConfig["measurements"])
+        # "wallboxes" is a list of several wallboxes, "wallbox" a single one
+        if "wallboxes" in rawConfig:
+            wallboxes = indexByID(rawConfig["wallboxes"], "wallbox", compileWallbox)
+        else:
+            wallboxes = indexByID([rawConfig["wallbox"]], "wallbox", compileWallbox)
+        timing = Timing(**rawConfig["timing"])
+    except KeyError as error:
+        raise ConfigError("Missing configuration entry " + str(error))
+    except TypeError as error:
+        raise ConfigError("Invalid timing definition: " + str(error))
+    try:
+        history = History(**rawConfig.get("history", dict()))
+    except TypeError as error:
+        raise ConfigError("Invalid history definition: " + str(error))
+    try:
+        loggingConfig = Logging(**rawConfig.get("logging", dict()))
+    except TypeError as error:
+        raise ConfigError("Invalid logging definition: " + str(error))
+    try:
+        planning = Planning(**rawConfig.get("planning", dict()))
+    except TypeError as error:
+        raise ConfigError("Invalid planning definition: " + str(error))
+    try:
+        sampling = Sampling(**rawConfig.get("sampling", dict()))
+    except TypeError as error:
+        raise ConfigError("Invalid sampling definition: " + str(error))
+    if sampling.filter not in ("median", "ewma"):
+        raise ConfigError("Invalid sampling filter: " + str(sampling.filter))
+    try:
+        circuitBreaker = CircuitBreakerConfig(**rawConfig.get("circuitBreaker", dict()))
+    except TypeError as error:
+        raise ConfigError("Invalid circuitBreaker definition: " + str(error))
+    try:
+        control = Control(**rawConfig.get("control", dict()))
+    except TypeError as error:
+        raise ConfigError("Invalid control definition: " + str(error))
+    try:
+        mqttConfig = Mqtt(**rawConfig.get("mqtt", dict()))
+    except TypeError as error:
+        raise ConfigError("Invalid mqtt definition: " + str(error))
+    try:
+        state = State(**rawConfig.get("state", dict()))
+    except TypeError as error:
+        raise ConfigError("Invalid state definition: " + str(error))
+    try:
+        web = Web(**rawConfig.get("web", dict()))
+    except TypeError as error:
+        raise ConfigError("Invalid web definition: " + str(error))
+    if web.server not in ("waitress", "flask"):
+        raise ConfigError("Invalid web server: " + str(web.server))
+
+    if len(modes) == 0:
+        raise ConfigError("At least one mode must be configured")
+    if len(cars) == 0:
+        raise ConfigError("At least one car must be configured")
+    if len(wallboxes) == 0:
+        raise ConfigError("At least one wallbox must be configured")
+
+    return Config(modes, tuple(modes.values()), cars, tuple(cars.values()), measurements, wallboxes, tuple(wallboxes.values()), timing, history, loggingConfig, planning, sampling, circuitBreaker, control, mqttConfig, state, web)
+
+
+######################################################################################
+# Class ConfigFile
+#
+# Holds the compiled configuration of a JSON file. get() checks the modification time
+# and compiles the file again if it has changed. If the changed file is invalid, the
+# previous configuration is kept.
+######################################################################################
+class ConfigFile:
+
+    def __init__(self, path):
+        self.path = path
+        self.config = None
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        # (Re-)load the file, raises ConfigError or IOError if it's not valid
+        with self.lock:
+            mtime = os.stat(self.path).st_mtime_ns
+            self.config = self.compile()
+            self.mtime = mtime
+            return self.config
+
+    def get(self):
+        with self.lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = self.mtime
+            if self.config == None or mtime != self.mtime:
+                try:
+                    self.config = self.compile()
+                except (ConfigError, IOError) as error:
+                    if self.config == None:
+                        raise
+                    log.warning("Invalid configuration, changes ignored", extra=Log.fields(file=self.path, error=error))
+                self.mtime = mtime
+            return self.config
+
+    def compile(self):
+        try:
+            with open(self.path) as configFile:
+                rawConfig = json.load(configFile)
+        except json.decoder.JSONDecodeError as error:
+            raise ConfigError("Invalid JSON: " + str(error))
+        return compileConfig(rawConfig)
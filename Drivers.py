@@ -0,0 +1,126 @@
+######################################################################################
+# Drivers.py
+# Registry of the wallbox and measurement classes by their "type" in config.json. A
+# driver is registered as "module:Class" and its module is imported only when the
+# configuration uses it, so e.g. requests or umodbus are not loaded at start. Drivers
+# of other packages are found through the entry point groups below, e.g. in their
+# pyproject.toml:
+#
+# [project.entry-points."chargeplan.weathersensors"]
+# MyInverter = "myinverter:MyInverter"
+######################################################################################
+
+import importlib
+import threading
+from enum import IntEnum
+from importlib import metadata
+
+import Log
+
+log = Log.getLogger("Drivers")
+
+
+# State of wallbox, PWM signalisation according to type2 definition. Defined here instead of
+# Wallbox.py, so the engine doesn't have to import a driver to know the states.
+class WallboxState(IntEnum):
+        STATE_UNDEFINED = 0
+        STATE_READY_NO_CAR = 1
+        STATE_CHARGING = 2
+        STATE_WAITING_FOR_CAR = 3
+        STATE_FINISHED_CAR_STILL_CONNECTED = 4
+
+
+def findEntryPoints(group):
+    entryPoints = metadata.entry_points()
+    if hasattr(entryPoints, "select") :
+        return entryPoints.select(group=group)
+    # Python < 3.10
+    return entryPoints.get(group, ())
+
+
+def loadDriver(driver):
+    # driver is "module:Class", an entry point or already the class
+    if isinstance(driver, str) :
+        moduleName, separator, className = driver.partition(":")
+        return getattr(importlib.import_module(moduleName), className)
+    if isinstance(driver, metadata.EntryPoint) :
+        return driver.load()
+    return driver
+
+
+######################################################################################
+# Class DriverRegistry
+#
+# Driver classes of one kind by type. The installed packages are searched for entry
+# points only when a type is not built in, and the built-in types can't be replaced
+# by installing a package.
+######################################################################################
+class DriverRegistry:
+
+    def __init__(self, entryPointGroup, drivers):
+        self.entryPointGroup = entryPointGroup
+        self.drivers = dict(drivers) # type -> "module:Class", entry point or class
+        self.entryPointsLoaded = False
+        self.lock = threading.Lock()
+
+    def register(self, driverType, driver):
+        with self.lock:
+            self.drivers[driverType] = driver
+
+    def loadEntryPoints(self):
+        if self.entryPointsLoaded :
+            return
+        self.entryPointsLoaded = True
+        for entryPoint in findEntryPoints(self.entryPointGroup):
+            self.drivers.setdefault(entryPoint.name, entryPoint)
+
+    def getTypes(self):
+        with self.lock:
+            self.loadEntryPoints()
+            return sorted(self.drivers)
+
+    def get(self, driverType):
+        # The class of the type, None if the type is unknown or its module can't be imported
+        with self.lock:
+            if driverType not in self.drivers :
+                self.loadEntryPoints()
+            driver = self.drivers.get(driverType)
+            if driver == None :
+                return None
+            try:
+                driverClass = loadDriver(driver)
+            except (ImportError, AttributeError) as error:
+                log.error("Driver can't be loaded", extra=Log.fields(type=driverType, group=self.entryPointGroup, error=error))
+                return None
+            self.drivers[driverType] = driverClass
+            return driverClass
+
+
+weatherSensors = DriverRegistry("chargeplan.weathersensors", {
+    "Swissmeteo": "Measurement:Swissmeteo",
+    "Solarlog": "Measurement:SolarLog",
+    "Fronius": "Measurement:Fronius",
+    "Smartfox": "Smartfox:Smartfox",
+    "Mqtt": "MQTT:MqttSensor",
+})
+
+wallboxes = DriverRegistry("chargeplan.wallboxes", {
+    "goEcharger": "Wallbox:goEcharger",
+    "goEchargerV2": "Wallbox:goEchargerV2",
+    "goEchargerSimulation": "Wallbox:goEchargerSimulation",
+})
+
+# asyncio variants, used by AsyncChargePlan
+asyncWeatherSensors = DriverRegistry("chargeplan.weathersensors.async", {
+    "Swissmeteo": "AsyncMeasurement:SwissmeteoAsync",
+    "Solarlog": "AsyncMeasurement:SolarLogAsync",
+    "Fronius": "AsyncMeasurement:FroniusAsync",
+    "Smartfox": "AsyncSmartfox:SmartfoxAsync",
+    "Mqtt": "MQTT:MqttSensorAsync",
+})
+
+asyncWallboxes = DriverRegistry("chargeplan.wallboxes.async", {
+    "goEcharger": "AsyncWallbox:goEchargerAsync",
+    "goEchargerV2": "AsyncWallbox:goEchargerV2Async",
+    "goEchargerSimulation": "AsyncWallbox:goEchargerSimulationAsync",
+})
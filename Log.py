@@ -0,0 +1,140 @@
+######################################################################################
+# Log.py
+# Logging of ChargePlan. Records are passed through a queue to a background thread,
+# which writes them to the console and a rotating logfile, so slow output never blocks
+# the statemachine. Additional key-values (e.g. wallbox, state, sensor) are given with
+# extra=Log.fields(...). Identical messages are suppressed for repeatSeconds and then
+# written once with the number of repetitions.
+######################################################################################
+
+import sys
+import atexit
+import queue
+import threading
+import time
+import logging
+import logging.handlers
+
+ROOT_LOGGER_NAME = "ChargePlan"
+
+
+def getLogger(name=None):
+    if name == None :
+        return logging.getLogger(ROOT_LOGGER_NAME)
+    return logging.getLogger(ROOT_LOGGER_NAME + "." + name)
+
+
+def fields(**values):
+    # Use as extra=Log.fields(wallbox="Garage", state="STATE_CHARGING")
+    return {"fields": values}
+
+
+######################################################################################
+# Class KeyValueFormatter
+#
+# time level logger: message key=value key=value ...
+######################################################################################
+class KeyValueFormatter(logging.Formatter):
+
+    def __init__(self):
+        super().__init__("%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s", "%Y-%m-%dT%H:%M:%S")
+
+    def format(self, record):
+        line = super().format(record)
+        for key, value in getattr(record, "fields", dict()).items():
+            value = str(value)
+            if value == "" or " " in value or "=" in value :
+                value = '"' + value.replace('"', '\\"') + '"'
+            line = line + " " + key + "=" + value
+        return line
+
+
+######################################################################################
+# Class RepeatFilter
+#
+# Lets the first of identical records (same logger, level, message and fields) pass and
+# counts the others. The next identical record after repeatSeconds passes again, with
+# the number of suppressed records.
+######################################################################################
+class RepeatFilter(logging.Filter):
+
+    # Above this number of entries, the ones older than repeatSeconds are removed
+    MAX_ENTRIES = 1000
+
+    def __init__(self, repeatSeconds):
+        super().__init__()
+        self.repeatSeconds = repeatSeconds
+        self.seen = dict() # key -> [time of the last record which passed, number of suppressed records]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.repeatSeconds <= 0 :
+            return True
+        key = (record.name, record.levelno, record.getMessage(), tuple(sorted(getattr(record, "fields", dict()).items())))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry != None and now - entry[0] < self.repeatSeconds :
+                entry[1] = entry[1] + 1
+                return False
+            if entry != None and entry[1] > 0 :
+                record.fields = dict(getattr(record, "fields", dict()), repeated=entry[1])
+            self.seen[key] = [now, 0]
+            if len(self.seen) > self.MAX_ENTRIES :
+                self.seen = {key: entry for key, entry in self.seen.items() if now - entry[0] < self.repeatSeconds}
+        return True
+
+
+######################################################################################
+# Setup
+######################################################################################
+
+# Background thread which writes the records, see setupLogging()
+listener = None
+listenerLock = threading.Lock()
+
+
+def setupLogging(level="INFO", logfile=None, maxBytes=1000000, backupCount=5, repeatSeconds=600, console=True):
+    # Can be called again to change the configuration, e.g. after reading config.json
+    global listener
+    with listenerLock:
+        handlers = list()
+        if console :
+            handlers.append(logging.StreamHandler(sys.stdout))
+        if logfile != None :
+            handlers.append(logging.handlers.RotatingFileHandler(logfile, maxBytes=maxBytes, backupCount=backupCount))
+        formatter = KeyValueFormatter()
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        queueHandler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        queueHandler.addFilter(RepeatFilter(repeatSeconds))
+
+        logger = getLogger()
+        if listener != None :
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        logger.addHandler(queueHandler)
+        logger.setLevel(level)
+        logger.propagate = False
+        listener = logging.handlers.QueueListener(queueHandler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+
+
+def stopLogging():
+    # Write all queued records, e.g. before the program ends
+    global listener
+    with listenerLock:
+        if listener != None :
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+            listener = None
+
+
+# Records still in the queue are written when the program ends
+atexit.register(stopLogging)
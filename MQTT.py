@@ -0,0 +1,231 @@
+######################################################################################
+# MQTT.py
+# Optional push ingestion: the go-eCharger and meters publish their values on an MQTT
+# broker, so the engine learns about a plugged in car without polling. Needs paho-mqtt.
+#
+# MqttConnection: one connection to the broker, shared by all subscriptions
+# WallboxSubscription: car state and power published by a go-eCharger
+# MqttSensor: measurement with the last value published on a topic
+######################################################################################
+
+import json
+import time
+import threading
+
+import paho.mqtt.client as mqtt
+
+import Measurement
+import Log
+from Drivers import WallboxState
+
+log = Log.getLogger("MQTT")
+
+# Connection of the engine, set by ChargePlanEngine.createMqtt(). None without "mqtt" in config.json.
+connection = None
+
+
+######################################################################################
+# Class MqttConnection
+#
+# Connects in the background and subscribes all topics again after a reconnect. The
+# callbacks are called by the network thread of paho with (topic, payload as bytes).
+######################################################################################
+class MqttConnection:
+
+    def __init__(self, host, port=1883, username=None, password=None, keepaliveSeconds=60, clientID="chargeplan"):
+        self.host = host
+        self.port = port
+        self.keepaliveSeconds = keepaliveSeconds
+        self.subscriptions = dict() # topic filter -> list of callbacks
+        self.connected = False
+        self.lock = threading.Lock()
+        if hasattr(mqtt, "CallbackAPIVersion") :
+            # paho-mqtt 2
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=clientID)
+        else :
+            self.client = mqtt.Client(client_id=clientID)
+        if username != None :
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = self.onConnect
+        self.client.on_disconnect = self.onDisconnect
+        self.client.on_message = self.onMessage
+
+    def start(self):
+        self.client.connect_async(self.host, self.port, self.keepaliveSeconds)
+        self.client.loop_start()
+
+    def stop(self):
+        self.connected = False
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def isConnected(self):
+        return self.connected
+
+    def subscribe(self, topic, callback):
+        with self.lock:
+            callbacks = self.subscriptions.setdefault(topic, list())
+            callbacks.append(callback)
+            if len(callbacks) > 1 or not self.connected :
+                return
+        self.client.subscribe(topic)
+
+    def unsubscribe(self, topic, callback):
+        with self.lock:
+            callbacks = self.subscriptions.get(topic, list())
+            if callback in callbacks :
+                callbacks.remove(callback)
+            if len(callbacks) > 0 or topic not in self.subscriptions :
+                return
+            del self.subscriptions[topic]
+        self.client.unsubscribe(topic)
+
+    def subscribeWallbox(self, topic, onStatus):
+        return WallboxSubscription(self, topic, onStatus)
+
+    def onConnect(self, client, userdata, flags, reasonCode, properties=None):
+        # same signature for the callback API of paho-mqtt 1 and 2
+        if reasonCode != 0 :
+            log.warning("Connection refused", extra=Log.fields(host=self.host, reason=reasonCode))
+            return
+        with self.lock:
+            self.connected = True
+            topics = list(self.subscriptions)
+        log.info("Connected", extra=Log.fields(host=self.host, topics=len(topics)))
+        for topic in topics:
+            client.subscribe(topic)
+
+    def onDisconnect(self, client, userdata, *arguments):
+        if self.connected :
+            log.warning("Disconnected, reconnecting", extra=Log.fields(host=self.host))
+        self.connected = False
+
+    def onMessage(self, client, userdata, message):
+        with self.lock:
+            callbacks = [callback for topic, topicCallbacks in self.subscriptions.items() if mqtt.topic_matches_sub(topic, message.topic)
+                         for callback in topicCallbacks]
+        for callback in callbacks:
+            try:
+                callback(message.topic, message.payload)
+            except Exception:
+                log.exception("Message not processed", extra=Log.fields(topic=message.topic))
+
+
+######################################################################################
+# Class WallboxSubscription
+#
+# The API v2 of the go-eCharger publishes each key as <topic>/<key>, e.g.
+# go-eCharger/123456/car, the legacy API the whole status as <topic>/status. onStatus is
+# called with a dict with "state" (WallboxState) and/or "power" (kW).
+######################################################################################
+class WallboxSubscription:
+
+    def __init__(self, connection, topic, onStatus):
+        self.connection = connection
+        self.topic = topic.rstrip("/")
+        self.onStatus = onStatus
+        connection.subscribe(self.topic + "/#", self.onMessage)
+
+    def isLive(self):
+        # False while the broker is not connected, the wallbox must be polled then
+        return self.connection.isConnected()
+
+    def parseMessage(self, key, value):
+        if key == "status" :
+            return {"state": getWallboxState(value["car"]), "power": value["nrg"][11] / 100} # legacy power in 0.01kW
+        if key == "car" :
+            return {"state": getWallboxState(value)}
+        if key == "nrg" :
+            return {"power": value[11] / 1000} # API v2 power in W
+        return None
+
+    def onMessage(self, topic, payload):
+        key = topic[len(self.topic) + 1:]
+        try:
+            status = self.parseMessage(key, json.loads(payload))
+        except (ValueError, KeyError, TypeError, IndexError):
+            log.warning("Invalid wallbox message", extra=Log.fields(topic=topic))
+            return
+        if status != None :
+            self.onStatus(status)
+
+    def close(self):
+        self.connection.unsubscribe(self.topic + "/#", self.onMessage)
+
+
+def getWallboxState(car):
+    # "car" of both APIs, unknown and error values have no WallboxState
+    try:
+        return WallboxState(int(car))
+    except ValueError:
+        return WallboxState.STATE_UNDEFINED
+
+
+######################################################################################
+# Class MqttSensor
+#
+# Measurement of a meter which publishes its value, e.g.
+# {"type": "Mqtt", "topic": "meter/pv", "key": "power", "factor": 0.001}
+# The payload is a number or a JSON object with the value in "key". The value is
+# multiplied by "factor" to get the unit of the thresholds. With "addPowerWallbox" the
+# power of the wallboxes is added, for a meter of the grid feed-in like Smartfox.
+######################################################################################
+class MqttSensor(Measurement.WeatherSensor):
+
+    def __init__(self, topic, modes, key=None, factor=1, maxAgeSeconds=60, valueIsPower=True, addPowerWallbox=False):
+        super().__init__(modes)
+        self.topic = topic
+        self.key = key
+        self.factor = factor
+        self.maxAgeSeconds = maxAgeSeconds
+        self.valueIsPower = valueIsPower
+        self.addPowerWallbox = addPowerWallbox
+        self.value = None
+        self.receivedAt = None # time.monotonic() of the last value
+        self.lock = threading.Lock()
+        self.connection = connection
+        if self.connection != None :
+            self.connection.subscribe(topic, self.onMessage)
+
+    @classmethod
+    def fromSettings(cls, settings, modes):
+        return cls(settings["topic"], modes, settings.get("key"), settings.get("factor", 1), settings.get("maxAgeSeconds", 60),
+                   settings.get("valueIsPower", True), settings.get("addPowerWallbox", False))
+
+    def onMessage(self, topic, payload):
+        try:
+            value = json.loads(payload)
+            if self.key != None :
+                value = value[self.key]
+            value = float(value) * self.factor
+        except (ValueError, KeyError, TypeError):
+            log.warning("Invalid meter message", extra=Log.fields(topic=topic))
+            return
+        with self.lock:
+            self.value = value
+            self.receivedAt = time.monotonic()
+
+    def readValue(self, powerWallbox):
+        with self.lock:
+            if self.value == None or time.monotonic() - self.receivedAt > self.maxAgeSeconds :
+                raise IOError("No recent value on " + self.topic)
+            value = self.value
+        if self.addPowerWallbox :
+            value = value + powerWallbox
+        return value
+
+    def unsubscribe(self):
+        # Called by the engine when the sensor is replaced
+        if self.connection != None :
+            self.connection.unsubscribe(self.topic, self.onMessage)
+
+
+class MqttSensorAsync(MqttSensor):
+
+    # for AsyncChargePlan, the value is already there
+
+    async def readValue(self, powerWallbox):
+        return MqttSensor.readValue(self, powerWallbox)
+
+    async def close(self):
+        self.unsubscribe()
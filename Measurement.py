@@ -7,14 +7,132 @@
 import requests
 # re is used for regex
 import re
-# attrgetter is used for sorting list
-from operator import attrgetter
+# time and threading are used for the shared Swissmeteo cache
+import time
+import threading
+from email.utils import parsedate_to_datetime
 
-# Socket, umodbus and struct is used for modbus TCP (Smartfox)
-import socket
-from umodbus import conf
-from umodbus.client import tcp
-import struct
+import Log
+
+log = Log.getLogger("Measurement")
+
+
+######################################################################################
+# Class WeatherSensor
+#
+# Base class of all measurement classes. A subclass reads its value with readValue(),
+# the value is then converted to the allowed charging current with the compiled
+# threshold table of the mode (see Config.ThresholdTable).
+######################################################################################
+class WeatherSensor:
+
+    # True if readValue() returns a power in kW, which can be split between several wallboxes
+    valueIsPower = True
+    # Set by the engine from the configuration, in the unit of the thresholds
+    hysteresis = 0
+
+    def __init__(self, modes):
+        # modes is a mapping of mode id -> ThresholdTable. It can be replaced at runtime
+        # when the configuration is reloaded.
+        self.modes = modes
+
+    @classmethod
+    def fromSettings(cls, settings, modes):
+        # Create the sensor from the settings of its measurement in config.json
+        raise NotImplementedError
+
+    def readValue(self, powerWallbox):
+        # Must return the measured value in the unit of the thresholds. Raises IOError.
+        raise NotImplementedError
+
+    def getCurrent(self, value, modeID, hysteresis=0):
+        # hysteresis lowers all thresholds, used while charging
+        thresholds = self.modes.get(modeID)
+        if thresholds == None :
+            log.error("Mode not found", extra=Log.fields(sensor=type(self).__name__, mode=modeID))
+            return 0
+        return thresholds.getCurrent(value + hysteresis)
+
+    def getMaxAllowedCurrent(self, powerWallbox, modeID):
+        return self.getCurrent(self.readValue(powerWallbox), modeID)
+
+
+######################################################################################
+# Class SwissmeteoFeed
+#
+# Process-wide cache of the Swissmeteo sunshine feed. The feed is published every 10
+# minutes, so it's downloaded at most once per 10-minute slot and shared by all
+# Swissmeteo instances. A new slot revalidates with ETag/If-Modified-Since.
+######################################################################################
+class SwissmeteoFeed:
+
+    URL = 'https://data.geo.admin.ch/ch.meteoschweiz.messwerte-sonnenscheindauer-10min/ch.meteoschweiz.messwerte-sonnenscheindauer-10min_de.json'
+    SLOT_SECONDS = 600
+    # Publication is some minutes late, so an unchanged feed is checked again after this time
+    REVALIDATE_SECONDS = 60
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.stations = dict() # station id -> (station name, value)
+        self.etag = None
+        self.lastModified = None
+        self.slot = None
+        self.lastCheck = 0
+
+    def getStation(self, stationID):
+        with self.lock:
+            now = time.time()
+            slot = self.slotToUpdate(now)
+            if slot != None :
+                resp = self.session.get(self.url, headers=self.requestHeaders(), timeout=5)
+                self.lastCheck = now
+                if resp.status_code != 304 :
+                    resp.raise_for_status()
+                    self.update(resp.json(), resp.headers, slot)
+        return self.lookup(stationID)
+
+    def slotToUpdate(self, now):
+        # Returns the current slot if the feed must be checked, otherwise None
+        slot = int(now // self.SLOT_SECONDS)
+        if slot != self.slot and now - self.lastCheck >= self.REVALIDATE_SECONDS :
+            return slot
+        return None
+
+    def requestHeaders(self):
+        headers = dict()
+        if self.etag != None :
+            headers['If-None-Match'] = self.etag
+        if self.lastModified != None :
+            headers['If-Modified-Since'] = self.lastModified
+        return headers
+
+    def update(self, datastore, headers, slot):
+        # Take over a downloaded feed. A 304 response means the feed is not yet updated for this slot.
+        self.stations = {station['id']: (station['properties']['station_name'], station['properties']['value']) for station in datastore['features']}
+        self.etag = headers.get('ETag')
+        self.lastModified = headers.get('Last-Modified')
+        if self.lastModified != None and int(parsedate_to_datetime(self.lastModified).timestamp() // self.SLOT_SECONDS) < slot :
+            # Still the data of the previous slot, check again later
+            return
+        self.slot = slot
+
+    def lookup(self, stationID):
+        try:
+            return self.stations[stationID]
+        except KeyError:
+            raise IOError
+
+# One feed per URL, shared by all instances of Swissmeteo
+swissmeteoFeeds = dict()
+swissmeteoFeedsLock = threading.Lock()
+
+def getSwissmeteoFeed(url):
+    with swissmeteoFeedsLock:
+        if url not in swissmeteoFeeds :
+            swissmeteoFeeds[url] = SwissmeteoFeed(url)
+        return swissmeteoFeeds[url]
 
 
 ######################################################################################
@@ -23,39 +141,28 @@ import struct
 # Interface to the openly available measurement data from the Swissmeteo measurement
 # stations. Gets the duration of sunshine in minutes within the last 10 minutes.
 ######################################################################################
-class Swissmeteo:
+class Swissmeteo(WeatherSensor):
+
+    # The value is a sunshine duration
+    valueIsPower = False
 
-    def __init__(self, stationID, modes):
+    def __init__(self, stationID, modes, url=SwissmeteoFeed.URL):
+        super().__init__(modes)
         self.stationID = stationID
-        self.modes = modes
+        self.feed = getSwissmeteoFeed(url)
 
-    def getMaxAllowedCurrent(self, powerWallbox, modeID):
+    @classmethod
+    def fromSettings(cls, settings, modes):
+        return cls(settings["station"], modes, settings.get("url", SwissmeteoFeed.URL))
+
+    def readValue(self, powerWallbox):
+        # Sunshine duration in minutes within the last 10 minutes
         try:
-            resp = requests.get('https://data.geo.admin.ch/ch.meteoschweiz.messwerte-sonnenscheindauer-10min/ch.meteoschweiz.messwerte-sonnenscheindauer-10min_de.json', timeout=5)
-
-            datastore = resp.json()
-
-            for station in datastore['features']:
-                if station['id'] == self.stationID :
-                    print('Station name:' + station['properties']['station_name'])
-                    print('Value:' + str(station['properties']['value']) )
-                    sunshineduration = station['properties']['value']
-
-            # Select correct mode and thresholds
-            for mode in self.modes :
-                if mode["id"] == modeID :
-                    thresholds = mode["thresholds"]
-
-            # Sort list so the maximum power is first
-            thresholds.sort(key=lambda x: x["minSunshineDuration"], reverse=True)
-            for threshold in thresholds :
-                if sunshineduration >= threshold["minSunshineDuration"] :
-                    return threshold["chargeCurrentAmpere"]
-                    
-            # If no threshold is reached, return 0
-            return 0
+            stationName, sunshineduration = self.feed.getStation(self.stationID)
+            log.info("Sunshine duration", extra=Log.fields(sensor="Swissmeteo", station=stationName, value=sunshineduration))
+            return sunshineduration
 
-        except (requests.exceptions.RequestException, requests.exceptions.Timeout):
+        except (requests.exceptions.RequestException, requests.exceptions.Timeout, ValueError, KeyError):
             raise IOError
 
 
@@ -66,51 +173,70 @@ class Swissmeteo:
 # this requires a separate licence. Only tested with a certain instance, not
 # garanteed to work with every instance/version.
 ######################################################################################
-class SolarLog:
+class SolarLog(WeatherSensor):
+
+    powerPattern = re.compile(r"P<sub>AC</sub>: ([0-9]{1,6}) W")
+    # The login form is shown instead of the data if the session is not logged in (anymore)
+    loginPattern = re.compile(r"name=[\"']?password", re.IGNORECASE)
 
     def __init__(self, url, username, password, modes):
+        super().__init__(modes)
         self.url = url
         self.username = username
         self.password = password
-        self.modes = modes
-
-    def getMaxAllowedCurrent(self, powerWallbox, modeID):
+        # Session and cookies are kept, so the login is only needed once
+        self.session = requests.Session()
+        self.loggedIn = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def fromSettings(cls, settings, modes):
+        return cls(settings["url"], settings["username"], settings["password"], modes)
+
+    def loginPayload(self):
+        return {"username": self.username, "password": self.password, "submit": "Login", "action": "login"}
+
+    def login(self):
+        self.session.post(self.url, data=self.loginPayload(), timeout=5)
+        self.loggedIn = True
+
+    def needsLogin(self, statusCode, text):
+        return statusCode in (401, 403) or self.loginPattern.search(text) != None
+
+    def readWebsite(self):
+        with self.lock:
+            if not self.loggedIn :
+                self.login()
+            website = self.session.get(self.url, timeout=5)
+            if self.needsLogin(website.status_code, website.text) :
+                # Session expired, login again and repeat the request
+                self.login()
+                website = self.session.get(self.url, timeout=5)
+            return website
+
+    def parsePower(self, text):
+        powerMatch = self.powerPattern.search(text)
+        if powerMatch != None :
+            powerString = powerMatch.group(1)
+        else :
+            powerString = "0"
+
+        # Convert to number and convert from W to kW
+        currentPowerkW = int(powerString) / 1000
+        log.info("Power", extra=Log.fields(sensor="Solarlog", currentPowerkW=currentPowerkW))
+
+        # The maximum allowed charging power is dependant on the current solar power. Since we only know
+        # about production but not about other consumption, this can often not be a 1 to 1 relationship
+        return currentPowerkW
+
+    def readValue(self, powerWallbox):
         #get current power
         try:
-            with requests.Session() as s:
-                payload = {"username": self.username, "password": self.password, "submit": "Login", "action": "login"}
-                s.post(self.url, data=payload, timeout=5)
-
-                # An authorised request.
-                website = s.get(self.url, timeout=5)
-                powerPatternList = re.findall(r"P<sub>AC</sub>: [0-9]{1,6} W", website.text)
-                if len(powerPatternList) > 0 :
-                    powerStringList = re.findall(r"[0-9]{1,6}", powerPatternList[0])
-                else :
-                    powerStringList = ["0"]
-
-            # Convert to number and convert from W to kW
-            currentPowerkW = int(powerStringList[0]) / 1000
-            print("currentPowerkW Solarlog: " + str(currentPowerkW))
-
-            # The maximum allowed charging power is dependant on the current solar power. Since we only know
-            # about production but not about other consumption, this can often not be a 1 to 1 relationship
-
-            # Select correct mode and thresholds
-            for mode in self.modes :
-                if mode["id"] == modeID :
-                    thresholds = mode["thresholds"]
-
-            # Sort list so the maximum power is first
-            thresholds.sort(key=lambda x: x["minPowerProductionKW"], reverse=True)
-            for threshold in thresholds :
-                if currentPowerkW >= threshold["minPowerProductionKW"] :
-                    return threshold["chargeCurrentAmpere"]
-
-            # If no threshold is reached, return 0
-            return 0
+            website = self.readWebsite()
+            return self.parsePower(website.text)
 
         except (requests.exceptions.RequestException, requests.exceptions.Timeout):
+            self.loggedIn = False
             raise IOError
 
 
@@ -118,110 +244,71 @@ class SolarLog:
 # Class Fronius
 #
 # Interface to a Fronius PV inverter which follows the "Fronius Solar API V1". Targets
-# and is tested with a Fronius Symo 3.7-3 S
+# and is tested with a Fronius Symo 3.7-3 S. With powerFlow, the power flow of the
+# whole site (all inverters, grid and load of the Fronius Smart Meter) is read with
+# one request and the surplus is calculated like with Smartfox.
 ######################################################################################
-class Fronius:
+class Fronius(WeatherSensor):
+
+    INVERTER_PATH = "/solar_api/v1/GetInverterRealtimeData.cgi"
+    POWERFLOW_PATH = "/solar_api/v1/GetPowerFlowRealtimeData.fcgi"
 
-    def __init__(self, baseURL, deviceID, modes):
+    def __init__(self, baseURL, deviceID, modes, powerFlow=False):
+        super().__init__(modes)
         self.baseURL = baseURL
         self.deviceID = deviceID
-        self.modes = modes
-
-    def getMaxAllowedCurrent(self, powerWallbox, modeID):
+        self.powerFlow = powerFlow
+
+    @classmethod
+    def fromSettings(cls, settings, modes):
+        return cls(settings["url"], settings.get("deviceID", 1), modes, settings.get("powerFlow", False))
+
+    def requestURL(self):
+        if self.powerFlow :
+            return self.baseURL + self.POWERFLOW_PATH
+        return self.baseURL + self.INVERTER_PATH
+
+    def requestParameters(self):
+        if self.powerFlow :
+            return {}
+        return {"Scope": "Device", "DeviceId" : str(self.deviceID), "DataCollection" : "CommonInverterData"}
+
+    def parsePower(self, datastore):
+        # If no power is currently produced (e.g. at night), PAC is not in the data
+        pac = datastore['Body']['Data'].get('PAC')
+        if pac == None :
+            currentPowerkW = 0
+        else :
+            currentPowerkW = pac['Value'] / 1000
+        log.info("Power", extra=Log.fields(sensor="Fronius", currentPowerkW=currentPowerkW))
+
+        # The maximum allowed charging power is dependant on the current solar power.
+        return currentPowerkW
+
+    def parsePowerFlow(self, datastore, powerWallbox):
+        # Values of the site in W: P_Grid is positive when power is taken from the grid, P_PV is
+        # the production of all inverters. Both are null if there is no meter or no production.
+        site = datastore['Body']['Data']['Site']
+        productionkW = (site.get('P_PV') or 0) / 1000
+        if site.get('P_Grid') == None :
+            # without meter only the production is known
+            log.info("Power", extra=Log.fields(sensor="Fronius", productionkW=productionkW))
+            return productionkW
+        gridkW = site['P_Grid'] / 1000
+        # Power fed into the grid plus the power of the wallboxes, which is available for charging
+        currentPowerkW = powerWallbox - gridkW
+        log.info("Power", extra=Log.fields(sensor="Fronius", currentPowerkW=currentPowerkW, productionkW=productionkW, gridkW=gridkW))
+        return currentPowerkW
+
+    def parseResponse(self, datastore, powerWallbox):
+        if self.powerFlow :
+            return self.parsePowerFlow(datastore, powerWallbox)
+        return self.parsePower(datastore)
+
+    def readValue(self, powerWallbox):
         try:
+            resp = requests.get(self.requestURL(), params=self.requestParameters(), timeout=5)
+            return self.parseResponse(resp.json(), powerWallbox)
 
-            payload = {"Scope": "Device", "DeviceId" : str(self.deviceID), "DataCollection" : "CommonInverterData"}
-            resp = requests.get(self.baseURL + "/solar_api/v1/GetInverterRealtimeData.cgi", params=payload, timeout=5)
-            
-            datastore = resp.json()
-
-            # If no power is currently produced, the following field is not in the json which will generate an exception
-            currentPowerkW = datastore['Body']['Data']['PAC']['Value'] / 1000
-            print('currentPowerkW Fronius:' + str(currentPowerkW))
-
-            # The maximum allowed charging power is dependant on the current solar power.
-
-            # Select correct mode and thresholds
-            for mode in self.modes :
-                if mode["id"] == modeID :
-                    thresholds = mode["thresholds"]
-
-            # Sort list so the maximum power is first            
-
-            thresholds.sort(key=lambda x: x["minPowerProductionKW"], reverse=True)
-            for threshold in thresholds :
-                if currentPowerkW >= threshold["minPowerProductionKW"] :
-                    return threshold["chargeCurrentAmpere"]
-                    
-            # If no threshold is reached, return 0
-            return 0
-
-        except :
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
             raise IOError
-
-
-######################################################################################
-# Class Smartfox
-#
-# Interface to a Smartfox Pro energy management device.
-######################################################################################
-class Smartfox:
-
-    def __init__(self, IPaddress, modes):
-        self.IPaddress = IPaddress
-        self.modes = modes
-
-    def getMaxAllowedCurrent(self, powerWallbox, modeID):
-
-        try:
-            # Enable values to be signed (default is False).
-            conf.SIGNED_VALUES = False
-
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.IPaddress, 502))
-
-            # Request the current total power
-            message = tcp.read_holding_registers(slave_id=1, starting_address=41017, quantity=2)
-            response_totalPower = tcp.send_message(message, sock)
-
-            # Request the current power sent to the analog output
-            message = tcp.read_holding_registers(slave_id=1, starting_address=41041, quantity=2)
-            response_analogOutPower = tcp.send_message(message, sock)
-
-            sock.close()
-
-            # Convert response of total power in INT32 to a normal number in kW
-            temp = struct.pack(">HH", response_totalPower[0], response_totalPower[1])
-            totalPowerTuple = struct.unpack(">l", temp)
-            totalPowerkW = totalPowerTuple[0] / 1000
-
-            # Convert response of analogout power in UINT32 to a normal number in kW
-            temp = struct.pack(">HH", response_analogOutPower[0], response_analogOutPower[1])
-            analogOutPowerTuple = struct.unpack(">L", temp)
-            analogOutPowerkW = analogOutPowerTuple[0] / 1000
-
-            # Add both powers in the correct way to get the current power produced and available
-            currentPowerkW = analogOutPowerkW + ((-1) * totalPowerkW) + powerWallbox
-            
-            print('currentPowerkW Smartfox:' + str(currentPowerkW))
-
-            # Select correct mode and thresholds
-            for mode in self.modes :
-                if mode["id"] == modeID :
-                    thresholds = mode["thresholds"]
-            
-            if thresholds != None :
-                # Sort list so the maximum power is first
-                thresholds.sort(key=lambda x: x["minPowerProductionKW"], reverse=True)
-                for threshold in thresholds :
-                    if currentPowerkW >= threshold["minPowerProductionKW"] :
-                        return threshold["chargeCurrentAmpere"]
-                # If no threshold is reached, return 0
-                return 0
-            else :
-                print("Smartfox Error: Mode not found")
-                return 0
-
-        except :
-            raise IOError
-
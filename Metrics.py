@@ -0,0 +1,194 @@
+######################################################################################
+# Metrics.py
+# Counters and histograms of the engine and the drivers, exposed by ChargePlanWebApp
+# on /metrics in the Prometheus text format. Drivers are measured by wrapping their
+# methods with instrument(), so Wallbox.py and Measurement.py don't need to know
+# about metrics.
+######################################################################################
+
+import time
+import asyncio
+import threading
+import functools
+
+
+def formatLabels(labelNames, labelValues, extra=None):
+    labels = list(zip(labelNames, labelValues))
+    if extra != None :
+        labels.append(extra)
+    if len(labels) == 0 :
+        return ""
+    escaped = [name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for name, value in labels]
+    return "{" + ",".join(escaped) + "}"
+
+
+def formatValue(value):
+    if value == float("inf") :
+        return "+Inf"
+    return repr(float(value))
+
+
+######################################################################################
+# Class Counter
+######################################################################################
+class Counter:
+
+    metricType = "counter"
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.values = dict() # label values -> value
+        self.lock = threading.Lock()
+
+    def labelValues(self, labels):
+        return tuple(str(labels[name]) for name in self.labelNames)
+
+    def inc(self, amount=1, **labels):
+        key = self.labelValues(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.labelValues(labels), 0)
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [self.name + formatLabels(self.labelNames, key) + " " + formatValue(value) for key, value in values]
+
+
+######################################################################################
+# Class Histogram
+######################################################################################
+class Histogram:
+
+    metricType = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.values = dict() # label values -> [count per bucket, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelNames)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry == None :
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self.values[key] = entry
+            for index, bound in enumerate(self.buckets):
+                if value <= bound :
+                    entry[0][index] = entry[0][index] + 1
+                    break
+            entry[1] = entry[1] + value
+            entry[2] = entry[2] + 1
+
+    def render(self):
+        with self.lock:
+            values = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self.values.items()]
+        lines = list()
+        for key, bucketCounts, total, count in values:
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets, bucketCounts):
+                cumulative = cumulative + bucketCount
+                lines.append(self.name + "_bucket" + formatLabels(self.labelNames, key, ("le", formatValue(bound))) + " " + str(cumulative))
+            lines.append(self.name + "_sum" + formatLabels(self.labelNames, key) + " " + formatValue(total))
+            lines.append(self.name + "_count" + formatLabels(self.labelNames, key) + " " + str(count))
+        return lines
+
+
+######################################################################################
+# Class Registry
+######################################################################################
+class Registry:
+
+    def __init__(self):
+        self.metrics = list()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Prometheus text format, version 0.0.4
+        lines = list()
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " + metric.help)
+            lines.append("# TYPE " + metric.name + " " + metric.metricType)
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+driverSeconds = registry.register(Histogram("chargeplan_driver_call_seconds", "Duration of calls to wallboxes and sensors", ("driver", "instance", "operation")))
+driverErrors = registry.register(Counter("chargeplan_driver_errors_total", "Failed calls to wallboxes and sensors", ("driver", "instance", "operation")))
+driverTimeouts = registry.register(Counter("chargeplan_driver_timeouts_total", "Sensor reads without an answer before the deadline", ("driver", "instance")))
+iterationSeconds = registry.register(Histogram("chargeplan_iteration_seconds", "Duration of one iteration of the statemachines"))
+stateSeconds = registry.register(Counter("chargeplan_state_seconds_total", "Time spent in each state", ("wallbox", "state")))
+wallboxCommands = registry.register(Counter("chargeplan_wallbox_commands_total", "Settings requests sent to the wallboxes", ("wallbox",)))
+circuitOpened = registry.register(Counter("chargeplan_circuit_opened_total", "Circuit breakers opened after repeated failures", ("device",)))
+chargingSwitches = registry.register(Counter("chargeplan_charging_switches_total", "Charging allowed or stopped by the engine", ("wallbox",)))
+
+
+def instrument(driver, operation, instance):
+    # Replace the method driver.<operation> of this instance by a measured one. Coroutines
+    # stay coroutines.
+    method = getattr(driver, operation)
+    labels = {"driver": type(driver).__name__, "instance": instance, "operation": operation}
+
+    def finished(started, error):
+        driverSeconds.observe(time.perf_counter() - started, **labels)
+        if error :
+            driverErrors.inc(**labels)
+
+    if asyncio.iscoroutinefunction(method) :
+        @functools.wraps(method)
+        async def measured(*arguments, **keywords):
+            started = time.perf_counter()
+            try:
+                result = await method(*arguments, **keywords)
+            except asyncio.CancelledError:
+                # sensor read after the deadline, counted by the engine as timeout
+                raise
+            except Exception:
+                finished(started, True)
+                raise
+            finished(started, False)
+            return result
+    else :
+        @functools.wraps(method)
+        def measured(*arguments, **keywords):
+            started = time.perf_counter()
+            try:
+                result = method(*arguments, **keywords)
+            except Exception:
+                finished(started, True)
+                raise
+            finished(started, False)
+            return result
+
+    setattr(driver, operation, measured)
+
+
+def countCalls(driver, operation, counter, **labels):
+    # Count the calls of driver.<operation>, if the driver has this method
+    method = getattr(driver, operation, None)
+    if method == None :
+        return
+
+    @functools.wraps(method)
+    def counted(*arguments, **keywords):
+        result = method(*arguments, **keywords)
+        counter.inc(**labels)
+        return result
+
+    setattr(driver, operation, counted)
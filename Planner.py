@@ -0,0 +1,128 @@
+######################################################################################
+# Planner.py
+# Charge schedule for a goal: splits the horizon until the goal into slots, expects the
+# forecast PV power in each slot and puts the energy which the sun can't deliver into
+# the latest slots before the goal. The engine charges from the grid only when the
+# current slot of the plan needs it. Needs NumPy, without it ChargePlan keeps the
+# fixed deadline of the car (goal - deadlineHours).
+######################################################################################
+
+import math
+from collections import namedtuple
+
+import numpy
+
+# Lowest current a wallbox can charge with (IEC 61851)
+MIN_CURRENT = 6
+
+# gridStart: unix time of the first slot which charges from the grid, None if the sun
+# is expected to deliver everything. powerkW: charging power planned for now.
+# reachable: False if the goal can't be reached even with full power in all slots.
+Plan = namedtuple("Plan", ["gridStart", "powerkW", "gridPowerkW", "solarkWh", "gridkWh", "reachable"])
+
+
+######################################################################################
+# Forecasts
+#
+# getPowerkW(slotStarts) returns the expected PV power in kW for an array of unix times,
+# as array or list.
+######################################################################################
+class NoForecast:
+
+    def getPowerkW(self, slotStarts):
+        return numpy.zeros(len(slotStarts))
+
+
+class HistoryForecast:
+
+    # Expects the average power of the last days at the same time of day, from the values
+    # of a sensor recorded in the time series. Time slots without values count as no sun.
+
+    def __init__(self, timeSeries, seriesName, historyDays=7, slotSeconds=900):
+        self.timeSeries = timeSeries
+        self.seriesName = seriesName
+        self.historyDays = historyDays
+        self.slotSeconds = slotSeconds
+        self.slotsPerDay = int(86400 // slotSeconds)
+        self.profile = None # average power per slot of the day
+        self.profileStart = None # unix time of the first slot of the profile
+        self.profileEnd = None # slot start up to which the history is in the profile
+
+    def updateProfile(self, now):
+        # Calculated again only once per slot
+        end = math.floor(now / self.slotSeconds) * self.slotSeconds
+        if end == self.profileEnd :
+            return
+        start = end - self.historyDays * 86400
+        timestamps, values = self.timeSeries.readSamples(self.seriesName, start, end)
+        timestamps = numpy.frombuffer(timestamps, dtype=numpy.float64)
+        values = numpy.clip(numpy.frombuffer(values, dtype=numpy.float64), 0, None)
+        slots = ((timestamps - start) // self.slotSeconds).astype(numpy.int64) % self.slotsPerDay
+        sums = numpy.bincount(slots, weights=values, minlength=self.slotsPerDay)
+        counts = numpy.bincount(slots, minlength=self.slotsPerDay)
+        self.profile = numpy.divide(sums, counts, out=numpy.zeros(self.slotsPerDay), where=counts > 0)
+        self.profileStart = start
+        self.profileEnd = end
+
+    def getPowerkW(self, slotStarts):
+        self.updateProfile(slotStarts[0])
+        slots = ((slotStarts - self.profileStart) // self.slotSeconds).astype(numpy.int64) % self.slotsPerDay
+        return self.profile[slots]
+
+
+######################################################################################
+# Class ChargePlanner
+######################################################################################
+class ChargePlanner:
+
+    def __init__(self, forecast, slotSeconds=900, horizonDays=3, forecastFactor=0.8, reserveSeconds=1800):
+        self.forecast = forecast
+        self.slotSeconds = slotSeconds
+        self.horizonSeconds = horizonDays * 86400
+        # Only this part of the forecast is trusted
+        self.forecastFactor = forecastFactor
+        # The plan ends this time before the goal
+        self.reserveSeconds = reserveSeconds
+
+    def plan(self, now, goal, requiredkWh, maxPowerkW, forecastShare=1):
+        # now and goal as unix time. forecastShare is the part of the PV power which this
+        # wallbox gets if several are charging.
+        end = goal - self.reserveSeconds
+        if requiredkWh <= 0 :
+            return Plan(None, 0, 0, 0, 0, True)
+        if end <= now :
+            return Plan(now, maxPowerkW, maxPowerkW, 0, requiredkWh, False)
+
+        # Slots from the start of the current one until the end of the horizon
+        horizonEnd = min(end, now + self.horizonSeconds)
+        first = math.floor(now / self.slotSeconds) * self.slotSeconds
+        slotStarts = first + self.slotSeconds * numpy.arange(math.ceil((horizonEnd - first) / self.slotSeconds))
+        hours = numpy.clip(numpy.minimum(slotStarts + self.slotSeconds, horizonEnd) - numpy.maximum(slotStarts, now), 0, None) / 3600
+
+        forecastkW = numpy.asarray(self.forecast.getPowerkW(slotStarts), dtype=numpy.float64) * self.forecastFactor * forecastShare
+        solarkW = numpy.clip(forecastkW, 0, maxPowerkW)
+        solarkWh = solarkW * hours
+        # Energy which the sun doesn't deliver. Beyond the horizon no sun is expected, but
+        # the slots there can charge from the grid as well.
+        deficitkWh = requiredkWh - solarkWh.sum() - maxPowerkW * (end - horizonEnd) / 3600
+
+        # Fill the latest slots first: a slot needs grid energy only if the slots after it
+        # can't take the whole deficit
+        capacitykWh = (maxPowerkW - solarkW) * hours
+        laterkWh = numpy.cumsum(capacitykWh[::-1])[::-1] - capacitykWh
+        gridkWh = numpy.clip(deficitkWh - laterkWh, 0, capacitykWh)
+
+        gridSlots = numpy.flatnonzero(gridkWh > 0)
+        if len(gridSlots) > 0 :
+            gridStart = max(now, float(slotStarts[gridSlots[0]]))
+        else :
+            gridStart = None
+        if hours[0] > 0 and gridkWh[0] > 0 :
+            # the expected sun is used in this slot too
+            gridPowerkW = float(gridkWh[0] / hours[0])
+            powerkW = gridPowerkW + float(solarkW[0])
+        else :
+            gridPowerkW = 0
+            powerkW = 0
+        reachable = bool(deficitkWh <= capacitykWh.sum() + 1e-9)
+        return Plan(gridStart, powerkW, gridPowerkW, float(solarkWh.sum()), float(gridkWh.sum()), reachable)
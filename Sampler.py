@@ -0,0 +1,205 @@
+######################################################################################
+# Sampler.py
+# Reads the weather sensors in the background, each with its own interval, and keeps
+# the last samples in a ring buffer. The engine takes the filtered value (rolling
+# median or EWMA) of the sensors instead of waiting for the devices, so a passing
+# cloud doesn't switch the charging off and on again.
+######################################################################################
+
+import math
+import time
+import asyncio
+import threading
+import statistics
+from array import array
+
+import Log
+
+log = Log.getLogger("Sampler")
+
+
+######################################################################################
+# Class SampleBuffer
+#
+# Ring buffer of the last (monotonic time, value) samples of one sensor.
+######################################################################################
+class SampleBuffer:
+
+    def __init__(self, size):
+        self.size = size
+        self.timestamps = array("d", bytes(8 * size))
+        self.values = array("d", bytes(8 * size))
+        self.count = 0 # number of samples ever added
+
+    def append(self, timestamp, value):
+        index = self.count % self.size
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+        self.count = self.count + 1
+
+    def getValues(self):
+        # The buffered values, oldest first
+        if self.count < self.size :
+            return self.values[:self.count]
+        index = self.count % self.size
+        return self.values[index:] + self.values[:index]
+
+    def getLastTimestamp(self):
+        if self.count == 0 :
+            return None
+        return self.timestamps[(self.count - 1) % self.size]
+
+
+######################################################################################
+# Class SensorSampler
+#
+# Samples one weather sensor. The filtered value is the median of the buffered samples
+# or an exponentially weighted moving average with the given time constant.
+######################################################################################
+class SensorSampler:
+
+    def __init__(self, weatherSensor, name, intervalSeconds, getPowerWallbox, onSample=None, windowSamples=20, filter="median", timeConstantSeconds=60):
+        self.weatherSensor = weatherSensor
+        self.name = name
+        self.intervalSeconds = intervalSeconds
+        # Smartfox needs the power of the wallboxes at the time of the sample
+        self.getPowerWallbox = getPowerWallbox
+        self.onSample = onSample
+        self.filter = filter
+        self.timeConstantSeconds = timeConstantSeconds
+        self.buffer = SampleBuffer(windowSamples)
+        self.ewma = None
+        self.failed = False
+        self.lock = threading.Lock()
+        self.firstSample = threading.Event() # set when the sensor has been read once, also if it failed
+
+    def addSample(self, value, timestamp=None):
+        if timestamp == None :
+            timestamp = time.monotonic()
+        with self.lock:
+            lastTimestamp = self.buffer.getLastTimestamp()
+            if self.ewma == None or lastTimestamp == None :
+                self.ewma = value
+            else :
+                # irregular intervals: the weight depends on the time since the last sample
+                alpha = 1 - math.exp(-max(timestamp - lastTimestamp, 0) / self.timeConstantSeconds)
+                self.ewma = self.ewma + alpha * (value - self.ewma)
+            self.buffer.append(timestamp, value)
+        if self.onSample != None :
+            self.onSample(value)
+
+    def getFiltered(self):
+        # Returns (filtered value, age of the last sample in seconds), None without samples
+        with self.lock:
+            lastTimestamp = self.buffer.getLastTimestamp()
+            if lastTimestamp == None :
+                return None
+            if self.filter == "ewma" :
+                value = self.ewma
+            else :
+                value = statistics.median(self.buffer.getValues())
+        return value, time.monotonic() - lastTimestamp
+
+    def sampleFailed(self, failed):
+        # Log only the change, not every failed sample
+        if failed and not self.failed :
+            log.warning("WeatherSensor IOError", extra=Log.fields(sensor=type(self.weatherSensor).__name__, instance=self.name))
+        elif self.failed and not failed :
+            log.info("WeatherSensor available again", extra=Log.fields(sensor=type(self.weatherSensor).__name__, instance=self.name))
+        self.failed = failed
+
+    def sample(self):
+        try:
+            value = self.weatherSensor.readValue(self.getPowerWallbox())
+        except IOError:
+            self.sampleFailed(True)
+            return
+        self.sampleFailed(False)
+        if value != None :
+            self.addSample(value)
+
+    async def sampleAsync(self):
+        try:
+            value = await self.weatherSensor.readValue(self.getPowerWallbox())
+        except IOError:
+            self.sampleFailed(True)
+            return
+        self.sampleFailed(False)
+        if value != None :
+            self.addSample(value)
+
+    def run(self, stopEvent):
+        # Thread of the sampler, the interval is measured from start to start
+        while not stopEvent.is_set():
+            started = time.monotonic()
+            try:
+                self.sample()
+            except Exception:
+                log.exception("WeatherSensor failed", extra=Log.fields(sensor=type(self.weatherSensor).__name__, instance=self.name))
+            self.firstSample.set()
+            stopEvent.wait(max(0, self.intervalSeconds - (time.monotonic() - started)))
+
+    async def runAsync(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.sampleAsync()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("WeatherSensor failed", extra=Log.fields(sensor=type(self.weatherSensor).__name__, instance=self.name))
+            self.firstSample.set()
+            await asyncio.sleep(max(0, self.intervalSeconds - (time.monotonic() - started)))
+
+
+######################################################################################
+# Class Sampler
+#
+# The samplers of all weather sensors, in priority order.
+######################################################################################
+class Sampler:
+
+    def __init__(self, samplers, maxAgeSeconds):
+        self.samplers = samplers
+        self.maxAgeSeconds = maxAgeSeconds
+        self.stopEvent = threading.Event()
+        self.threads = list()
+        self.tasks = list()
+
+    def start(self):
+        for sampler in self.samplers:
+            thread = threading.Thread(target=sampler.run, args=(self.stopEvent,), name="Sampler-" + sampler.name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def startTasks(self, loop):
+        # asyncio variant, the sensors have coroutines as readValue
+        self.tasks = [loop.create_task(sampler.runAsync()) for sampler in self.samplers]
+
+    def waitForFirstSamples(self, timeoutSeconds):
+        # Until each sensor has been read once, so the first iteration has a reading
+        deadline = time.monotonic() + timeoutSeconds
+        for sampler in self.samplers:
+            sampler.firstSample.wait(max(0, deadline - time.monotonic()))
+
+    async def waitForFirstSamplesAsync(self, timeoutSeconds):
+        deadline = time.monotonic() + timeoutSeconds
+        while not all(sampler.firstSample.is_set() for sampler in self.samplers) and time.monotonic() < deadline :
+            await asyncio.sleep(0.05)
+
+    def stop(self):
+        self.stopEvent.set()
+        for task in self.tasks:
+            task.cancel()
+
+    def getReading(self):
+        # Like ChargePlanEngine.readWeatherSensors(): (weatherSensor, filtered value) of the first
+        # sensor with a recent sample, None if no sensor has one
+        for sampler in self.samplers:
+            filtered = sampler.getFiltered()
+            if filtered == None :
+                continue
+            value, age = filtered
+            if age <= self.maxAgeSeconds :
+                return (sampler.weatherSensor, value)
+        return None
@@ -0,0 +1,362 @@
+######################################################################################
+# Simulation.py
+# Runs ChargePlanEngine with a virtual clock, simulated wallboxes and cars and a PV
+# production trace, so days or seasons are simulated in seconds. Used to compare modes
+# and thresholds before they are changed in config.json.
+#
+# python Simulation.py --config config.json --start 2026-06-01 --days 30 --mode 2
+######################################################################################
+
+import sys
+import csv
+import copy
+import math
+import random
+import argparse
+import datetime
+from array import array
+from bisect import bisect_right
+
+import ChargePlan
+import Wallbox
+import Measurement
+import Log
+import TimeSeries
+
+
+class StopSimulation(Exception):
+    pass
+
+
+######################################################################################
+# Class VirtualClock
+#
+# Same interface as ChargePlan.SystemClock, but time only passes with advance().
+######################################################################################
+class VirtualClock:
+
+    def __init__(self, start):
+        self.start = start
+        self.elapsed = 0.0
+
+    def advance(self, seconds):
+        self.elapsed = self.elapsed + seconds
+
+    def monotonic(self):
+        return self.elapsed
+
+    def time(self):
+        return self.start.timestamp() + self.elapsed
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.elapsed)
+
+
+######################################################################################
+# PV traces
+#
+# getPowerkW(now) returns the PV production at a datetime.
+######################################################################################
+class SyntheticPVTrace:
+
+    def __init__(self, peakkW, sunriseHour=6, sunsetHour=20, cloudiness=0.3, seed=1):
+        self.peakkW = peakkW
+        self.sunriseHour = sunriseHour
+        self.sunsetHour = sunsetHour
+        self.cloudiness = cloudiness
+        self.seed = seed
+        self.clouds = dict() # (day, minute of day / 10) -> cloud factor
+
+    def getCloudFactor(self, now):
+        # Clouds change every 10 minutes, the same for the same seed and time
+        key = (now.date(), (now.hour * 60 + now.minute) // 10)
+        factor = self.clouds.get(key)
+        if factor == None :
+            generator = random.Random(self.seed * 1000003 + key[0].toordinal() * 1000 + key[1])
+            factor = 1 - self.cloudiness * generator.random()
+            if len(self.clouds) > 10000 :
+                self.clouds.clear()
+            self.clouds[key] = factor
+        return factor
+
+    def getPowerkW(self, now):
+        hour = now.hour + now.minute / 60 + now.second / 3600
+        if hour <= self.sunriseHour or hour >= self.sunsetHour :
+            return 0
+        # Bell shaped production over the day
+        sun = math.sin(math.pi * (hour - self.sunriseHour) / (self.sunsetHour - self.sunriseHour))
+        return self.peakkW * sun * sun * self.getCloudFactor(now)
+
+
+class RecordedPVTrace:
+
+    def __init__(self, timestamps, values):
+        # timestamps (unix time) must be sorted, values in kW
+        self.timestamps = timestamps
+        self.values = values
+
+    @classmethod
+    def fromCSV(cls, path):
+        # Lines "ISO time or unix time,kW", e.g. exported from /api/history
+        timestamps = array("d")
+        values = array("d")
+        with open(path, newline="") as csvFile:
+            for row in csv.reader(csvFile):
+                if len(row) < 2 :
+                    continue
+                try:
+                    timestamp = float(row[0])
+                except ValueError:
+                    try:
+                        timestamp = datetime.datetime.fromisoformat(row[0]).timestamp()
+                    except ValueError:
+                        # header
+                        continue
+                timestamps.append(timestamp)
+                values.append(float(row[1]))
+        return cls(timestamps, values)
+
+    @classmethod
+    def fromTimeSeries(cls, directory, name, start, end):
+        # e.g. the values of a sensor recorded by ChargePlanEngine
+        timestamps, values = TimeSeries.TimeSeriesStore(directory).readSamples(name, start, end)
+        return cls(timestamps, values)
+
+    def getPowerkW(self, now):
+        # Linear interpolation between the recorded values
+        if len(self.timestamps) == 0 :
+            return 0
+        timestamp = now.timestamp()
+        index = bisect_right(self.timestamps, timestamp)
+        if index == 0 :
+            return self.values[0]
+        if index == len(self.timestamps) :
+            return self.values[-1]
+        t0, t1 = self.timestamps[index - 1], self.timestamps[index]
+        v0, v1 = self.values[index - 1], self.values[index]
+        return v0 + (v1 - v0) * (timestamp - t0) / (t1 - t0)
+
+
+######################################################################################
+# Class SimulatedSensor
+#
+# Replaces a measurement of config.json. Depending on the type it returns the PV
+# production, the surplus (Smartfox) or the sunshine duration (Swissmeteo).
+######################################################################################
+class SimulatedSensor(Measurement.WeatherSensor):
+
+    def __init__(self, measurementType, simulation, modes):
+        super().__init__(modes)
+        self.measurementType = measurementType
+        self.simulation = simulation
+        self.valueIsPower = measurementType != "Swissmeteo"
+
+    def readValue(self, powerWallbox):
+        now = self.simulation.clock.now()
+        powerkW = self.simulation.pvTrace.getPowerkW(now)
+        if self.measurementType == "Swissmeteo" :
+            # minutes of sunshine within 10 minutes, full sun at 60% of the peak power
+            return min(10, round(10 * powerkW / (0.6 * self.simulation.peakkW)))
+        if self.measurementType == "Smartfox" :
+            # Smartfox measures the power which would be fed into the grid without the wallboxes
+            return powerkW - self.simulation.houseLoadkW
+        return powerkW
+
+
+class TraceForecast:
+
+    # Perfect forecast for the planner: the PV trace of the simulation minus the house load
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+
+    def getPowerkW(self, slotStarts):
+        return [self.simulation.pvTrace.getPowerkW(datetime.datetime.fromtimestamp(slotStart)) - self.simulation.houseLoadkW for slotStart in slotStarts]
+
+
+######################################################################################
+# Class SimulationEngine
+#
+# ChargePlanEngine with simulated devices. wait() advances the virtual clock instead
+# of sleeping and collects the energy statistics.
+######################################################################################
+class SimulationEngine(ChargePlan.ChargePlanEngine):
+
+    # Maximum step of the physical simulation within one wait
+    STEP_SECONDS = 60
+
+    def __init__(self, configPath, start, end, pvTrace, car, peakkW, houseLoadkW=0.3, mode=None, logLevel="WARNING", historyDirectory=None, setGoals=False, planning=True):
+        self.pvTrace = pvTrace
+        self.car = car # each wallbox gets a copy
+        self.cars = dict() # wallbox id -> SimulatedCar
+        self.peakkW = peakkW
+        self.houseLoadkW = houseLoadkW
+        self.simulationMode = mode
+        self.logLevel = logLevel
+        self.historyDirectory = historyDirectory
+        self.setGoals = setGoals # the departure of the car is set as goal
+        self.planning = planning
+        self.end = end
+        Log.setupLogging(logLevel)
+        super().__init__(configPath, VirtualClock(start))
+
+        # Statistics
+        self.solarEnergykWh = 0
+        self.gridEnergykWh = 0
+        self.pvEnergykWh = 0
+        self.chargingSeconds = 0
+        self.iterations = 0
+
+    def setupLogging(self):
+        Log.setupLogging(self.logLevel)
+
+    def createTimeSeries(self):
+        if self.historyDirectory == None :
+            self.timeSeries = None
+        else :
+            # flushed when the simulation has finished
+            self.timeSeries = TimeSeries.TimeSeriesStore(self.historyDirectory, 100000, float("inf"))
+
+    def createSampler(self):
+        # The sensors are read in each iteration, a sampler would run in real time
+        self.sampler = None
+
+    def createStateFile(self):
+        # A simulation must not continue with the state of the real engine, nor overwrite it
+        self.stateFile = None
+
+    def createMqtt(self):
+        # The simulated wallboxes don't publish anything
+        self.mqtt = None
+
+    def isPlanningEnabled(self):
+        # Plans unless --no-planner, also without "planning" in config.json
+        return self.planning
+
+    def createForecast(self):
+        return TraceForecast(self)
+
+    def getNextDeparture(self):
+        if self.car.departureHour == None :
+            return None
+        now = self.clock.now()
+        departure = now.replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(hours=self.car.departureHour)
+        if departure <= now :
+            departure = departure + datetime.timedelta(days=1)
+        return departure
+
+    def chargingStatusStep(self, chargePoint):
+        if self.setGoals and chargePoint.getGoal() == None :
+            departure = self.getNextDeparture()
+            if departure != None :
+                self.applyNewGoal(chargePoint, departure.strftime("%d.%m.%Y"), departure.strftime("%H:%M"))
+        return super().chargingStatusStep(chargePoint)
+
+    def createWallbox(self, wallboxConfig):
+        if wallboxConfig.id not in self.cars :
+            self.cars[wallboxConfig.id] = copy.deepcopy(self.car)
+        return Wallbox.goEchargerSimulation(wallboxConfig.IP, wallboxConfig.absolutMaxCurrent, self.cars[wallboxConfig.id], self.clock, wallboxConfig.phases, wallboxConfig.voltage)
+
+    def createWeatherSensor(self, measurement):
+        return SimulatedSensor(measurement.type, self, measurement.modes)
+
+    def updateChargePoints(self):
+        super().updateChargePoints()
+        if self.simulationMode != None :
+            for chargePoint in self.chargePoints.values():
+                chargePoint.mode = self.simulationMode
+
+    def getChargers(self):
+        return [chargePoint.charger for chargePoint in self.chargePoints.values() if chargePoint.charger != None]
+
+    def wait(self, seconds):
+        self.iterations = self.iterations + 1
+        self.processCommands()
+        remaining = max(seconds, 0)
+        while remaining > 0 :
+            step = min(remaining, self.STEP_SECONDS)
+            chargingPower = sum(charger.getChargingPower() for charger in self.getChargers())
+            pvPower = self.pvTrace.getPowerkW(self.clock.now() + datetime.timedelta(seconds=step / 2))
+            surplus = max(0, pvPower - self.houseLoadkW)
+            self.pvEnergykWh = self.pvEnergykWh + pvPower * step / 3600
+            self.solarEnergykWh = self.solarEnergykWh + min(chargingPower, surplus) * step / 3600
+            self.gridEnergykWh = self.gridEnergykWh + max(0, chargingPower - surplus) * step / 3600
+            if chargingPower > 0 :
+                self.chargingSeconds = self.chargingSeconds + step
+            self.clock.advance(step)
+            for charger in self.getChargers():
+                charger.update()
+            remaining = remaining - step
+        if self.clock.now() >= self.end :
+            raise StopSimulation()
+        return False
+
+    def run(self):
+        try:
+            self.start()
+        except StopSimulation:
+            pass
+        if self.sensorExecutor != None :
+            self.sensorExecutor.shutdown()
+        if self.timeSeries != None :
+            self.timeSeries.flush()
+
+    def getSummary(self):
+        chargedkWh = self.solarEnergykWh + self.gridEnergykWh
+        if chargedkWh > 0 :
+            solarShare = self.solarEnergykWh / chargedkWh
+        else :
+            solarShare = 0
+        return {
+            "iterations": self.iterations,
+            "pvEnergykWh": round(self.pvEnergykWh, 2),
+            "chargedkWh": round(chargedkWh, 2),
+            "solarEnergykWh": round(self.solarEnergykWh, 2),
+            "gridEnergykWh": round(self.gridEnergykWh, 2),
+            "solarShare": round(solarShare, 3),
+            "chargingHours": round(self.chargingSeconds / 3600, 2),
+            "currentChanges": sum(charger.currentChanges for charger in self.getChargers()),
+            "carSoc": [round(car.soc, 3) for car in self.cars.values()],
+        }
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Simulate ChargePlan with a virtual clock")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--start", default=datetime.date.today().isoformat(), help="first day, YYYY-MM-DD")
+    parser.add_argument("--days", type=float, default=1)
+    parser.add_argument("--mode", type=int, default=None, help="mode of all wallboxes, default as configured")
+    parser.add_argument("--peak", type=float, default=8, help="peak PV power of the synthetic trace in kW")
+    parser.add_argument("--cloudiness", type=float, default=0.3)
+    parser.add_argument("--pv-csv", default=None, help="recorded PV trace instead of the synthetic one")
+    parser.add_argument("--house-load", type=float, default=0.3, help="constant consumption of the house in kW")
+    parser.add_argument("--battery", type=float, default=40, help="battery size in kWh")
+    parser.add_argument("--car-power", type=float, default=11, help="maximum charging power of the car in kW")
+    parser.add_argument("--arrival-soc", type=float, default=0.3)
+    parser.add_argument("--arrival", type=float, default=None, help="hour of the day the car arrives, default always connected")
+    parser.add_argument("--departure", type=float, default=7)
+    parser.add_argument("--set-goal", action="store_true", help="set the departure as goal when the car is connected")
+    parser.add_argument("--no-planner", action="store_true", help="charge from the grid deadlineHours before the goal instead of planning")
+    parser.add_argument("--history", default=None, help="directory to store the time series of the simulation")
+    parser.add_argument("--log-level", default="WARNING")
+    options = parser.parse_args(arguments)
+
+    start = datetime.datetime.fromisoformat(options.start)
+    end = start + datetime.timedelta(days=options.days)
+    if options.pv_csv != None :
+        pvTrace = RecordedPVTrace.fromCSV(options.pv_csv)
+    else :
+        pvTrace = SyntheticPVTrace(options.peak, cloudiness=options.cloudiness)
+    car = Wallbox.SimulatedCar(options.battery, options.car_power, options.arrival_soc, options.arrival, options.departure)
+
+    simulation = SimulationEngine(options.config, start, end, pvTrace, car, options.peak, options.house_load, options.mode, options.log_level, options.history,
+                                  options.set_goal, not options.no_planner)
+    simulation.run()
+    for key, value in simulation.getSummary().items():
+        print(key + ": " + str(value))
+    Log.stopLogging()
+
+
+#If file is called as script, not used as module
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,92 @@
+######################################################################################
+# Smartfox.py
+# Measurement of a Smartfox Pro energy management device over Modbus TCP. In its own
+# module, so umodbus is imported only when a Smartfox is configured.
+######################################################################################
+
+# Socket, umodbus and struct is used for modbus TCP
+import socket
+import struct
+import threading
+from umodbus import conf
+from umodbus.client import tcp
+
+import Log
+from Measurement import WeatherSensor, log
+
+
+######################################################################################
+# Class Smartfox
+#
+# Interface to a Smartfox Pro energy management device.
+######################################################################################
+class Smartfox(WeatherSensor):
+
+    # Registers 41017-41018: total power (INT32), 41041-41042: power of analog output (UINT32).
+    # Both are read in one block and decoded with precompiled layouts.
+    BLOCK_START = 41017
+    BLOCK_QUANTITY = 41042 - 41017 + 1
+    blockStruct = struct.Struct(">" + str(BLOCK_QUANTITY) + "H")
+    powerStruct = struct.Struct(">l" + str((41041 - 41019) * 2) + "xL")
+
+    def __init__(self, IPaddress, modes, timeout=2, port=502):
+        super().__init__(modes)
+        self.IPaddress = IPaddress
+        self.timeout = timeout
+        self.port = port
+        self.sock = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def fromSettings(cls, settings, modes):
+        return cls(settings["ip"], modes, port=settings.get("port", 502))
+
+    def connect(self):
+        self.sock = socket.create_connection((self.IPaddress, self.port), timeout=self.timeout)
+        self.sock.settimeout(self.timeout)
+
+    def close(self):
+        if self.sock != None :
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def readPowerRegisters(self):
+        message = tcp.read_holding_registers(slave_id=1, starting_address=self.BLOCK_START, quantity=self.BLOCK_QUANTITY)
+        with self.lock:
+            # Try once on the existing connection, reconnect if the device has closed it meanwhile
+            for attempt in range(2):
+                reused = self.sock != None
+                try:
+                    if not reused :
+                        self.connect()
+                    return tcp.send_message(message, self.sock)
+                except Exception:
+                    self.close()
+                    if not reused or attempt == 1 :
+                        raise
+
+    def decodePower(self, response, powerWallbox):
+        # Convert response of total power in INT32 and analogout power in UINT32 to a normal number in kW
+        totalPower, analogOutPower = self.powerStruct.unpack(self.blockStruct.pack(*response))
+        totalPowerkW = totalPower / 1000
+        analogOutPowerkW = analogOutPower / 1000
+
+        # Add both powers in the correct way to get the current power produced and available
+        currentPowerkW = analogOutPowerkW + ((-1) * totalPowerkW) + powerWallbox
+        
+        log.info("Power", extra=Log.fields(sensor="Smartfox", currentPowerkW=currentPowerkW))
+        return currentPowerkW
+
+    def readValue(self, powerWallbox):
+
+        try:
+            # Enable values to be signed (default is False).
+            conf.SIGNED_VALUES = False
+
+            return self.decodePower(self.readPowerRegisters(), powerWallbox)
+
+        except :
+            raise IOError
@@ -0,0 +1,80 @@
+######################################################################################
+# StateFile.py
+# Snapshot of the engine (settings and state of each charge point) in a small JSON
+# file, so a restart continues where the engine was instead of interrupting the
+# charging. The file is replaced atomically: after a crash or power loss it contains
+# either the previous or the new snapshot, never a part of it.
+######################################################################################
+
+import os
+import json
+import tempfile
+
+import Log
+
+log = Log.getLogger("StateFile")
+
+# Version of the snapshot format, snapshots of other versions are ignored
+VERSION = 1
+
+
+def syncDirectory(directory):
+    # Make the rename durable as well. Not possible on all platforms.
+    if not hasattr(os, "O_DIRECTORY") :
+        return
+    descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+######################################################################################
+# Class StateFile
+######################################################################################
+class StateFile:
+
+    def __init__(self, path):
+        self.path = path
+        self.saved = None # last snapshot written or read, to write only changes
+
+    def load(self):
+        # Returns the snapshot as dict, None if there's no valid snapshot
+        try:
+            with open(self.path) as stateFile:
+                snapshot = json.load(stateFile)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            log.warning("State file not readable, starting without it", extra=Log.fields(file=self.path, error=error))
+            return None
+        if not isinstance(snapshot, dict) or snapshot.get("version") != VERSION :
+            log.warning("State file of another version ignored", extra=Log.fields(file=self.path))
+            return None
+        self.saved = snapshot
+        return snapshot
+
+    def save(self, snapshot):
+        # Writes the snapshot if it has changed, returns True in this case. Raises OSError.
+        snapshot = dict(snapshot, version=VERSION)
+        if snapshot == self.saved :
+            return False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        # The temporary file must be on the same file system for os.replace()
+        descriptor, temporaryPath = tempfile.mkstemp(prefix=".state-", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(descriptor, "w") as temporaryFile:
+                json.dump(snapshot, temporaryFile, indent=1)
+                temporaryFile.flush()
+                os.fsync(temporaryFile.fileno())
+            os.replace(temporaryPath, self.path)
+        except BaseException:
+            try:
+                os.unlink(temporaryPath)
+            except OSError:
+                pass
+            raise
+        syncDirectory(directory)
+        self.saved = snapshot
+        return True
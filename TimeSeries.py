@@ -0,0 +1,195 @@
+######################################################################################
+# TimeSeries.py
+# Embedded, append-only store for the values seen by ChargePlan (charging power,
+# energy, sensor values, allowed current). Samples are buffered in arrays and written
+# in batches to one binary file per series and day, so the memory usage doesn't grow
+# with the history. Day files older than the retention time are deleted.
+######################################################################################
+
+import os
+import re
+import time
+import datetime
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class TimeSeriesError(ValueError):
+    pass
+
+
+# Series names are used as directory names, so they must not start with a dot (".", "..")
+SERIES_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.-]*$")
+# Bytes of one (timestamp, value) pair in the day files
+SAMPLE_SIZE = 2 * array("d").itemsize
+# Samples read from a day file at once by a query
+CHUNK_SAMPLES = 4096
+
+
+######################################################################################
+# Class TimeSeriesStore
+#
+# Each day file contains (timestamp, value) pairs as native doubles, in ascending time
+# order. A range query only reads the day files in the range.
+######################################################################################
+class TimeSeriesStore:
+
+    def __init__(self, directory, retentionDays=90, flushSeconds=60):
+        self.directory = directory
+        self.retentionDays = retentionDays
+        self.flushSeconds = flushSeconds
+        self.buffers = dict() # series name -> array of unwritten (timestamp, value) pairs
+        self.lastFlush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def append(self, name, value, timestamp=None):
+        if SERIES_NAME_PATTERN.match(name) == None :
+            raise TimeSeriesError("Invalid series name: " + name)
+        if value == None :
+            return
+        if timestamp == None :
+            timestamp = time.time()
+        with self.lock:
+            buffer = self.buffers.get(name)
+            if buffer == None :
+                buffer = array("d")
+                self.buffers[name] = buffer
+            buffer.append(timestamp)
+            buffer.append(float(value))
+
+    def flushIfDue(self):
+        # Called in each iteration of the engine, writes at most every flushSeconds
+        if time.monotonic() - self.lastFlush >= self.flushSeconds :
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            buffers = self.buffers
+            self.buffers = dict()
+            self.lastFlush = time.monotonic()
+            for name, buffer in buffers.items():
+                self.writeSamples(name, buffer)
+        self.deleteExpired()
+
+    def writeSamples(self, name, samples):
+        # One append per series and day
+        index = 0
+        while index < len(samples):
+            day = self.dayOf(samples[index])
+            end = index + 2
+            while end < len(samples) and self.dayOf(samples[end]) == day:
+                end = end + 2
+            os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+            with open(self.dayPath(name, day), "ab") as dayFile:
+                # remove an incomplete sample, e.g. after a power failure while writing
+                dayFile.truncate(dayFile.tell() - dayFile.tell() % SAMPLE_SIZE)
+                samples[index:end].tofile(dayFile)
+            index = end
+
+    def deleteExpired(self):
+        oldestDay = datetime.date.today() - datetime.timedelta(days=self.retentionDays)
+        for name in self.getSeriesNames():
+            for fileName in os.listdir(os.path.join(self.directory, name)):
+                try:
+                    day = datetime.date.fromisoformat(fileName[:-len(".bin")])
+                except ValueError:
+                    continue
+                if day < oldestDay :
+                    os.remove(os.path.join(self.directory, name, fileName))
+
+    def dayOf(self, timestamp):
+        return datetime.date.fromtimestamp(timestamp)
+
+    def dayPath(self, name, day):
+        return os.path.join(self.directory, name, day.isoformat() + ".bin")
+
+    def getSeriesNames(self):
+        try:
+            names = set(entry for entry in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, entry)))
+        except FileNotFoundError:
+            names = set()
+        with self.lock:
+            names.update(self.buffers.keys())
+        return sorted(names)
+
+    def readChunks(self, name, start, end):
+        # Yields the timestamps and values within [start, end] as pairs of arrays of at most
+        # CHUNK_SAMPLES samples in time order, so a long range isn't loaded at once
+        if SERIES_NAME_PATTERN.match(name) == None :
+            raise TimeSeriesError("Invalid series name: " + name)
+        day = self.dayOf(start)
+        while day <= self.dayOf(end):
+            try:
+                dayFile = open(self.dayPath(name, day), "rb")
+            except FileNotFoundError:
+                dayFile = None
+            if dayFile != None :
+                with dayFile:
+                    while True:
+                        data = dayFile.read(CHUNK_SAMPLES * SAMPLE_SIZE)
+                        # an incomplete sample at the end of the file is ignored
+                        chunk = array("d")
+                        chunk.frombytes(data[:len(data) - len(data) % SAMPLE_SIZE])
+                        if len(chunk) > 0 :
+                            yield self.clipChunk(chunk, start, end)
+                        if len(data) < CHUNK_SAMPLES * SAMPLE_SIZE :
+                            break
+            day = day + datetime.timedelta(days=1)
+        with self.lock:
+            buffered = array("d", self.buffers.get(name, array("d")))
+        if len(buffered) > 0 :
+            yield self.clipChunk(buffered, start, end)
+
+    def clipChunk(self, chunk, start, end):
+        timestamps = chunk[0::2]
+        values = chunk[1::2]
+        first = bisect_left(timestamps, start)
+        last = bisect_right(timestamps, end)
+        return timestamps[first:last], values[first:last]
+
+    def readSamples(self, name, start, end):
+        # Returns the timestamps and values within [start, end] as two arrays
+        timestamps = array("d")
+        values = array("d")
+        for chunkTimestamps, chunkValues in self.readChunks(name, start, end):
+            timestamps.extend(chunkTimestamps)
+            values.extend(chunkValues)
+        return timestamps, values
+
+    def query(self, name, start, end, buckets):
+        # Downsample the range into at most the given number of buckets of equal duration.
+        # Returns a list of (bucket start, min, max, mean, count), empty buckets are left out.
+        # The samples are read in chunks, only one bucket is accumulated at a time.
+        if end <= start or buckets < 1 :
+            raise TimeSeriesError("Invalid range")
+        bucketSeconds = (end - start) / buckets
+        result = list()
+        current = None # [bucket, min, max, sum, count] of the bucket being accumulated
+        for timestamps, values in self.readChunks(name, start, end):
+            index = 0
+            while index < len(timestamps):
+                bucket = min(int((timestamps[index] - start) / bucketSeconds), buckets - 1)
+                bucketEnd = bisect_left(timestamps, start + (bucket + 1) * bucketSeconds, index)
+                if bucket == buckets - 1 :
+                    bucketEnd = len(timestamps)
+                bucketEnd = max(bucketEnd, index + 1)
+                bucketValues = values[index:bucketEnd]
+                if current != None and current[0] == bucket :
+                    # the bucket continues in this chunk
+                    current[1] = min(current[1], min(bucketValues))
+                    current[2] = max(current[2], max(bucketValues))
+                    current[3] = current[3] + sum(bucketValues)
+                    current[4] = current[4] + len(bucketValues)
+                else :
+                    if current != None :
+                        result.append(self.bucketResult(current, start, bucketSeconds))
+                    current = [bucket, min(bucketValues), max(bucketValues), sum(bucketValues), len(bucketValues)]
+                index = bucketEnd
+        if current != None :
+            result.append(self.bucketResult(current, start, bucketSeconds))
+        return result
+
+    def bucketResult(self, accumulator, start, bucketSeconds):
+        bucket, minimum, maximum, total, count = accumulator
+        return (start + bucket * bucketSeconds, minimum, maximum, total / count, count)
@@ -3,6 +3,7 @@
 # Interface to different wallboxes. At the moment:
 #
 # goEcharger: Connection to go-Echarger via local REST API
+# goEchargerV2: Connection to go-Echarger via the HTTP API v2
 # goEchargerSimulation: simulates a go-Echarger for offline testing
 
 ######################################################################################
@@ -10,15 +11,12 @@
 #requests is the defacto standard library for using REST
 import requests
 import json
-from enum import IntEnum
+# time and datetime are used by goEchargerSimulation
+import time
+import datetime
 
 # State of wallbox, PWM signalisation according to type2 definition
-class WallboxState(IntEnum):
-        STATE_UNDEFINED = 0
-        STATE_READY_NO_CAR = 1
-        STATE_CHARGING = 2
-        STATE_WAITING_FOR_CAR = 3
-        STATE_FINISHED_CAR_STILL_CONNECTED = 4
+from Drivers import WallboxState
 
 
 ##################################################################################################
@@ -26,6 +24,10 @@ class WallboxState(IntEnum):
 ##################################################################################################
 class goEcharger:
 
+    # Paths of the legacy API: /status returns all keys, /mqtt?payload=key=value,... sets them
+    STATUS_PATH = '/status'
+    SET_PATH = '/mqtt'
+
     def __init__(self, baseURL, absolutMaxCurrent):
         #Initialize variables
         self.allowsCharging = False
@@ -39,39 +41,78 @@ class goEcharger:
         self.maxEnergy = 0
         self.limitToMaxEnergy = False
 
-    def allowCharging(self, allow):
-        if allow == True:
-            payload = {'payload': 'alw=1'}
-        elif allow == False:
-            payload = {'payload': 'alw=0'}
+        # One keep-alive session for all requests, so the TCP connection is reused
+        self.session = requests.Session()
+        # Settings as last read from or written to the wallbox, e.g. {"amp": "8"}
+        self.knownSettings = dict()
+        # Settings which are not yet sent, see flushSettings()
+        self.pendingSettings = dict()
+
+    @classmethod
+    def fromConfig(cls, wallboxConfig):
+        # Create the wallbox from its configuration (Config.WallboxConfig)
+        return cls(wallboxConfig.IP, wallboxConfig.absolutMaxCurrent)
+
+    def queueSetting(self, key, value):
+        # Only remember the setting, it's sent with the next call to flushSettings()
+        if self.knownSettings.get(key) == value :
+            # wallbox already has this value, don't write it again
+            self.pendingSettings.pop(key, None)
+        else :
+            self.pendingSettings[key] = value
+
+    def pendingPayload(self):
+        # Parameters of the request which sends all pending settings, None if nothing is pending
+        if len(self.pendingSettings) == 0 :
+            return None
+        return {'payload': ','.join(key + '=' + value for key, value in self.pendingSettings.items())}
+
+    def statusParameters(self):
+        # Parameters of the status request
+        return None
+
+    def checkSetResponse(self, statusCode):
+        # Raises IOError if the wallbox has not accepted the settings
+        pass
+
+    def settingsSent(self):
+        self.knownSettings.update(self.pendingSettings)
+        self.pendingSettings.clear()
+
+    def flushSettings(self):
+        # Send all pending settings in one single request
+        payload = self.pendingPayload()
+        if payload == None :
+            return
         try:
-            requests.get(self.baseURL +'/mqtt', params=payload)
+            resp = self.session.get(self.baseURL + self.SET_PATH, params=payload, timeout=5)
         except requests.exceptions.RequestException:
             raise IOError
+        self.checkSetResponse(resp.status_code)
+        self.settingsSent()
+
+    def allowCharging(self, allow):
+        if allow == True:
+            self.queueSetting('alw', '1')
+        elif allow == False:
+            self.queueSetting('alw', '0')
         self.allowsCharging = allow
 
     def setMaxCurrent(self, maxCurrent):
         # Don't allow to high currents due to misconfiguration
         if (maxCurrent <= self.absolutMaxCurrent) :
-            payload = {'payload': 'amp=' + str(maxCurrent)}
+            self.queueSetting('amp', str(maxCurrent))
         else:
-            payload = {'payload': 'amp=' + str(self.absolutMaxCurrent)}
-        try:
-            requests.get(self.baseURL +'/mqtt', params=payload)
-        except requests.exceptions.RequestException:
-            raise IOError
+            self.queueSetting('amp', str(self.absolutMaxCurrent))
         self.maxCurrent = maxCurrent
 
     def setMaxEnergy(self, limitToMaxEnergy, maxEnergy):
         if limitToMaxEnergy == True :
-            payload = {'payload': 'dwo=' + '{:d}'.format(int(maxEnergy * 10)) + ',stp=2'} #Energy is configured as 0.1 kWh
+            self.queueSetting('dwo', '{:d}'.format(int(maxEnergy * 10))) #Energy is configured as 0.1 kWh
+            self.queueSetting('stp', '2')
         else :
-            payload = {'payload': 'dwo=0,stp=0'} #Energy is configured as 0.1 kWh
-        #Send the data to the wallbox
-        try:
-            requests.get(self.baseURL +'/mqtt', params=payload)
-        except requests.exceptions.RequestException:
-            raise IOError
+            self.queueSetting('dwo', '0')
+            self.queueSetting('stp', '0')
 
         self.limitToMaxEnergy = limitToMaxEnergy
         self.maxEnergy = maxEnergy
@@ -79,26 +120,117 @@ class goEcharger:
     def readStatus(self):
         #Connect to wallbox and read some stuff
         try:
-            resp = requests.get(self.baseURL + '/status')
-            self.maxCurrent = resp.json()["amp"]
-            self.currentPower = resp.json()["nrg"][11] / 100 # power is returned as 0.01kW
-            if resp.json()["alw"] == 0 :
-                self.allowsCharging = False
-            else :
-                self.allowsCharging = True
-            self.energy = int(resp.json()["dws"]) / 360000 # Energy is returned as Deka-Watt-Seconds
-            self.error = int(resp.json()["err"])
-            self.state = WallboxState(int(resp.json()["car"]))
-            self.maxEnergy = float(resp.json()["dwo"]) / 10 # Energy is returned as 0.1 kWh
-            if resp.json()["stp"] == 0 :
-                self.limitToMaxEnergy = False
-            else :
-                self.limitToMaxEnergy = True
+            resp = self.session.get(self.baseURL + self.STATUS_PATH, params=self.statusParameters(), timeout=5)
+            self.parseStatus(resp.json())
         except requests.exceptions.RequestException: 
             raise IOError
         except json.decoder.JSONDecodeError:
             raise IOError
 
+    def parseStatus(self, status):
+        # Take over the status object returned by /status
+        self.maxCurrent = status["amp"]
+        self.currentPower = status["nrg"][11] / 100 # power is returned as 0.01kW
+        if status["alw"] == 0 :
+            self.allowsCharging = False
+        else :
+            self.allowsCharging = True
+        self.energy = int(status["dws"]) / 360000 # Energy is returned as Deka-Watt-Seconds
+        self.error = int(status["err"])
+        self.state = WallboxState(int(status["car"]))
+        self.maxEnergy = float(status["dwo"]) / 10 # Energy is returned as 0.1 kWh
+        if status["stp"] == 0 :
+            self.limitToMaxEnergy = False
+        else :
+            self.limitToMaxEnergy = True
+
+        # Remember the state of the wallbox, so unchanged settings are not written again
+        self.knownSettings = {key: str(int(status[key])) for key in ('alw', 'amp', 'dwo', 'stp')}
+
+
+##################################################################################################
+# Wallbox goEchargerV2
+# go-eCharger with the HTTP API v2 (hardware V3 and newer). Only the needed keys of the status
+# are requested, and all settings are sent with one /api/set request.
+##################################################################################################
+
+# Values of "car" in API v2, 0 (unknown) and 5 (error) have no WallboxState
+CAR_STATES_V2 = {1: WallboxState.STATE_READY_NO_CAR, 2: WallboxState.STATE_CHARGING, 3: WallboxState.STATE_WAITING_FOR_CAR,
+                 4: WallboxState.STATE_FINISHED_CAR_STILL_CONNECTED}
+
+
+class StatusV2:
+
+    # The keys of the status used by goEchargerV2
+    __slots__ = ("car", "amp", "alw", "frc", "nrg", "wh", "err", "dwo")
+
+    def __init__(self, status):
+        for key in self.__slots__:
+            setattr(self, key, status[key])
+
+
+class goEchargerV2(goEcharger):
+
+    STATUS_PATH = '/api/status'
+    SET_PATH = '/api/set'
+
+    def statusParameters(self):
+        return {'filter': ','.join(StatusV2.__slots__)}
+
+    def pendingPayload(self):
+        # One parameter per setting, the values are JSON
+        if len(self.pendingSettings) == 0 :
+            return None
+        return dict(self.pendingSettings)
+
+    def checkSetResponse(self, statusCode):
+        if statusCode != 200 :
+            raise IOError("Settings not accepted, HTTP status " + str(statusCode))
+
+    def allowCharging(self, allow):
+        # forceState: 1 off, 2 on
+        if allow == True:
+            self.queueSetting('frc', '2')
+        elif allow == False:
+            self.queueSetting('frc', '1')
+        self.allowsCharging = allow
+
+    def setMaxEnergy(self, limitToMaxEnergy, maxEnergy):
+        # The limit is configured in Wh, null switches it off
+        if limitToMaxEnergy == True :
+            self.queueSetting('dwo', '{:d}'.format(int(maxEnergy * 1000)))
+        else :
+            self.queueSetting('dwo', 'null')
+        self.limitToMaxEnergy = limitToMaxEnergy
+        self.maxEnergy = maxEnergy
+
+    def readStatus(self):
+        try:
+            super().readStatus()
+        except (KeyError, TypeError, IndexError):
+            raise IOError
+
+    def parseStatus(self, status):
+        # Take over the status object returned by /api/status
+        status = StatusV2(status)
+        self.maxCurrent = status.amp
+        self.currentPower = status.nrg[11] / 1000 # power is returned in W
+        self.allowsCharging = bool(status.alw)
+        self.energy = status.wh / 1000 # energy since the car is connected, in Wh
+        self.error = int(status.err)
+        self.state = CAR_STATES_V2.get(status.car, WallboxState.STATE_UNDEFINED)
+        if status.dwo == None :
+            self.maxEnergy = 0
+            self.limitToMaxEnergy = False
+            dwo = 'null'
+        else :
+            self.maxEnergy = status.dwo / 1000
+            self.limitToMaxEnergy = True
+            dwo = '{:d}'.format(int(status.dwo))
+
+        # Remember the state of the wallbox, so unchanged settings are not written again
+        self.knownSettings = {'amp': str(int(status.amp)), 'frc': str(int(status.frc)), 'dwo': dwo}
+
 
 ##################################################################################################
 # Wallbox goEchargerSimulation
@@ -106,24 +238,142 @@ class goEcharger:
 ##################################################################################################
 class goEchargerSimulation:
 
-    def __init__(self, baseURL, absolutMaxCurrent):
+    def __init__(self, baseURL, absolutMaxCurrent, car=None, clock=None, phases=3, voltage=230):
         #Initialize variables
         self.allowsCharging = False
         self.absolutMaxCurrent = absolutMaxCurrent
         self.maxCurrent = 0
         self.currentPower = 0
         self.baseURL = baseURL
-        self.state = WallboxState.STATE_CHARGING
+        self.state = WallboxState.STATE_UNDEFINED
         self.energy = 0
         self.error = 0
         self.maxEnergy = 0
         self.limitToMaxEnergy = False
 
+        # Without a car, one is always connected
+        if car == None :
+            car = SimulatedCar()
+        self.car = car
+        # clock.monotonic() and clock.now() as in ChargePlan.SystemClock
+        self.clock = clock
+        self.phases = phases
+        self.voltage = voltage
+        self.lastUpdate = None
+        self.carConnected = False
+        self.currentChanges = 0 # number of times the current has been changed
+
+    @classmethod
+    def fromConfig(cls, wallboxConfig):
+        return cls(wallboxConfig.IP, wallboxConfig.absolutMaxCurrent, phases=wallboxConfig.phases, voltage=wallboxConfig.voltage)
+
     def allowCharging(self, allow):
         self.allowsCharging = allow
 
     def setMaxCurrent(self, maxCurrent):
-        self.maxCurrent = maxCurrent
+        if min(maxCurrent, self.absolutMaxCurrent) != self.maxCurrent :
+            self.currentChanges = self.currentChanges + 1
+        self.maxCurrent = min(maxCurrent, self.absolutMaxCurrent)
+
+    def setMaxEnergy(self, limitToMaxEnergy, maxEnergy):
+        self.limitToMaxEnergy = limitToMaxEnergy
+        self.maxEnergy = maxEnergy
+
+    def flushSettings(self):
+        pass
+
+    def getMonotonic(self):
+        if self.clock == None :
+            return time.monotonic()
+        return self.clock.monotonic()
+
+    def getNow(self):
+        if self.clock == None :
+            return datetime.datetime.now()
+        return self.clock.now()
+
+    def getChargingPower(self):
+        # Power in kW with the current settings, state and battery of the car
+        if not self.carConnected or not self.allowsCharging :
+            return 0
+        if self.limitToMaxEnergy and self.energy >= self.maxEnergy :
+            return 0
+        return min(self.maxCurrent * self.phases * self.voltage / 1000, self.car.getMaxPowerkW())
+
+    def update(self):
+        # Charge the car with the power since the last update, then take over its state
+        now = self.getMonotonic()
+        if self.lastUpdate != None :
+            chargedEnergy = self.car.charge(self.getChargingPower(), now - self.lastUpdate)
+            self.energy = self.energy + chargedEnergy
+        self.lastUpdate = now
+
+        connected = self.car.isConnected(self.getNow())
+        if connected and not self.carConnected :
+            # new charging session
+            self.energy = 0
+        self.carConnected = connected
+
+        self.currentPower = self.getChargingPower()
+        if not connected :
+            self.state = WallboxState.STATE_READY_NO_CAR
+        elif self.car.isFull() or (self.limitToMaxEnergy and self.energy >= self.maxEnergy) :
+            self.state = WallboxState.STATE_FINISHED_CAR_STILL_CONNECTED
+        elif self.currentPower > 0 :
+            self.state = WallboxState.STATE_CHARGING
+        else :
+            self.state = WallboxState.STATE_WAITING_FOR_CAR
 
     def readStatus(self):
-        self.energy = self.energy + 0.5
\ No newline at end of file
+        self.update()
+
+
+##################################################################################################
+# SimulatedCar
+# Battery of a car for goEchargerSimulation. The car arrives every day at arrivalHour with
+# arrivalSoc and leaves at departureHour. The charging power is reduced above taperSoc,
+# as with real batteries.
+##################################################################################################
+class SimulatedCar:
+
+    def __init__(self, batterysizekWh=40, maxPowerkW=11, arrivalSoc=0.3, arrivalHour=None, departureHour=None, taperSoc=0.8):
+        self.batterysizekWh = batterysizekWh
+        self.maxPowerkW = maxPowerkW
+        self.arrivalSoc = arrivalSoc
+        self.arrivalHour = arrivalHour # None: always connected
+        self.departureHour = departureHour
+        self.taperSoc = taperSoc
+        self.soc = arrivalSoc
+        self.connected = False
+
+    def isConnected(self, now):
+        if self.arrivalHour == None :
+            connected = True
+        else :
+            hour = now.hour + now.minute / 60
+            if self.arrivalHour <= self.departureHour :
+                connected = self.arrivalHour <= hour < self.departureHour
+            else :
+                # connected over midnight
+                connected = hour >= self.arrivalHour or hour < self.departureHour
+        if connected and not self.connected :
+            self.soc = self.arrivalSoc
+        self.connected = connected
+        return connected
+
+    def isFull(self):
+        return self.soc >= 1
+
+    def getMaxPowerkW(self):
+        if self.soc >= 1 :
+            return 0
+        if self.soc <= self.taperSoc :
+            return self.maxPowerkW
+        # linear down to 10% of the maximum power when full
+        return self.maxPowerkW * (1 - 0.9 * (self.soc - self.taperSoc) / (1 - self.taperSoc))
+
+    def charge(self, powerkW, seconds):
+        # Returns the charged energy in kWh
+        energy = min(powerkW * seconds / 3600, (1 - self.soc) * self.batterysizekWh)
+        self.soc = self.soc + energy / self.batterysizekWh
+        return energy
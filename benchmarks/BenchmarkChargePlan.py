@@ -0,0 +1,215 @@
+######################################################################################
+# BenchmarkChargePlan.py
+# Measures the latency of one iteration of the STATE_CHARGING path (wallbox status,
+# sensor read, decision, wallbox command) and the requests per iteration, against the
+# local fakes of FakeDevices.py.
+#
+# python benchmarks/BenchmarkChargePlan.py --iterations 200 --latency 0.02
+# python benchmarks/BenchmarkChargePlan.py --save-baseline baseline.json
+# python benchmarks/BenchmarkChargePlan.py --baseline baseline.json
+#
+# With --baseline the exit code is 1 if the latency or the number of requests has
+# become worse than the baseline (plus the tolerance).
+######################################################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+# The modules of ChargePlan are in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ChargePlan
+from ChargePlan import ChargePlanState
+import FakeDevices
+
+SENSOR_TYPES = ("smartfox", "fronius", "solarlog", "swissmeteo")
+
+
+def thresholds(key, limit):
+    # All modes charge from the same limit, so the decision is always "charge"
+    return [{"id": mode, "thresholds": [{key: limit, "chargeCurrentAmpere": 8}]} for mode in range(1, 6)]
+
+
+def createConfig(wallbox, wallboxType, sensors, historyDirectory, sampling):
+    measurements = list()
+    for sensorType, device in sensors:
+        if sensorType == "smartfox" :
+            measurements.append({"type": "Smartfox", "ip": device.getURL(), "port": device.getPort(), "modes": thresholds("minPowerProductionKW", 1)})
+        elif sensorType == "fronius" :
+            measurements.append({"type": "Fronius", "url": device.getURL(), "deviceID": 1, "modes": thresholds("minPowerProductionKW", 1)})
+        elif sensorType == "solarlog" :
+            measurements.append({"type": "Solarlog", "url": device.getURL() + "/", "username": "user", "password": "secret", "modes": thresholds("minPowerProductionKW", 1)})
+        elif sensorType == "swissmeteo" :
+            measurements.append({"type": "Swissmeteo", "station": "EXA", "url": device.getURL() + "/feed.json", "modes": thresholds("minSunshineDuration", 5)})
+    return {
+        "modes": [{"id": mode, "name": "Mode " + str(mode)} for mode in range(1, 6)],
+        "measurements": measurements,
+        "wallbox": {"IP": wallbox.getURL(), "type": wallboxType, "absolutMaxCurrent": 16},
+        "cars": [{"id": 1, "name": "Benchmark", "batterysizekWh": 40, "deadlineHours": 3}],
+        "timing": {"connectionMaxRetrys": 10, "waitAfterFinishedSeconds": 300, "waitWithoutCarSeconds": 120, "waitAfterErrorSeconds": 60,
+                   "waitWithoutSunSeconds": 120, "waitChargingSeconds": 300, "sensorDeadlineSeconds": 6},
+        "history": {"directory": historyDirectory},
+        "state": {"file": os.path.join(os.path.dirname(historyDirectory), "state.json")},
+        "logging": {"level": "ERROR"},
+        # without the sampler, each iteration reads the sensors
+        "sampling": {"enabled": sampling, "intervalSeconds": 1},
+    }
+
+
+def createDevice(sensorType, faults):
+    if sensorType == "smartfox" :
+        return FakeDevices.FakeSmartfox(faults)
+    if sensorType == "fronius" :
+        return FakeDevices.FakeFronius(faults)
+    if sensorType == "solarlog" :
+        return FakeDevices.FakeSolarLog(faults)
+    return FakeDevices.FakeSwissmeteo(faults)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Benchmark:
+
+    def __init__(self, options):
+        self.options = options
+        self.directory = tempfile.mkdtemp(prefix="chargeplan-benchmark-")
+        faults = lambda seed: FakeDevices.FaultInjection(options.latency, options.jitter, options.failure_rate, seed)
+        if options.wallbox == "goEchargerV2" :
+            self.wallbox = FakeDevices.FakeGoEChargerV2(faults(1)).start()
+        else :
+            self.wallbox = FakeDevices.FakeGoECharger(faults(1)).start()
+        self.sensors = [(sensorType, createDevice(sensorType, faults(index + 2)).start()) for index, sensorType in enumerate(options.sensors)]
+        configPath = os.path.join(self.directory, "config.json")
+        with open(configPath, "w") as configFile:
+            json.dump(createConfig(self.wallbox, options.wallbox, self.sensors, os.path.join(self.directory, "history"), options.sampling), configFile)
+        if options.use_async :
+            import AsyncChargePlan
+            self.engine = AsyncChargePlan.AsyncChargePlanEngine(configPath)
+        else :
+            self.engine = ChargePlan.ChargePlanEngine(configPath)
+
+    def getDevices(self):
+        return [("wallbox", self.wallbox)] + self.sensors
+
+    async def runIteration(self):
+        for chargePoint in self.engine.getChargePoints():
+            chargePoint.nextRun = 0
+        if self.options.use_async :
+            await self.engine.runIterationAsync()
+        else :
+            self.engine.runIteration()
+
+    async def run(self):
+        if self.options.use_async :
+            self.engine.loop = asyncio.get_running_loop()
+            self.engine.commandEvent = asyncio.Event()
+        self.engine.initialize()
+
+        # until the car is charging, at most a few iterations
+        for attempt in range(20):
+            if all(chargePoint.state == ChargePlanState.STATE_CHARGING for chargePoint in self.engine.getChargePoints()) :
+                break
+            await self.runIteration()
+        for warmup in range(self.options.warmup):
+            await self.runIteration()
+
+        latencies = list()
+        requests = {name: 0 for name, device in self.getDevices()}
+        for name, device in self.getDevices():
+            device.resetCounts()
+        for iteration in range(self.options.iterations):
+            started = time.perf_counter()
+            await self.runIteration()
+            latencies.append(time.perf_counter() - started)
+        for name, device in self.getDevices():
+            requests[name] = device.getRequestCount() / self.options.iterations
+        commands = self.wallbox.counts.get(self.wallbox.SET_REQUEST, 0)
+        wallboxBytes = self.wallbox.responseBytes
+
+        if self.options.use_async :
+            await self.engine.closeDrivers()
+        return {
+            "iterations": self.options.iterations,
+            "latencyMeanMs": round(1000 * sum(latencies) / len(latencies), 3),
+            "latencyP50Ms": round(1000 * percentile(latencies, 0.5), 3),
+            "latencyP95Ms": round(1000 * percentile(latencies, 0.95), 3),
+            "latencyMaxMs": round(1000 * max(latencies), 3),
+            "requestsPerIteration": {name: round(count, 3) for name, count in requests.items()},
+            "wallboxCommandsPerIteration": round(commands / self.options.iterations, 3),
+            "wallboxResponseBytesPerIteration": round(wallboxBytes / self.options.iterations),
+        }
+
+    def stop(self):
+        for name, device in self.getDevices():
+            device.stop()
+        if self.engine.sampler != None :
+            self.engine.sampler.stop()
+        if self.engine.sensorExecutor != None :
+            self.engine.sensorExecutor.shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def compareWithBaseline(result, baseline, tolerance):
+    # Returns the list of regressions
+    regressions = list()
+    for key in ("latencyP50Ms", "latencyP95Ms"):
+        if result[key] > baseline[key] * (1 + tolerance) :
+            regressions.append(key + ": " + str(result[key]) + " > " + str(baseline[key]))
+    for name, count in result["requestsPerIteration"].items():
+        if count > baseline["requestsPerIteration"].get(name, 0) * (1 + tolerance) :
+            regressions.append("requests " + name + ": " + str(count) + " > " + str(baseline["requestsPerIteration"].get(name, 0)))
+    return regressions
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Benchmark of the ChargePlan control loop against fake devices")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--sensors", default=",".join(SENSOR_TYPES), help="comma separated, in priority order: " + ", ".join(SENSOR_TYPES))
+    parser.add_argument("--latency", type=float, default=0, help="latency of each device request in seconds")
+    parser.add_argument("--jitter", type=float, default=0, help="additional random latency in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0, help="probability that a device request fails")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="benchmark the asyncio engine")
+    parser.add_argument("--wallbox", default="goEcharger", choices=("goEcharger", "goEchargerV2"), help="API of the fake wallbox")
+    parser.add_argument("--sampling", action="store_true", help="read the sensors in the background sampler instead of in each iteration")
+    parser.add_argument("--baseline", default=None, help="compare with a result saved with --save-baseline")
+    parser.add_argument("--save-baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    options = parser.parse_args(arguments)
+    options.sensors = [sensorType.strip().lower() for sensorType in options.sensors.split(",") if sensorType.strip() != ""]
+    for sensorType in options.sensors:
+        if sensorType not in SENSOR_TYPES :
+            parser.error("unknown sensor: " + sensorType)
+
+    benchmark = Benchmark(options)
+    try:
+        result = asyncio.run(benchmark.run())
+    finally:
+        benchmark.stop()
+    print(json.dumps(result, indent=2))
+
+    if options.save_baseline != None :
+        with open(options.save_baseline, "w") as baselineFile:
+            json.dump(result, baselineFile, indent=2)
+    if options.baseline != None :
+        with open(options.baseline) as baselineFile:
+            regressions = compareWithBaseline(result, json.load(baselineFile), options.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression)
+        if len(regressions) > 0 :
+            return 1
+    return 0
+
+
+#If file is called as script, not used as module
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
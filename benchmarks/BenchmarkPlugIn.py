@@ -0,0 +1,123 @@
+######################################################################################
+# BenchmarkPlugIn.py
+# Measures how fast a plugged in car is noticed and how many wallbox requests are
+# sent while no car is connected, with polling only and with the status published
+# by the wallbox on the local fake MQTT broker of FakeDevices.py. While idle, the
+# wallbox publishes its power --publish-hz times per second, which must not wake up
+# the engine.
+#
+# python benchmarks/BenchmarkPlugIn.py --idle-seconds 10 --poll-seconds 5 [--async]
+######################################################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+# The modules of ChargePlan are in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ChargePlan
+import Metrics
+from ChargePlan import ChargePlanState
+import FakeDevices
+from BenchmarkChargePlan import createConfig
+
+TOPIC = "go-eCharger/000001"
+
+
+def waitFor(condition, timeout):
+    # Returns the seconds until the condition was true, None after the timeout
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if condition() :
+            return time.perf_counter() - started
+        time.sleep(0.005)
+    return None
+
+
+def getIterationCount():
+    # Iterations of the engines of this process, from the histogram of their duration
+    with Metrics.iterationSeconds.lock:
+        return sum(entry[2] for entry in Metrics.iterationSeconds.values.values())
+
+
+def runScenario(options, useMqtt):
+    directory = tempfile.mkdtemp(prefix="chargeplan-benchmark-")
+    wallbox = FakeDevices.FakeGoECharger(car=1).start()
+    sensor = FakeDevices.FakeFronius().start()
+    broker = None
+    config = createConfig(wallbox, "goEcharger", [("fronius", sensor)], os.path.join(directory, "history"), False)
+    config["timing"]["waitWithoutCarSeconds"] = options.poll_seconds
+    if useMqtt :
+        broker = FakeDevices.FakeMqttBroker().start()
+        config["wallbox"]["mqttTopic"] = TOPIC
+        config["mqtt"] = {"host": broker.getURL(), "port": broker.getPort(), "livenessSeconds": 600}
+    configPath = os.path.join(directory, "config.json")
+    with open(configPath, "w") as configFile:
+        json.dump(config, configFile)
+
+    if options.use_async :
+        import AsyncChargePlan
+        engine = AsyncChargePlan.AsyncChargePlanEngine(configPath)
+    else :
+        engine = ChargePlan.ChargePlanEngine(configPath)
+    threading.Thread(target=engine.start, daemon=True).start()
+    try:
+        getState = lambda: [chargePoint.state for chargePoint in engine.getChargePoints()]
+        if waitFor(lambda: getState() == [ChargePlanState.STATE_NO_CAR], 10) == None :
+            raise RuntimeError("engine not started")
+        if useMqtt :
+            waitFor(lambda: engine.mqtt.isConnected(), 10)
+        time.sleep(0.5)
+
+        wallbox.resetCounts()
+        iterations = getIterationCount()
+        idleEnd = time.perf_counter() + options.idle_seconds
+        while time.perf_counter() < idleEnd:
+            if useMqtt and options.publish_hz > 0 :
+                broker.publish(TOPIC + "/nrg", json.dumps([0] * 11 + [0]))
+                time.sleep(1 / options.publish_hz)
+            else :
+                time.sleep(max(0, idleEnd - time.perf_counter()))
+        idleRequests = wallbox.getRequestCount()
+        idleIterations = getIterationCount() - iterations
+
+        # plug in the car
+        wallbox.car = 3
+        if useMqtt :
+            broker.publish(TOPIC + "/car", "3")
+        reactionSeconds = waitFor(lambda: getState() == [ChargePlanState.STATE_CHARGING], options.poll_seconds * 3)
+    finally:
+        if engine.mqtt != None :
+            engine.mqtt.stop()
+        for device in (wallbox, sensor, broker):
+            if device != None :
+                device.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "idleRequestsPerMinute": round(idleRequests * 60 / options.idle_seconds, 1),
+        "idleIterationsPerMinute": round(idleIterations * 60 / options.idle_seconds, 1),
+        "plugInReactionMs": None if reactionSeconds == None else round(1000 * reactionSeconds, 1),
+    }
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Plug-in reaction and idle requests with polling and with MQTT")
+    parser.add_argument("--idle-seconds", type=float, default=10, help="time without car before it's plugged in")
+    parser.add_argument("--poll-seconds", type=float, default=5, help="waitWithoutCarSeconds")
+    parser.add_argument("--publish-hz", type=float, default=5, help="power messages of the wallbox per second while idle")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="benchmark the asyncio engine")
+    options = parser.parse_args(arguments)
+    result = {"polling": runScenario(options, False), "mqtt": runScenario(options, True)}
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+#If file is called as script, not used as module
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
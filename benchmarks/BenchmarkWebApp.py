@@ -0,0 +1,126 @@
+######################################################################################
+# BenchmarkWebApp.py
+# Measures the home page of ChargePlanWebApp under several clients, with the
+# development server of Flask and with waitress, and with and without conditional
+# requests (If-None-Match). The web application runs as its own process with the
+# engine against the fake devices of FakeDevices.py.
+#
+# python benchmarks/BenchmarkWebApp.py --clients 8 --seconds 5
+######################################################################################
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+# The modules of ChargePlan are in the parent directory
+BASE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIRECTORY)
+
+import FakeDevices
+from BenchmarkChargePlan import createConfig, percentile
+
+
+def getFreePort():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def waitForServer(port, timeout):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/api/status")
+            status = json.loads(connection.getresponse().read())
+            connection.close()
+            if len(status["chargePoints"]) > 0 :
+                return True
+        except (OSError, ValueError, KeyError):
+            pass
+        time.sleep(0.1)
+    return False
+
+
+def runClient(port, conditional, deadline, latencies, statusCounts):
+    # One keep-alive connection, like a browser reloading the page
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    etag = None
+    while time.perf_counter() < deadline:
+        headers = dict()
+        if conditional and etag != None :
+            headers["If-None-Match"] = etag
+        started = time.perf_counter()
+        connection.request("GET", "/", headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - started)
+        statusCounts[response.status] = statusCounts.get(response.status, 0) + 1
+        etag = response.getheader("ETag", etag)
+        if response.getheader("Connection", "").lower() == "close" :
+            connection.close()
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    connection.close()
+
+
+def runScenario(options, server, conditional):
+    directory = tempfile.mkdtemp(prefix="chargeplan-benchmark-")
+    wallbox = FakeDevices.FakeGoECharger().start()
+    sensor = FakeDevices.FakeFronius().start()
+    port = getFreePort()
+    config = createConfig(wallbox, "goEcharger", [("fronius", sensor)], os.path.join(directory, "history"), False)
+    config["web"] = {"host": "127.0.0.1", "port": port, "server": server}
+    with open(os.path.join(directory, "config.json"), "w") as configFile:
+        json.dump(config, configFile)
+    # ChargePlanWebApp reads config.json of the working directory
+    process = subprocess.Popen([sys.executable, os.path.join(BASE_DIRECTORY, "ChargePlanWebApp.py")], cwd=directory,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not waitForServer(port, 20) :
+            raise RuntimeError("web application not started")
+        latencies = list()
+        statusCounts = dict()
+        deadline = time.perf_counter() + options.seconds
+        clients = [threading.Thread(target=runClient, args=(port, conditional, deadline, latencies, statusCounts)) for client in range(options.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    finally:
+        process.kill()
+        process.wait()
+        wallbox.stop()
+        sensor.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "requestsPerSecond": round(len(latencies) / options.seconds, 1),
+        "latencyP50Ms": round(1000 * percentile(latencies, 0.5), 3),
+        "latencyP95Ms": round(1000 * percentile(latencies, 0.95), 3),
+        "statusCodes": {str(code): count for code, count in sorted(statusCounts.items())},
+    }
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Home page requests per second of the web servers")
+    parser.add_argument("--clients", type=int, default=8, help="parallel clients")
+    parser.add_argument("--seconds", type=float, default=5, help="duration of each scenario")
+    parser.add_argument("--server", choices=("flask", "waitress"), action="append", help="server to measure, default both")
+    options = parser.parse_args(arguments)
+    result = dict()
+    for server in options.server or ("flask", "waitress"):
+        result[server] = {"full": runScenario(options, server, False), "conditional": runScenario(options, server, True)}
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+#If file is called as script, not used as module
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
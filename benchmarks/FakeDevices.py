@@ -0,0 +1,487 @@
+######################################################################################
+# FakeDevices.py
+# Local stand-ins for the devices ChargePlan talks to, for benchmarks without real
+# hardware: go-eCharger REST API, Fronius Solar API, Solar-Log web page, Swissmeteo
+# feed, a Smartfox Modbus TCP server and an MQTT broker. Each fake counts its requests and can delay
+# or fail them (see FaultInjection).
+######################################################################################
+
+import sys
+import json
+import time
+import random
+import threading
+import socketserver
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from email.utils import formatdate
+
+from umodbus import conf
+from umodbus.server.tcp import RequestHandler, get_server
+
+
+######################################################################################
+# Class FaultInjection
+#
+# Latency in seconds (plus a random jitter) and the probability that a request fails.
+######################################################################################
+class FaultInjection:
+
+    def __init__(self, latency=0, jitter=0, failureRate=0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.failureRate = failureRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def apply(self):
+        # Waits the latency, returns True if the request must fail
+        with self.lock:
+            delay = self.latency + self.jitter * self.random.random()
+            fail = self.random.random() < self.failureRate
+        if delay > 0 :
+            time.sleep(delay)
+        return fail
+
+
+######################################################################################
+# Class FakeDevice
+#
+# Base class of all fakes: runs the server in a daemon thread and counts the requests
+# by name, e.g. {"status": 10, "mqtt": 2}.
+######################################################################################
+class FakeDevice:
+
+    def __init__(self, faults=None):
+        if faults == None :
+            faults = FaultInjection()
+        self.faults = faults
+        self.counts = dict()
+        self.responseBytes = 0
+        self.countLock = threading.Lock()
+        self.server = None
+
+    def count(self, name):
+        with self.countLock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def countBytes(self, length):
+        with self.countLock:
+            self.responseBytes = self.responseBytes + length
+
+    def resetCounts(self):
+        with self.countLock:
+            counts = self.counts
+            self.counts = dict()
+            self.responseBytes = 0
+        return counts
+
+    def getRequestCount(self):
+        with self.countLock:
+            return sum(self.counts.values())
+
+    def createServer(self):
+        raise NotImplementedError
+
+    def start(self):
+        self.server = self.createServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server != None :
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def getPort(self):
+        return self.server.server_address[1]
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients close connections when they give up (timeouts, cancelled sensor reads)
+        if not isinstance(sys.exc_info()[1], ConnectionError) :
+            super().handle_error(request, client_address)
+
+
+class FakeHTTPDevice(FakeDevice):
+
+    def createServer(self):
+        device = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and content are written separately, don't wait for delayed ACKs
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                device.handle(self, "GET")
+
+            def do_POST(self):
+                device.handle(self, "POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return QuietHTTPServer(("127.0.0.1", 0), Handler)
+
+    def getURL(self):
+        return "http://127.0.0.1:" + str(self.getPort())
+
+    def handle(self, handler, method):
+        url = urlparse(handler.path)
+        if method == "POST" :
+            length = int(handler.headers.get("Content-Length", 0))
+            body = parse_qs(handler.rfile.read(length).decode())
+        else :
+            body = dict()
+        self.count(self.requestName(method, url.path))
+        if self.faults.apply() :
+            # drop the connection without an answer
+            handler.close_connection = True
+            return
+        status, headers, content = self.respond(method, url.path, parse_qs(url.query), body, handler.headers)
+        try:
+            handler.send_response(status)
+            for key, value in headers.items():
+                handler.send_header(key, value)
+            handler.send_header("Content-Length", str(len(content)))
+            handler.end_headers()
+            handler.wfile.write(content)
+            self.countBytes(len(content))
+        except (BrokenPipeError, ConnectionResetError):
+            # the client has given up, e.g. a sensor read after the deadline
+            handler.close_connection = True
+
+    def requestName(self, method, path):
+        return path.strip("/")
+
+    def respond(self, method, path, query, body, headers):
+        # Returns (status, headers, content as bytes)
+        raise NotImplementedError
+
+    def jsonResponse(self, data, headers=None):
+        if headers == None :
+            headers = dict()
+        headers["Content-Type"] = "application/json"
+        return 200, headers, json.dumps(data).encode()
+
+
+######################################################################################
+# Class FakeGoECharger
+#
+# /status with the fields used by Wallbox.goEcharger, /mqtt?payload=key=value,... sets them.
+######################################################################################
+class FakeGoECharger(FakeHTTPDevice):
+
+    # Request name of the settings requests
+    SET_REQUEST = "mqtt"
+
+    def __init__(self, faults=None, car=2, powerkW=3.5):
+        super().__init__(faults)
+        self.settings = {"alw": 0, "amp": 6, "dwo": 0, "stp": 0}
+        self.car = car
+        self.powerkW = powerkW
+        self.energykWh = 1.0
+
+    def respond(self, method, path, query, body, headers):
+        if path == "/mqtt" :
+            for setting in query.get("payload", [""])[0].split(","):
+                key, separator, value = setting.partition("=")
+                if separator != "" :
+                    self.settings[key] = int(value)
+            return self.jsonResponse(dict(self.settings))
+        if path == "/status" :
+            nrg = [0] * 16
+            if self.settings["alw"] :
+                nrg[11] = int(self.powerkW * 100)
+            status = dict(self.settings, car=str(self.car), nrg=nrg, dws=str(int(self.energykWh * 360000)), err="0")
+            return self.jsonResponse(status)
+        return 404, dict(), b""
+
+
+######################################################################################
+# Class FakeGoEChargerV2
+#
+# HTTP API v2: /api/status?filter=key,... returns only these keys, otherwise all of a
+# multi-kilobyte status. /api/set?key=value&... sets them, the values are JSON.
+######################################################################################
+class FakeGoEChargerV2(FakeHTTPDevice):
+
+    SET_REQUEST = "api/set"
+
+    def __init__(self, faults=None, car=2, powerkW=3.5):
+        super().__init__(faults)
+        self.settings = {"amp": 6, "frc": 1, "dwo": None}
+        self.car = car
+        self.powerkW = powerkW
+        self.energykWh = 1.0
+        # stand-in for the other keys of the real status
+        self.otherKeys = {"k{:03d}".format(index): [0, 0.5, "value"] for index in range(200)}
+
+    def respond(self, method, path, query, body, headers):
+        if path == "/api/set" :
+            result = dict()
+            for key, values in query.items():
+                self.settings[key] = json.loads(values[0])
+                result[key] = True
+            return self.jsonResponse(result)
+        if path == "/api/status" :
+            nrg = [0] * 16
+            if self.settings["frc"] == 2 :
+                nrg[11] = int(self.powerkW * 1000)
+            status = dict(self.otherKeys, car=self.car, alw=self.settings["frc"] == 2, nrg=nrg, wh=self.energykWh * 1000, err=0, **self.settings)
+            if "filter" in query :
+                keys = query["filter"][0].split(",")
+                status = {key: status[key] for key in keys if key in status}
+            return self.jsonResponse(status)
+        return 404, dict(), b""
+
+
+######################################################################################
+# Class FakeFronius
+######################################################################################
+class FakeFronius(FakeHTTPDevice):
+
+    def __init__(self, faults=None, powerW=3000, loadW=500):
+        super().__init__(faults)
+        self.powerW = powerW
+        self.loadW = loadW
+
+    def respond(self, method, path, query, body, headers):
+        if path == "/solar_api/v1/GetInverterRealtimeData.cgi" :
+            return self.jsonResponse({"Body": {"Data": {"PAC": {"Unit": "W", "Value": self.powerW}}}, "Head": {"Status": {"Code": 0}}})
+        if path == "/solar_api/v1/GetPowerFlowRealtimeData.fcgi" :
+            site = {"Mode": "meter", "P_PV": self.powerW, "P_Load": -self.loadW, "P_Grid": self.loadW - self.powerW, "P_Akku": None}
+            return self.jsonResponse({"Body": {"Data": {"Site": site, "Inverters": {"1": {"P": self.powerW}}}}, "Head": {"Status": {"Code": 0}}})
+        return 404, dict(), b""
+
+
+######################################################################################
+# Class FakeSolarLog
+#
+# Shows the login form until the session cookie has been set by a POST.
+######################################################################################
+class FakeSolarLog(FakeHTTPDevice):
+
+    def __init__(self, faults=None, powerW=3000):
+        super().__init__(faults)
+        self.powerW = powerW
+
+    def requestName(self, method, path):
+        if method == "POST" :
+            return "login"
+        return "page"
+
+    def respond(self, method, path, query, body, headers):
+        if method == "POST" :
+            return 200, {"Set-Cookie": "SolarLogSession=1; Path=/", "Content-Type": "text/html"}, b"<html>OK</html>"
+        if "SolarLogSession=1" not in headers.get("Cookie", "") :
+            return 200, {"Content-Type": "text/html"}, b'<html><form><input name="password"></form></html>'
+        page = "<html><p>P<sub>AC</sub>: " + str(self.powerW) + " W</p></html>"
+        return 200, {"Content-Type": "text/html"}, page.encode()
+
+
+######################################################################################
+# Class FakeSwissmeteo
+#
+# GeoJSON feed of the sunshine duration, answers 304 if the ETag has not changed.
+######################################################################################
+class FakeSwissmeteo(FakeHTTPDevice):
+
+    def __init__(self, faults=None, station="EXA", value=10):
+        super().__init__(faults)
+        self.station = station
+        self.value = value
+
+    def respond(self, method, path, query, body, headers):
+        etag = '"' + self.station + "-" + str(self.value) + '"'
+        if headers.get("If-None-Match") == etag :
+            return 304, {"ETag": etag}, b""
+        feed = {"features": [{"id": self.station, "properties": {"station_name": "Example", "value": self.value}}]}
+        return self.jsonResponse(feed, {"ETag": etag, "Last-Modified": formatdate(usegmt=True)})
+
+
+######################################################################################
+# Class FakeMqttBroker
+#
+# MQTT 3.1.1 broker with QoS 0 only, enough for paho-mqtt: connect, subscribe with
+# wildcards, retained messages and ping. publish() sends a message like a device.
+######################################################################################
+def topicMatches(topicFilter, topic):
+    filterLevels = topicFilter.split("/")
+    topicLevels = topic.split("/")
+    for index, level in enumerate(filterLevels):
+        if level == "#" :
+            return True
+        if index >= len(topicLevels) or (level != "+" and level != topicLevels[index]) :
+            return False
+    return len(filterLevels) == len(topicLevels)
+
+
+def encodeString(text):
+    data = text.encode()
+    return len(data).to_bytes(2, "big") + data
+
+
+def encodePacket(packetType, body):
+    length = len(body)
+    header = bytearray([packetType])
+    while True:
+        byte = length % 128
+        length = length // 128
+        header.append(byte | 0x80 if length > 0 else byte)
+        if length == 0 :
+            return bytes(header) + body
+
+
+class FakeMqttBroker(FakeDevice):
+
+    def __init__(self, faults=None):
+        super().__init__(faults)
+        self.clients = dict() # socket -> list of topic filters
+        self.retained = dict() # topic -> payload
+        self.lock = threading.Lock()
+
+    def createServer(self):
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+
+            def handle(self):
+                broker.serve(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        return server
+
+    def getURL(self):
+        return "127.0.0.1"
+
+    def readPacket(self, connection):
+        first = connection.recv(1)
+        if len(first) == 0 :
+            return None, None
+        length = 0
+        shift = 0
+        while True:
+            byte = connection.recv(1)[0]
+            length = length + ((byte & 0x7F) << shift)
+            shift = shift + 7
+            if byte & 0x80 == 0 :
+                break
+        body = b""
+        while len(body) < length:
+            chunk = connection.recv(length - len(body))
+            if len(chunk) == 0 :
+                return None, None
+            body = body + chunk
+        return first[0], body
+
+    def serve(self, connection):
+        with self.lock:
+            self.clients[connection] = list()
+        try:
+            while True:
+                header, body = self.readPacket(connection)
+                if header == None :
+                    return
+                packetType = header >> 4
+                self.count("packet")
+                if packetType == 1 : # CONNECT
+                    connection.sendall(encodePacket(0x20, b"\x00\x00"))
+                elif packetType == 3 : # PUBLISH
+                    topicLength = int.from_bytes(body[:2], "big")
+                    topic = body[2:2 + topicLength].decode()
+                    offset = 2 + topicLength + (2 if header & 0x06 else 0)
+                    self.publish(topic, body[offset:], bool(header & 0x01))
+                elif packetType == 8 : # SUBSCRIBE
+                    self.subscribe(connection, body)
+                elif packetType == 10 : # UNSUBSCRIBE
+                    connection.sendall(encodePacket(0xB0, body[:2]))
+                elif packetType == 12 : # PINGREQ
+                    connection.sendall(encodePacket(0xD0, b""))
+                elif packetType == 14 : # DISCONNECT
+                    return
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.clients.pop(connection, None)
+
+    def subscribe(self, connection, body):
+        packetID = body[:2]
+        offset = 2
+        topicFilters = list()
+        while offset < len(body):
+            length = int.from_bytes(body[offset:offset + 2], "big")
+            topicFilters.append(body[offset + 2:offset + 2 + length].decode())
+            offset = offset + 2 + length + 1 # requested QoS
+        with self.lock:
+            self.clients[connection].extend(topicFilters)
+            retained = [(topic, payload) for topic, payload in self.retained.items() if any(topicMatches(topicFilter, topic) for topicFilter in topicFilters)]
+        connection.sendall(encodePacket(0x90, packetID + bytes(len(topicFilters))))
+        for topic, payload in retained:
+            connection.sendall(encodePacket(0x31, encodeString(topic) + payload))
+
+    def publish(self, topic, payload, retain=False):
+        if isinstance(payload, str) :
+            payload = payload.encode()
+        packet = encodePacket(0x30, encodeString(topic) + payload)
+        with self.lock:
+            if retain :
+                self.retained[topic] = payload
+            receivers = [connection for connection, topicFilters in self.clients.items() if any(topicMatches(topicFilter, topic) for topicFilter in topicFilters)]
+        for connection in receivers:
+            try:
+                connection.sendall(packet)
+            except OSError:
+                pass
+
+
+######################################################################################
+# Class FakeSmartfox
+#
+# Modbus TCP server with the registers read by Smartfox.Smartfox.
+######################################################################################
+class FakeSmartfox(FakeDevice):
+
+    def __init__(self, faults=None, gridPowerW=-3000, analogOutPowerW=0):
+        super().__init__(faults)
+        self.gridPowerW = gridPowerW # negative: power fed into the grid
+        self.analogOutPowerW = analogOutPowerW
+
+    def getRegisters(self):
+        registers = dict()
+        gridPower = self.gridPowerW & 0xFFFFFFFF
+        registers[41017] = gridPower >> 16
+        registers[41018] = gridPower & 0xFFFF
+        registers[41041] = self.analogOutPowerW >> 16
+        registers[41042] = self.analogOutPowerW & 0xFFFF
+        return registers
+
+    def createServer(self):
+        conf.SIGNED_VALUES = False
+        socketserver.TCPServer.allow_reuse_address = True
+        server = get_server(socketserver.ThreadingTCPServer, ("127.0.0.1", 0), RequestHandler)
+        server.daemon_threads = True
+        device = self
+
+        @server.route(slave_ids=[1], function_codes=[3], addresses=list(range(41017, 41043)))
+        def readHoldingRegister(slave_id, function_code, address):
+            if address == 41017 :
+                # one block read per request
+                device.count("read")
+                if device.faults.apply() :
+                    raise IOError("injected failure")
+            return device.getRegisters().get(address, 0)
+
+        return server
+
+    def getURL(self):
+        return "127.0.0.1"